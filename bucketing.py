@@ -0,0 +1,107 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Groups examples by sequence length so that inference skips padding.
+
+`BertModel` needs a static sequence length, so instead of padding every
+example to `max_seq_length`, examples are grouped into buckets and each bucket
+is run separately at its own (static) length. Since examples are zero-padded
+at the end, truncating a padded example to a bucket length that is at least
+its real length only removes padding.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import collections
+
+
+def parse_bucket_lengths(bucket_lengths, max_seq_length):
+  """Parses a comma-separated list of bucket lengths.
+
+  Args:
+    bucket_lengths: String such as "16,32,64".
+    max_seq_length: int. The length that examples were padded to. It is
+      always added as the last bucket, and longer buckets are dropped.
+
+  Returns:
+    A sorted list of unique ints.
+
+  Raises:
+    ValueError: If a bucket length is not positive.
+  """
+  lengths = set([max_seq_length])
+  for x in bucket_lengths.split(","):
+    x = x.strip()
+    if not x:
+      continue
+    length = int(x)
+    if length <= 0:
+      raise ValueError("Bucket lengths must be positive: %s" % bucket_lengths)
+    if length < max_seq_length:
+      lengths.add(length)
+  return sorted(lengths)
+
+
+def bucket_by_length(lengths, bucket_lengths):
+  """Groups example indexes by the shortest bucket that fits each example.
+
+  Args:
+    lengths: List of the real (unpadded) length of each example.
+    bucket_lengths: Sorted list of bucket lengths. The last one must be at
+      least `max(lengths)`.
+
+  Returns:
+    An OrderedDict from bucket length to the (increasing) list of indexes of
+    the examples in that bucket. Only non-empty buckets are included, in
+    increasing order of length.
+
+  Raises:
+    ValueError: If an example is longer than the longest bucket.
+  """
+  buckets = collections.OrderedDict((x, []) for x in bucket_lengths)
+  for (index, length) in enumerate(lengths):
+    i = bisect.bisect_left(bucket_lengths, length)
+    if i == len(bucket_lengths):
+      raise ValueError("Example %d has length %d, which is longer than the "
+                       "longest bucket (%d)." % (index, length,
+                                                 bucket_lengths[-1]))
+    buckets[bucket_lengths[i]].append(index)
+  return collections.OrderedDict(
+      (length, indexes) for (length, indexes) in buckets.items() if indexes)
+
+
+def restore_order(indexed_results):
+  """Yields results in the order of their index.
+
+  Args:
+    indexed_results: Iterable of (index, result) pairs, in any order, whose
+      indexes are 0, 1, ..., n - 1.
+
+  Yields:
+    The results, ordered by index. A result is yielded as soon as all results
+    with a smaller index have been, so only out-of-order results are held in
+    memory.
+  """
+  pending = {}
+  next_index = 0
+  for (index, result) in indexed_results:
+    pending[index] = result
+    while next_index in pending:
+      yield pending.pop(next_index)
+      next_index += 1
+  if pending:
+    raise ValueError("Missing the result with index %d." % next_index)
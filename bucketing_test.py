@@ -0,0 +1,59 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bucketing
+import tensorflow as tf
+
+
+class BucketingTest(tf.test.TestCase):
+
+  def test_parse_bucket_lengths(self):
+    self.assertEqual(
+        bucketing.parse_bucket_lengths("32, 16,256,64,", 128),
+        [16, 32, 64, 128])
+    self.assertEqual(bucketing.parse_bucket_lengths("", 128), [128])
+    with self.assertRaises(ValueError):
+      bucketing.parse_bucket_lengths("0,16", 128)
+
+  def test_bucket_by_length(self):
+    buckets = bucketing.bucket_by_length([3, 17, 16, 128, 5, 40],
+                                         [16, 32, 64, 128])
+    self.assertEqual(list(buckets.items()), [(16, [0, 2, 4]), (32, [1]),
+                                             (64, [5]), (128, [3])])
+
+    with self.assertRaises(ValueError):
+      bucketing.bucket_by_length([129], [16, 128])
+
+  def test_restore_order(self):
+    buckets = bucketing.bucket_by_length([3, 17, 16, 128, 5, 40],
+                                         [16, 32, 64, 128])
+    indexed_results = []
+    for indexes in buckets.values():
+      for index in indexes:
+        indexed_results.append((index, "result_%d" % index))
+
+    self.assertEqual(
+        list(bucketing.restore_order(indexed_results)),
+        ["result_%d" % i for i in range(6)])
+
+    with self.assertRaises(ValueError):
+      list(bucketing.restore_order([(0, "a"), (2, "c")]))
+
+
+if __name__ == "__main__":
+  tf.test.main()
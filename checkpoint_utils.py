@@ -0,0 +1,80 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Utilities for rewriting the variables of a checkpoint offline."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import tensorflow as tf
+
+# Suffixes of the slot variables that `AdamWeightDecayOptimizer` creates for
+# each trainable variable.
+ADAM_SLOT_SUFFIXES = ("/adam_m", "/adam_v")
+
+
+def get_slot_base_name(name):
+  """Returns the variable that `name` is an optimizer slot of, or `name`."""
+  for suffix in ADAM_SLOT_SUFFIXES:
+    if name.endswith(suffix):
+      return name[:-len(suffix)]
+  return name
+
+
+def load_variables(checkpoint):
+  """Loads all variables of a checkpoint as numpy arrays.
+
+  Args:
+    checkpoint: Checkpoint prefix, e.g. "/path/to/bert_model.ckpt".
+
+  Returns:
+    An OrderedDict from variable name to numpy array, sorted by name.
+  """
+  reader = tf.train.load_checkpoint(checkpoint)
+  variables = collections.OrderedDict()
+  for name in sorted(reader.get_variable_to_shape_map().keys()):
+    variables[name] = reader.get_tensor(name)
+  return variables
+
+
+def save_variables(variables, checkpoint):
+  """Writes numpy arrays to a new checkpoint.
+
+  The values are fed into the variables' initializers instead of being baked
+  into the graph as constants, so tables larger than the 2GB GraphDef limit
+  can be written.
+
+  Args:
+    variables: Dict from variable name to numpy array.
+    checkpoint: Checkpoint prefix to write, e.g. "/path/to/bert_model.ckpt".
+
+  Returns:
+    The path of the written checkpoint.
+  """
+  with tf.Graph().as_default():
+    var_list = collections.OrderedDict()
+    for (name, value) in variables.items():
+      var_list[name] = tf.get_variable(
+          name,
+          shape=value.shape,
+          dtype=tf.as_dtype(value.dtype),
+          initializer=tf.zeros_initializer(),
+          trainable=False)
+    saver = tf.train.Saver(var_list)
+    with tf.Session() as sess:
+      for (name, value) in variables.items():
+        var_list[name].load(value, sess)
+      return saver.save(sess, checkpoint, write_meta_graph=False)
@@ -0,0 +1,69 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import checkpoint_utils
+import numpy as np
+import tensorflow as tf
+
+
+class CheckpointUtilsTest(tf.test.TestCase):
+
+  def test_save_and_load_variables(self):
+    rng = np.random.RandomState(12345)
+    variables = collections.OrderedDict([
+        ("bert/embeddings/word_embeddings",
+         rng.normal(size=[7, 4]).astype(np.float32)),
+        ("bert/embeddings/word_embeddings/adam_m",
+         rng.normal(size=[7, 4]).astype(np.float32)),
+        ("global_step", np.array(42, dtype=np.int64)),
+    ])
+
+    checkpoint = checkpoint_utils.save_variables(
+        variables, os.path.join(self.get_temp_dir(), "model.ckpt"))
+    loaded = checkpoint_utils.load_variables(checkpoint)
+
+    self.assertEqual(sorted(loaded.keys()), sorted(variables.keys()))
+    for (name, value) in variables.items():
+      self.assertEqual(loaded[name].dtype, value.dtype)
+      self.assertAllEqual(loaded[name], value)
+
+    # The saved variables can be restored into a model graph by name.
+    with tf.Graph().as_default():
+      word_embeddings = tf.get_variable(
+          "bert/embeddings/word_embeddings", shape=[7, 4])
+      saver = tf.train.Saver([word_embeddings])
+      with self.test_session() as sess:
+        saver.restore(sess, checkpoint)
+        self.assertAllEqual(
+            sess.run(word_embeddings),
+            variables["bert/embeddings/word_embeddings"])
+
+  def test_get_slot_base_name(self):
+    self.assertEqual(
+        checkpoint_utils.get_slot_base_name("cls/predictions/output_bias"),
+        "cls/predictions/output_bias")
+    self.assertEqual(
+        checkpoint_utils.get_slot_base_name(
+            "cls/predictions/output_bias/adam_v"),
+        "cls/predictions/output_bias")
+
+
+if __name__ == "__main__":
+  tf.test.main()
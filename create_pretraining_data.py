@@ -314,19 +314,13 @@ def create_training_instances(input_files, tokenizer, max_seq_length, is_synthet
   #BERTAR modifications: maintaining labels for now too with the documents, to be used later on with training
 
   for input_file in input_files:
-    with tf.gfile.GFile(input_file, "r") as reader:
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-
+    for batch in tokenization.read_tokenized_batches(input_file, tokenizer):
+      for tokens in batch:
         # Empty lines are used as document delimiters
-        if not line:
+        if tokens is None:
           all_documents.append([])
           labels.append(is_synthetic)
-        tokens = tokenizer.tokenize(line)
-        if tokens:
+        elif tokens:
           all_documents[-1].append(tokens)
   
   for i, doc in enumerate(all_documents):
@@ -0,0 +1,111 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Extends the position embeddings of a BERT checkpoint to longer sequences.
+
+The rows of `bert/embeddings/position_embeddings` are repeated up to
+`--max_position_embeddings`, so that position `i` starts from the embedding of
+position `i % old_max_position_embeddings`, as in "Longformer: The
+Long-Document Transformer". The new rows get zero Adam slots. The model then
+has to be fine-tuned on the longer sequences, typically with
+`--attention_window_size` set so that the attention stays linear in the
+sequence length.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import checkpoint_utils
+import modeling
+import numpy as np
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "bert_config_file", None,
+    "The config json file corresponding to the checkpoint.")
+
+flags.DEFINE_string("init_checkpoint", None, "The checkpoint to extend.")
+
+flags.DEFINE_string(
+    "output_dir", None,
+    "The output directory where bert_config.json and bert_model.ckpt will be "
+    "written.")
+
+flags.DEFINE_integer("max_position_embeddings", None,
+                     "The number of position embeddings to extend to.")
+
+flags.DEFINE_integer(
+    "attention_window_size", None,
+    "If set, the `attention_window_size` written to the config (see "
+    "`BertConfig`).")
+
+POSITION_EMBEDDINGS = "bert/embeddings/position_embeddings"
+
+
+def extend_variables(variables, max_position_embeddings):
+  """Repeats the position embeddings in `variables`, returning a new dict."""
+  extended = type(variables)()
+  for (name, value) in variables.items():
+    if checkpoint_utils.get_slot_base_name(name) != POSITION_EMBEDDINGS:
+      extended[name] = value
+      continue
+    rows = np.arange(max_position_embeddings) % value.shape[0]
+    new_value = value[rows]
+    if name != POSITION_EMBEDDINGS:
+      # New rows start with fresh optimizer moments.
+      new_value[value.shape[0]:] = 0
+    extended[name] = new_value
+    tf.logging.info("  %s: %s -> %s", name, value.shape, new_value.shape)
+  return extended
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  if FLAGS.max_position_embeddings < bert_config.max_position_embeddings:
+    raise ValueError(
+        "Cannot shrink max_position_embeddings from %d to %d." %
+        (bert_config.max_position_embeddings, FLAGS.max_position_embeddings))
+
+  variables = checkpoint_utils.load_variables(FLAGS.init_checkpoint)
+  if POSITION_EMBEDDINGS not in variables:
+    raise ValueError("`%s` is not in the checkpoint." % POSITION_EMBEDDINGS)
+  variables = extend_variables(variables, FLAGS.max_position_embeddings)
+
+  bert_config.max_position_embeddings = FLAGS.max_position_embeddings
+  if FLAGS.attention_window_size is not None:
+    bert_config.attention_window_size = FLAGS.attention_window_size
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+  with tf.gfile.GFile(os.path.join(FLAGS.output_dir, "bert_config.json"),
+                      "w") as writer:
+    writer.write(bert_config.to_json_string())
+  checkpoint = checkpoint_utils.save_variables(
+      variables, os.path.join(FLAGS.output_dir, "bert_model.ckpt"))
+  tf.logging.info("Wrote %s", checkpoint)
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("bert_config_file")
+  flags.mark_flag_as_required("init_checkpoint")
+  flags.mark_flag_as_required("output_dir")
+  flags.mark_flag_as_required("max_position_embeddings")
+  tf.app.run()
@@ -23,6 +23,7 @@ import collections
 import json
 import re
 
+import bucketing
 import modeling
 import tokenization
 import tensorflow as tf
@@ -62,6 +63,18 @@ flags.DEFINE_bool(
 
 flags.DEFINE_integer("batch_size", 32, "Batch size for predictions.")
 
+flags.DEFINE_string(
+    "bucket_lengths", None,
+    "Comma-separated sequence lengths, e.g. 16,32,64. If set, examples are "
+    "grouped by length and each group is run at the shortest of these "
+    "lengths that fits it, instead of padding every example to "
+    "`max_seq_length`. The output order is unchanged.")
+
+flags.DEFINE_bool(
+    "remove_padding", False,
+    "Whether the encoder skips padding tokens in its dense layers. Padding "
+    "positions of the output are zero. CPU/GPU only.")
+
 flags.DEFINE_bool("use_tpu", False, "Whether to use TPU or GPU/CPU.")
 
 flags.DEFINE_string("master", None,
@@ -98,7 +111,11 @@ class InputFeatures(object):
 
 
 def input_fn_builder(features, seq_length):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  Features padded to a longer length are truncated to `seq_length`, which must
+  not be shorter than any of their real lengths.
+  """
 
   all_unique_ids = []
   all_input_ids = []
@@ -107,9 +124,9 @@ def input_fn_builder(features, seq_length):
 
   for feature in features:
     all_unique_ids.append(feature.unique_id)
-    all_input_ids.append(feature.input_ids)
-    all_input_mask.append(feature.input_mask)
-    all_input_type_ids.append(feature.input_type_ids)
+    all_input_ids.append(feature.input_ids[:seq_length])
+    all_input_mask.append(feature.input_mask[:seq_length])
+    all_input_type_ids.append(feature.input_type_ids[:seq_length])
 
   def input_fn(params):
     """The actual input function."""
@@ -146,7 +163,7 @@ def input_fn_builder(features, seq_length):
 
 
 def model_fn_builder(bert_config, init_checkpoint, layer_indexes, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, remove_padding=False):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -163,7 +180,9 @@ def model_fn_builder(bert_config, init_checkpoint, layer_indexes, use_tpu,
         input_ids=input_ids,
         input_mask=input_mask,
         token_type_ids=input_type_ids,
-        use_one_hot_embeddings=use_one_hot_embeddings)
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        remove_padding=remove_padding,
+        output_layers=layer_indexes)
 
     if mode != tf.estimator.ModeKeys.PREDICT:
       raise ValueError("Only PREDICT modes are supported: %s" % (mode))
@@ -197,8 +216,8 @@ def model_fn_builder(bert_config, init_checkpoint, layer_indexes, use_tpu,
         "unique_id": unique_ids,
     }
 
-    for (i, layer_index) in enumerate(layer_indexes):
-      predictions["layer_output_%d" % i] = all_layers[layer_index]
+    for i in range(len(layer_indexes)):
+      predictions["layer_output_%d" % i] = all_layers[i]
 
     output_spec = tf.contrib.tpu.TPUEstimatorSpec(
         mode=mode, predictions=predictions, scaffold_fn=scaffold_fn)
@@ -316,27 +335,50 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
       tokens_b.pop()
 
 
+def predict_by_length(estimator, features, bucket_lengths):
+  """Runs `estimator` on `features` with one predict call per length bucket.
+
+  Args:
+    estimator: TPUEstimator built with `model_fn_builder`.
+    features: List of `InputFeatures`.
+    bucket_lengths: Sorted list of sequence lengths to run at.
+
+  Yields:
+    The prediction dict of each feature, in the order of `features`.
+  """
+  lengths = [sum(feature.input_mask) for feature in features]
+  buckets = bucketing.bucket_by_length(lengths, bucket_lengths)
+
+  def indexed_results():
+    for (seq_length, indexes) in buckets.items():
+      tf.logging.info("Predicting %d examples at sequence length %d",
+                      len(indexes), seq_length)
+      input_fn = input_fn_builder(
+          features=[features[i] for i in indexes], seq_length=seq_length)
+      results = estimator.predict(input_fn, yield_single_examples=True)
+      for (index, result) in zip(indexes, results):
+        yield (index, result)
+
+  return bucketing.restore_order(indexed_results())
+
+
 def read_examples(input_file):
   """Read a list of `InputExample`s from an input file."""
   examples = []
   unique_id = 0
-  with tf.gfile.GFile(input_file, "r") as reader:
-    while True:
-      line = tokenization.convert_to_unicode(reader.readline())
-      if not line:
-        break
-      line = line.strip()
-      text_a = None
-      text_b = None
-      m = re.match(r"^(.*) \|\|\| (.*)$", line)
-      if m is None:
-        text_a = line
-      else:
-        text_a = m.group(1)
-        text_b = m.group(2)
-      examples.append(
-          InputExample(unique_id=unique_id, text_a=text_a, text_b=text_b))
-      unique_id += 1
+  for line in tokenization.read_lines(input_file):
+    line = line.strip()
+    text_a = None
+    text_b = None
+    m = re.match(r"^(.*) \|\|\| (.*)$", line)
+    if m is None:
+      text_a = line
+    else:
+      text_a = m.group(1)
+      text_b = m.group(2)
+    examples.append(
+        InputExample(unique_id=unique_id, text_a=text_a, text_b=text_b))
+    unique_id += 1
   return examples
 
 
@@ -347,6 +389,9 @@ def main(_):
 
   bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
 
+  if FLAGS.use_tpu and FLAGS.remove_padding:
+    raise ValueError("`remove_padding` is not supported on TPU.")
+
   tokenizer = tokenization.FullTokenizer(
       vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
 
@@ -371,7 +416,8 @@ def main(_):
       init_checkpoint=FLAGS.init_checkpoint,
       layer_indexes=layer_indexes,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_one_hot_embeddings)
+      use_one_hot_embeddings=FLAGS.use_one_hot_embeddings,
+      remove_padding=FLAGS.remove_padding)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -381,12 +427,14 @@ def main(_):
       config=run_config,
       predict_batch_size=FLAGS.batch_size)
 
-  input_fn = input_fn_builder(
-      features=features, seq_length=FLAGS.max_seq_length)
+  bucket_lengths = [FLAGS.max_seq_length]
+  if FLAGS.bucket_lengths:
+    bucket_lengths = bucketing.parse_bucket_lengths(FLAGS.bucket_lengths,
+                                                    FLAGS.max_seq_length)
 
   with codecs.getwriter("utf-8")(tf.gfile.Open(FLAGS.output_file,
                                                "w")) as writer:
-    for result in estimator.predict(input_fn, yield_single_examples=True):
+    for result in predict_by_length(estimator, features, bucket_lengths):
       unique_id = int(result["unique_id"])
       feature = unique_id_to_feature[unique_id]
       output_json = collections.OrderedDict()
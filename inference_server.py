@@ -0,0 +1,461 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Long-lived, in-process inference server for a BERTAR classifier.
+
+Scoring with `run_classifier_discrimination.py --do_predict` restores the
+checkpoint, builds the graph and writes a TFRecord file on every call. This
+server loads a SavedModel written by `run_classifier_discrimination.py
+--export_dir` once and keeps its session warm. Texts are tokenized by a pool
+of worker threads, which overlaps with the model since the session releases
+the GIL. Concurrent requests are coalesced into batches of up to
+`max_batch_size` texts, and a batch waits at most `max_batch_delay_ms` for
+more texts once its first text is ready. Each batch is padded only to its
+longest text.
+
+From Python:
+
+  with inference_server.InferenceServer.from_saved_model(export_dir) as server:
+    probabilities = server.predict(["some text", "another text"])
+    future = server.submit("a third text")  # A `concurrent.futures.Future`.
+    stats = server.stats.get_stats()
+
+As a script, it reads one JSON request per line from stdin, or from each
+connection to the Unix socket `--socket_path`, and writes one JSON response
+per line, in the same order:
+
+  {"text_a": "some text"}  ->  {"label": "human", "probabilities": [...]}
+  {"command": "stats"}     ->  {"num_requests": 10, "p50_ms": ..., ...}
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import codecs
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import timeit
+import numpy as np
+from six.moves import queue
+from six.moves import socketserver
+import run_classifier_discrimination
+import tokenization
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "saved_model_dir", None,
+    "The SavedModel written by `run_classifier_discrimination.py "
+    "--export_dir`.")
+
+flags.DEFINE_string(
+    "socket_path", None,
+    "If set, requests are served on this Unix socket instead of stdin.")
+
+flags.DEFINE_integer("max_batch_size", 32,
+                     "Maximum number of texts that are run together.")
+
+flags.DEFINE_float(
+    "max_batch_delay_ms", 5.0,
+    "Maximum time that a batch waits for more texts once its first text is "
+    "tokenized.")
+
+flags.DEFINE_integer("num_tokenize_workers", 4,
+                     "Number of threads that tokenize the texts.")
+
+_timer = timeit.default_timer
+
+
+def convert_text_to_ids(tokenizer, text_a, text_b, max_seq_length):
+  """Converts a text (pair) to unpadded `input_ids` and `segment_ids`.
+
+  The features are those of `run_classifier_discrimination`: a single text is
+  split into a pair as by `BERTARProcessor` (see
+  `run_classifier_discrimination.create_example`), and converted with
+  `run_classifier_discrimination.convert_single_example`.
+
+  Args:
+    tokenizer: `FullTokenizer`.
+    text_a: string. The first text.
+    text_b: (optional) string. The second text.
+    max_seq_length: int. Maximum number of tokens, including [CLS] and [SEP].
+
+  Returns:
+    A tuple of the list of `input_ids` and the list of `segment_ids`.
+  """
+  # The label does not change the features, so any label of the task will do.
+  label_list = run_classifier_discrimination.BERTARProcessor().get_labels()
+  if text_b:
+    example = run_classifier_discrimination.InputExample(
+        guid="request", text_a=text_a, text_b=text_b, label=label_list[0])
+  else:
+    example = run_classifier_discrimination.create_example(
+        "request", text_a, label_list[0], max_seq_length)
+  # `convert_single_example` logs the features of the first 5 examples only.
+  feature = run_classifier_discrimination.convert_single_example(
+      5, example, label_list, max_seq_length, tokenizer)
+  length = int(np.sum(feature.input_mask))
+  return (list(feature.input_ids[:length]), list(feature.segment_ids[:length]))
+
+
+class SavedModelPredictor(object):
+  """Runs the serving signature of an exported classifier in a session."""
+
+  def __init__(self, export_dir, session_config=None):
+    """Loads `export_dir` and runs a first batch, so that it is warm.
+
+    Args:
+      export_dir: The SavedModel directory.
+      session_config: (optional) `tf.ConfigProto` of the session.
+    """
+    self._session = tf.Session(graph=tf.Graph(), config=session_config)
+    meta_graph = tf.saved_model.loader.load(
+        self._session, [tf.saved_model.tag_constants.SERVING], export_dir)
+    signature = meta_graph.signature_def[
+        tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+    self._inputs = {
+        name: tensor_info.name
+        for (name, tensor_info) in signature.inputs.items()
+    }
+    self._output = signature.outputs["probabilities"].name
+
+    assets_dir = os.path.join(export_dir, "assets.extra")
+    with tf.gfile.GFile(os.path.join(assets_dir, "serving_config.json"),
+                        "r") as reader:
+      serving_config = json.loads(reader.read())
+    self.max_seq_length = serving_config["max_seq_length"]
+    self.labels = serving_config["labels"]
+    self.tokenizer = tokenization.FullTokenizer(
+        vocab_file=os.path.join(assets_dir, "vocab.txt"),
+        do_lower_case=serving_config["do_lower_case"])
+
+    # The first run optimizes the graph for this device.
+    self.predict({name: np.ones([1, 2], dtype=np.int32)
+                  for name in self._inputs})
+
+  def predict(self, features):
+    """Returns the probabilities of a batch of padded `features`."""
+    return self._session.run(
+        self._output,
+        feed_dict={
+            self._inputs[name]: value for (name, value) in features.items()
+        })
+
+  def close(self):
+    self._session.close()
+
+
+class LatencyStats(object):
+  """Thread-safe latency and throughput counters of an `InferenceServer`."""
+
+  def __init__(self, max_num_latencies=100000):
+    """Constructs LatencyStats.
+
+    Args:
+      max_num_latencies: int. The percentiles are computed over at most this
+        many of the latest requests.
+    """
+    self._lock = threading.Lock()
+    self._latencies = collections.deque(maxlen=max_num_latencies)
+    self._start_time = _timer()
+    self._num_requests = 0
+    self._num_batches = 0
+    self._model_seconds = 0.0
+
+  def add_batch(self, latencies, model_seconds):
+    """Records the latencies (in seconds) of the requests of a batch."""
+    with self._lock:
+      self._latencies.extend(latencies)
+      self._num_requests += len(latencies)
+      self._num_batches += 1
+      self._model_seconds += model_seconds
+
+  def get_stats(self):
+    """Returns an OrderedDict of the counters since the server started."""
+    with self._lock:
+      latencies = np.array(self._latencies, dtype=np.float64) * 1e3
+      num_requests = self._num_requests
+      num_batches = self._num_batches
+      model_seconds = self._model_seconds
+    uptime_seconds = _timer() - self._start_time
+    if not num_requests:
+      latencies = np.zeros([1])
+    return collections.OrderedDict([
+        ("num_requests", num_requests),
+        ("num_batches", num_batches),
+        ("average_batch_size", num_requests / max(num_batches, 1)),
+        ("p50_ms", float(np.percentile(latencies, 50))),
+        ("p99_ms", float(np.percentile(latencies, 99))),
+        ("requests_per_second", num_requests / uptime_seconds),
+        ("model_seconds", model_seconds),
+        ("uptime_seconds", uptime_seconds),
+    ])
+
+
+_Request = collections.namedtuple(
+    "_Request", ["input_ids", "segment_ids", "future", "start_time"])
+
+
+class InferenceServer(object):
+  """Coalesces concurrent requests into batches for a predictor."""
+
+  def __init__(self, predictor, tokenizer, max_seq_length, max_batch_size=32,
+               max_batch_delay_ms=5.0, num_tokenize_workers=4):
+    """Starts the tokenization workers and the batching thread.
+
+    Args:
+      predictor: Object with a `predict(features)` method that returns the
+        probabilities of a dict of int32 arrays of shape [batch_size,
+        seq_length] ("input_ids", "input_mask" and "segment_ids"), and a
+        `close()` method. See `SavedModelPredictor`.
+      tokenizer: `FullTokenizer`.
+      max_seq_length: int. Longer texts are truncated.
+      max_batch_size: int. Maximum number of texts that are run together.
+      max_batch_delay_ms: float. Maximum time that a batch waits for more
+        texts once its first text is tokenized.
+      num_tokenize_workers: int. Number of threads that tokenize the texts.
+    """
+    self._predictor = predictor
+    self._tokenizer = tokenizer
+    self._max_seq_length = max_seq_length
+    self._max_batch_size = max_batch_size
+    self._max_batch_delay = max_batch_delay_ms / 1e3
+    self._tokenize_pool = concurrent.futures.ThreadPoolExecutor(
+        num_tokenize_workers)
+    # Tokenized requests, then None when the server is closed.
+    self._queue = queue.Queue()
+    self.stats = LatencyStats()
+    self._batch_thread = threading.Thread(target=self._run_batches)
+    self._batch_thread.daemon = True
+    self._batch_thread.start()
+
+  @classmethod
+  def from_saved_model(cls, export_dir, session_config=None, **kwargs):
+    """Creates a server for the SavedModel in `export_dir`.
+
+    Args:
+      export_dir: The SavedModel directory.
+      session_config: (optional) `tf.ConfigProto` of the session.
+      **kwargs: The other arguments of the constructor.
+
+    Returns:
+      An `InferenceServer`, which has the `labels` of the classifier.
+    """
+    predictor = SavedModelPredictor(export_dir, session_config=session_config)
+    server = cls(predictor, predictor.tokenizer, predictor.max_seq_length,
+                 **kwargs)
+    server.labels = predictor.labels
+    return server
+
+  def submit(self, text_a, text_b=None):
+    """Returns a `concurrent.futures.Future` of the probabilities of a text."""
+    future = concurrent.futures.Future()
+    self._tokenize_pool.submit(self._tokenize, text_a, text_b, future,
+                               _timer())
+    return future
+
+  def predict(self, texts):
+    """Returns the probabilities of each of `texts`, as a float32 array."""
+    futures = [self.submit(text) for text in texts]
+    return np.array([future.result() for future in futures])
+
+  def close(self):
+    """Answers the pending requests, then stops the threads and predictor."""
+    self._tokenize_pool.shutdown(wait=True)
+    self._queue.put(None)
+    self._batch_thread.join()
+    self._predictor.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _tokenize(self, text_a, text_b, future, start_time):
+    """Tokenizes a text in a worker thread and queues it for batching."""
+    try:
+      (input_ids, segment_ids) = convert_text_to_ids(
+          self._tokenizer, text_a, text_b, self._max_seq_length)
+    except Exception as e:  # pylint: disable=broad-except
+      future.set_exception(e)
+      return
+    self._queue.put(_Request(input_ids, segment_ids, future, start_time))
+
+  def _run_batches(self):
+    """Runs the queued requests in batches until the server is closed."""
+    closed = False
+    while not closed:
+      request = self._queue.get()
+      if request is None:
+        break
+      batch = [request]
+      deadline = _timer() + self._max_batch_delay
+      while len(batch) < self._max_batch_size:
+        try:
+          request = self._queue.get(timeout=max(deadline - _timer(), 0))
+        except queue.Empty:
+          break
+        if request is None:
+          closed = True
+          break
+        batch.append(request)
+      self._run_batch(batch)
+
+  def _run_batch(self, batch):
+    """Pads `batch` to its longest text, predicts it and sets the results."""
+    seq_length = max(len(x.input_ids) for x in batch)
+    features = collections.OrderedDict(
+        (name, np.zeros([len(batch), seq_length], dtype=np.int32))
+        for name in ("input_ids", "input_mask", "segment_ids"))
+    for (i, request) in enumerate(batch):
+      length = len(request.input_ids)
+      features["input_ids"][i, :length] = request.input_ids
+      features["input_mask"][i, :length] = 1
+      features["segment_ids"][i, :length] = request.segment_ids
+
+    model_start_time = _timer()
+    try:
+      probabilities = self._predictor.predict(features)
+    except Exception as e:  # pylint: disable=broad-except
+      for request in batch:
+        request.future.set_exception(e)
+      return
+    end_time = _timer()
+
+    for (request, request_probabilities) in zip(batch, probabilities):
+      request.future.set_result(request_probabilities)
+    self.stats.add_batch([end_time - x.start_time for x in batch],
+                         end_time - model_start_time)
+
+
+def serve_lines(server, labels, reader, writer):
+  """Answers the JSON request on each line of `reader` on `writer`.
+
+  Each request is submitted as soon as it is read, so that the requests of
+  a stream are batched together, and the responses are written in order as
+  soon as they are ready.
+
+  Args:
+    server: `InferenceServer`.
+    labels: List of the label strings.
+    reader: Iterable of lines, e.g. a file.
+    writer: File to write the responses to.
+  """
+  # Responses, futures of the probabilities, or functions that return a
+  # response when it is written, in the order of the requests. The reader
+  # puts None at the end of `reader`.
+  pending = queue.Queue()
+  write_errors = []
+
+  def write_responses():
+    """Writes each pending response in order as soon as it is ready."""
+    try:
+      while True:
+        response = pending.get()
+        if response is None:
+          break
+        if isinstance(response, concurrent.futures.Future):
+          try:
+            probabilities = response.result()
+            response = collections.OrderedDict([
+                ("label", labels[int(np.argmax(probabilities))]),
+                ("probabilities", [float(x) for x in probabilities]),
+            ])
+          except Exception as e:  # pylint: disable=broad-except
+            response = {"error": str(e)}
+        elif callable(response):
+          response = response()
+        writer.write(json.dumps(response) + "\n")
+        writer.flush()
+    except Exception as e:  # pylint: disable=broad-except
+      write_errors.append(e)
+
+  writer_thread = threading.Thread(target=write_responses)
+  writer_thread.daemon = True
+  writer_thread.start()
+  try:
+    for line in reader:
+      if write_errors:
+        break
+      if not line.strip():
+        continue
+      try:
+        request = json.loads(line)
+        if request.get("command") == "stats":
+          # The stats include the requests before this one.
+          pending.put(server.stats.get_stats)
+        else:
+          pending.put(server.submit(request["text_a"], request.get("text_b")))
+      except Exception as e:  # pylint: disable=broad-except
+        pending.put({"error": "Invalid request: %s" % e})
+  finally:
+    pending.put(None)
+    writer_thread.join()
+  if write_errors:
+    raise write_errors[0]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+  """Serves the requests of one connection to the Unix socket."""
+
+  def handle(self):
+    serve_lines(self.server.inference_server, self.server.labels,
+                codecs.getreader("utf-8")(self.rfile),
+                codecs.getwriter("utf-8")(self.wfile))
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  server = InferenceServer.from_saved_model(
+      FLAGS.saved_model_dir,
+      max_batch_size=FLAGS.max_batch_size,
+      max_batch_delay_ms=FLAGS.max_batch_delay_ms,
+      num_tokenize_workers=FLAGS.num_tokenize_workers)
+  tf.logging.info("Loaded %s", FLAGS.saved_model_dir)
+  try:
+    if FLAGS.socket_path:
+      socket_server = socketserver.ThreadingUnixStreamServer(
+          FLAGS.socket_path, _RequestHandler)
+      socket_server.daemon_threads = True
+      socket_server.inference_server = server
+      socket_server.labels = server.labels
+      tf.logging.info("Serving on %s", FLAGS.socket_path)
+      try:
+        socket_server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+      finally:
+        socket_server.server_close()
+        os.remove(FLAGS.socket_path)
+    else:
+      serve_lines(server, server.labels, sys.stdin, sys.stdout)
+  finally:
+    server.close()
+    for (key, value) in server.stats.get_stats().items():
+      tf.logging.info("  %s = %s", key, str(value))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("saved_model_dir")
+  tf.app.run()
@@ -0,0 +1,198 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import select
+import tempfile
+import threading
+import time
+import inference_server
+import numpy as np
+import run_classifier_discrimination
+import six
+import tokenization
+import tensorflow as tf
+
+
+class FakePredictor(object):
+  """Predicts the number of real tokens / 100, once `released` is set."""
+
+  def __init__(self):
+    self.started = threading.Event()
+    self.released = threading.Event()
+    self.released.set()
+    self.batch_shapes = []
+    self.closed = False
+
+  def predict(self, features):
+    self.started.set()
+    self.released.wait()
+    self.batch_shapes.append(features["input_ids"].shape)
+    lengths = np.sum(features["input_mask"], axis=1) / 100.0
+    return np.stack([lengths, 1 - lengths], axis=1)
+
+  def close(self):
+    self.closed = True
+
+
+class InferenceServerTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(InferenceServerTest, self).setUp()
+    vocab_tokens = ["[UNK]", "[CLS]", "[SEP]", "the", "dog", "is", "hairy"]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write(
+          six.ensure_binary("".join([x + "\n" for x in vocab_tokens])))
+      vocab_file = vocab_writer.name
+    self.tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+  def test_convert_text_to_ids(self):
+    self.assertEqual(
+        inference_server.convert_text_to_ids(self.tokenizer, "the dog", None,
+                                             8), ([1, 3, 4, 2], [0, 0, 0, 0]))
+    self.assertEqual(
+        inference_server.convert_text_to_ids(self.tokenizer,
+                                             "the dog is hairy", None, 4),
+        ([1, 3, 4, 2], [0, 0, 0, 0]))
+    # The longer text is truncated first.
+    self.assertEqual(
+        inference_server.convert_text_to_ids(self.tokenizer,
+                                             "the dog is hairy", "dog", 7),
+        ([1, 3, 4, 5, 2, 4, 2], [0, 0, 0, 0, 0, 1, 1]))
+
+  def test_convert_long_text_to_ids(self):
+    # A text of more than `max_seq_length` words is split into a pair and
+    # truncated as for `run_classifier_discrimination.py --do_predict`.
+    text = "the dog is hairy. the dog is. is the dog hairy. the dog."
+    input_file = os.path.join(self.get_temp_dir(), "human.test.txt")
+    with tf.gfile.GFile(input_file, "w") as writer:
+      writer.write(text + "\n")
+    max_seq_length = tf.flags.FLAGS.max_seq_length
+    tf.flags.FLAGS.max_seq_length = 8
+    try:
+      processor = run_classifier_discrimination.BERTARProcessor()
+      (example,) = processor._create_examples(input_file, "test", "human")
+      feature = run_classifier_discrimination.convert_single_example(
+          0, example, processor.get_labels(), 8, self.tokenizer)
+    finally:
+      tf.flags.FLAGS.max_seq_length = max_seq_length
+    self.assertTrue(example.text_b)
+    self.assertEqual(feature.segment_ids[-1], 1)
+
+    (input_ids, segment_ids) = inference_server.convert_text_to_ids(
+        self.tokenizer, text, None, 8)
+    self.assertAllEqual(input_ids, feature.input_ids)
+    self.assertAllEqual(segment_ids, feature.segment_ids)
+
+  def test_batching(self):
+    predictor = FakePredictor()
+    server = inference_server.InferenceServer(
+        predictor, self.tokenizer, max_seq_length=8, max_batch_size=4,
+        max_batch_delay_ms=50, num_tokenize_workers=1)
+
+    # The first text runs alone and blocks the model while the others queue.
+    predictor.released.clear()
+    futures = [server.submit("the")]
+    predictor.started.wait()
+    texts = ["the dog", "dog", "the dog is", "is", "the dog is hairy", "x"]
+    futures.extend(server.submit(text) for text in texts)
+    while server._queue.qsize() < len(texts):
+      time.sleep(0.001)
+    predictor.released.set()
+
+    lengths = [3, 4, 3, 5, 3, 6, 3]
+    for (future, length) in zip(futures, lengths):
+      self.assertAllClose(future.result(), [length / 100.0,
+                                            1 - length / 100.0])
+    self.assertEqual(predictor.batch_shapes, [(1, 3), (4, 5), (2, 6)])
+
+    stats = server.stats.get_stats()
+    self.assertEqual(stats["num_requests"], 7)
+    self.assertEqual(stats["num_batches"], 3)
+    self.assertAllClose(stats["average_batch_size"], 7 / 3.0)
+    self.assertLessEqual(stats["p50_ms"], stats["p99_ms"])
+    self.assertGreater(stats["requests_per_second"], 0)
+
+    server.close()
+    self.assertTrue(predictor.closed)
+
+  def test_serve_lines(self):
+    predictor = FakePredictor()
+    with inference_server.InferenceServer(
+        predictor, self.tokenizer, max_seq_length=8) as server:
+      requests = [
+          {"text_a": "the dog"},
+          {"text_a": "the", "text_b": "dog is"},
+          {"text": "the"},
+          {"command": "stats"},
+      ]
+      writer = six.StringIO()
+      inference_server.serve_lines(
+          server, ["machine", "human"],
+          [json.dumps(x) + "\n" for x in requests] + ["\n", "{\n"], writer)
+    responses = [json.loads(x) for x in writer.getvalue().splitlines()]
+
+    self.assertEqual(len(responses), 5)
+    self.assertEqual(responses[0]["label"], "human")
+    self.assertAllClose(responses[0]["probabilities"], [0.04, 0.96])
+    self.assertAllClose(responses[1]["probabilities"], [0.06, 0.94])
+    self.assertIn("error", responses[2])
+    self.assertEqual(responses[3]["num_requests"], 2)
+    self.assertIn("error", responses[4])
+
+  def test_serve_lines_pipe(self):
+    # Each response is written while the next request has not arrived yet.
+    (request_fd, request_writer_fd) = os.pipe()
+    (response_reader_fd, response_fd) = os.pipe()
+    request_writer = os.fdopen(request_writer_fd, "w")
+    response_reader = os.fdopen(response_reader_fd, "r")
+
+    def read_response():
+      (readable, _, _) = select.select([response_reader], [], [], 10)
+      self.assertTrue(readable, "Timed out waiting for a response.")
+      return json.loads(response_reader.readline())
+
+    predictor = FakePredictor()
+    with inference_server.InferenceServer(
+        predictor, self.tokenizer, max_seq_length=8) as server:
+      with os.fdopen(request_fd, "r") as reader:
+        with os.fdopen(response_fd, "w") as writer:
+          thread = threading.Thread(
+              target=inference_server.serve_lines,
+              args=(server, ["machine", "human"], reader, writer))
+          thread.start()
+          try:
+            request_writer.write(json.dumps({"text_a": "the dog"}) + "\n")
+            request_writer.flush()
+            self.assertAllClose(read_response()["probabilities"],
+                                [0.04, 0.96])
+
+            request_writer.write(json.dumps({"command": "stats"}) + "\n")
+            request_writer.flush()
+            self.assertEqual(read_response()["num_requests"], 1)
+          finally:
+            request_writer.close()
+            thread.join()
+    self.assertEqual(response_reader.read(), "")
+    response_reader.close()
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,92 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Loss functions shared by the pre-training and classification heads."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+def sparse_softmax_loss(logits, label_ids):
+  """Computes the per-example softmax cross entropy for integer labels.
+
+  This is numerically the same as
+
+    -tf.reduce_sum(tf.one_hot(label_ids, depth) * tf.nn.log_softmax(logits), -1)
+
+  but the label log probability is picked out by index, so the dense
+  [batch_size, num_classes] one-hot labels (and their product with the log
+  probs) are never materialized. The fused op also computes its own gradient,
+  so during training the log-softmax is only computed if something else, like
+  an eval metric, uses it.
+
+  Args:
+    logits: float Tensor of shape [batch_size, num_classes].
+    label_ids: int32 or int64 Tensor of shape [batch_size].
+
+  Returns:
+    float Tensor of shape [batch_size] with the loss of each example.
+  """
+  return tf.nn.sparse_softmax_cross_entropy_with_logits(
+      labels=label_ids, logits=logits)
+
+
+
+def check_masked_lm_num_sampled(num_sampled, use_tpu):
+  """Raises a ValueError if `masked_lm_loss` cannot sample on this device."""
+  if use_tpu and num_sampled > 0:
+    raise ValueError("`masked_lm_num_sampled` is not supported on TPU, since "
+                     "candidate sampling ops cannot be compiled for TPU.")
+
+
+def masked_lm_loss(input_tensor, output_weights, output_bias, label_ids,
+                   num_sampled=0):
+  """Computes the per-prediction loss of the masked LM.
+
+  If `num_sampled` > 0, the loss is a sampled softmax: only the logits of the
+  labels and of `num_sampled` candidates are computed, instead of an
+  [N, vocab_size] matmul. Candidates are drawn from a log-uniform
+  distribution, which assumes that the vocabulary is sorted by decreasing
+  frequency (as vocab.txt is). This is for training on CPU/GPU only (see
+  `check_masked_lm_num_sampled`), and eval should use the full softmax.
+
+  Args:
+    input_tensor: float Tensor of shape [N, hidden_size].
+    output_weights: float Tensor of shape [vocab_size, hidden_size].
+    output_bias: float Tensor of shape [vocab_size].
+    label_ids: int32 Tensor of shape [N].
+    num_sampled: int. Number of candidates of the sampled softmax, or 0 for
+      the full softmax.
+
+  Returns:
+    A tuple of the float Tensor of shape [N] with the loss of each prediction,
+    and the [N, vocab_size] log probs, which are None if `num_sampled` > 0.
+  """
+  if num_sampled > 0:
+    per_example_loss = tf.nn.sampled_softmax_loss(
+        weights=output_weights,
+        biases=output_bias,
+        labels=tf.cast(tf.expand_dims(label_ids, axis=-1), tf.int64),
+        inputs=input_tensor,
+        num_sampled=num_sampled,
+        num_classes=output_bias.shape.as_list()[0])
+    return (per_example_loss, None)
+
+  logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
+  logits = tf.nn.bias_add(logits, output_bias)
+  log_probs = tf.nn.log_softmax(logits, axis=-1)
+  return (sparse_softmax_loss(logits, label_ids), log_probs)
@@ -0,0 +1,141 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import losses
+import numpy as np
+import tensorflow as tf
+
+
+class LossesTest(tf.test.TestCase):
+
+  def _one_hot_loss(self, logits, label_ids, depth):
+    """The loss that the heads computed before `losses` existed."""
+    log_probs = tf.nn.log_softmax(logits, axis=-1)
+    one_hot_labels = tf.one_hot(label_ids, depth=depth, dtype=tf.float32)
+    return -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
+
+  def _num_dense_tensors(self, graph, fetches, shape):
+    """Counts the tensors of `shape` needed to compute `fetches`."""
+    subgraph = tf.graph_util.extract_sub_graph(
+        graph.as_graph_def(), [x.op.name for x in fetches])
+    names = set(node.name for node in subgraph.node)
+    count = 0
+    for op in graph.get_operations():
+      if op.name not in names:
+        continue
+      for output in op.outputs:
+        if output.shape.is_fully_defined() and output.shape.as_list() == shape:
+          count += 1
+    return count
+
+  def test_sparse_softmax_loss_matches_one_hot(self):
+    batch_size = 40
+    vocab_size = 3000
+    rng = np.random.RandomState(12345)
+    logits_value = rng.normal(scale=3.0, size=[batch_size, vocab_size])
+    label_ids_value = rng.randint(0, vocab_size, size=[batch_size])
+
+    with self.test_session() as sess:
+      logits = tf.constant(logits_value, dtype=tf.float32)
+      label_ids = tf.constant(label_ids_value, dtype=tf.int32)
+      weights = tf.constant(rng.uniform(size=[batch_size]), dtype=tf.float32)
+
+      expected = self._one_hot_loss(logits, label_ids, vocab_size)
+      actual = losses.sparse_softmax_loss(logits, label_ids)
+      (expected_grad,) = tf.gradients(tf.reduce_sum(weights * expected),
+                                      [logits])
+      (actual_grad,) = tf.gradients(tf.reduce_sum(weights * actual), [logits])
+
+      (expected_value, actual_value, expected_grad_value,
+       actual_grad_value) = sess.run(
+           [expected, actual, expected_grad, actual_grad])
+
+    self.assertAllClose(expected_value, actual_value, rtol=1e-5, atol=1e-5)
+    self.assertAllClose(
+        expected_grad_value, actual_grad_value, rtol=1e-5, atol=1e-6)
+
+  def test_sparse_softmax_loss_uses_fewer_dense_tensors(self):
+    batch_size = 40
+    vocab_size = 3000
+    shape = [batch_size, vocab_size]
+
+    counts = []
+    for use_one_hot in [True, False]:
+      with tf.Graph().as_default() as graph:
+        logits = tf.placeholder(tf.float32, shape=shape)
+        label_ids = tf.placeholder(tf.int32, shape=[batch_size])
+        if use_one_hot:
+          per_example_loss = self._one_hot_loss(logits, label_ids, vocab_size)
+        else:
+          per_example_loss = losses.sparse_softmax_loss(logits, label_ids)
+        loss = tf.reduce_mean(per_example_loss)
+        (grad,) = tf.gradients(loss, [logits])
+        counts.append(self._num_dense_tensors(graph, [loss, grad], shape))
+
+    (one_hot_count, sparse_count) = counts
+    # The fused op only keeps the softmax for its gradient, while the one-hot
+    # version also builds the labels, the log probs and their product.
+    self.assertLess(sparse_count, one_hot_count)
+    self.assertLessEqual(sparse_count, 3)
+
+  def test_masked_lm_loss(self):
+    num_predictions = 40
+    hidden_size = 8
+    vocab_size = 3000
+    shape = [num_predictions, vocab_size]
+    rng = np.random.RandomState(12345)
+
+    with tf.Graph().as_default() as graph:
+      input_tensor = tf.constant(
+          rng.normal(size=[num_predictions, hidden_size]), dtype=tf.float32)
+      output_weights = tf.constant(
+          rng.normal(size=[vocab_size, hidden_size]), dtype=tf.float32)
+      output_bias = tf.constant(rng.normal(size=[vocab_size]), dtype=tf.float32)
+      label_ids = tf.constant(
+          rng.randint(0, vocab_size, size=[num_predictions]), dtype=tf.int32)
+
+      (full_loss, log_probs) = losses.masked_lm_loss(
+          input_tensor, output_weights, output_bias, label_ids)
+      (sampled_loss, sampled_log_probs) = losses.masked_lm_loss(
+          input_tensor, output_weights, output_bias, label_ids, num_sampled=64)
+      self.assertIsNone(sampled_log_probs)
+      self.assertEqual(self._num_dense_tensors(graph, [sampled_loss], shape),
+                       0)
+
+      logits = tf.nn.bias_add(
+          tf.matmul(input_tensor, output_weights, transpose_b=True),
+          output_bias)
+      expected = self._one_hot_loss(logits, label_ids, vocab_size)
+      with self.test_session(graph=graph) as sess:
+        (expected_value, full_value, log_probs_value,
+         sampled_value) = sess.run(
+             [expected, full_loss, log_probs, sampled_loss])
+
+    self.assertAllClose(expected_value, full_value, rtol=1e-5, atol=1e-5)
+    self.assertAllEqual(log_probs_value.shape, shape)
+    self.assertAllEqual(sampled_value.shape, [num_predictions])
+
+  def test_check_masked_lm_num_sampled(self):
+    losses.check_masked_lm_num_sampled(0, use_tpu=True)
+    losses.check_masked_lm_num_sampled(64, use_tpu=False)
+    with self.assertRaises(ValueError):
+      losses.check_masked_lm_num_sampled(64, use_tpu=True)
+
+
+if __name__ == "__main__":
+  tf.test.main()
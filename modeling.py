@@ -23,7 +23,6 @@ import copy
 import json
 import math
 import re
-import numpy as np
 import six
 import tensorflow as tf
 
@@ -42,7 +41,14 @@ class BertConfig(object):
                attention_probs_dropout_prob=0.1,
                max_position_embeddings=512,
                type_vocab_size=16,
-               initializer_range=0.02):
+               initializer_range=0.02,
+               use_fused_qkv=False,
+               compute_dtype="float32",
+               recompute_block_size=0,
+               use_fused_layer_norm=False,
+               attention_head_size=None,
+               attention_window_size=0,
+               num_global_tokens=1):
     """Constructs BertConfig.
 
     Args:
@@ -50,11 +56,13 @@ class BertConfig(object):
       hidden_size: Size of the encoder layers and the pooler layer.
       num_hidden_layers: Number of hidden layers in the Transformer encoder.
       num_attention_heads: Number of attention heads for each attention layer in
-        the Transformer encoder.
+        the Transformer encoder, or a list with the number of heads of each
+        layer (e.g. written by `prune_attention_heads.py`).
       intermediate_size: The size of the "intermediate" (i.e., feed-forward)
         layer in the Transformer encoder.
       hidden_act: The non-linear activation function (function or string) in the
-        encoder and pooler.
+        encoder and pooler. "gelu" is the tanh approximation of GELU that
+        BERT was trained with, and "gelu_exact" is the exact, erf-based GELU.
       hidden_dropout_prob: The dropout probability for all fully connected
         layers in the embeddings, encoder, and pooler.
       attention_probs_dropout_prob: The dropout ratio for the attention
@@ -66,6 +74,34 @@ class BertConfig(object):
         `BertModel`.
       initializer_range: The stdev of the truncated_normal_initializer for
         initializing all weight matrices.
+      use_fused_qkv: Whether self-attention computes the query, key and value
+        projections with a single matmul. This does not change the variables,
+        so checkpoints can be used with either setting.
+      compute_dtype: The dtype ("float32", "bfloat16" or "float16") of the
+        matmuls and activations of the encoder. Variables are always stored
+        in float32, and layer normalization and the attention softmax are
+        computed in float32. The model outputs are float32.
+      recompute_block_size: If positive, training recomputes the activations
+        of the encoder in blocks of this many layers during the backward pass
+        instead of keeping them in memory (see `recompute_transformer_model`).
+        This trades compute for memory, e.g. for larger batches. It does not
+        change the variables.
+      use_fused_layer_norm: Whether layer normalization computes the mean and
+        variance from a single pass over its input (see `layer_norm`)
+        instead of using `tf.contrib.layers.layer_norm`. This does not change
+        the variables.
+      attention_head_size: The size of each attention head. Defaults to
+        `hidden_size / num_attention_heads`, and is required if
+        `num_attention_heads` is a list.
+      attention_window_size: If positive, each token of the encoder only
+        attends to the tokens at most this many positions away and to the
+        first `num_global_tokens` tokens, which attend to all tokens. Memory
+        and compute are then linear in the sequence length, which must be a
+        multiple of this. See `sliding_window_attention`. This does not
+        change the variables.
+      num_global_tokens: Number of leading tokens (e.g. [CLS]) that attend to
+        and are attended to by all tokens when `attention_window_size` is
+        positive.
     """
     self.vocab_size = vocab_size
     self.hidden_size = hidden_size
@@ -78,6 +114,13 @@ class BertConfig(object):
     self.max_position_embeddings = max_position_embeddings
     self.type_vocab_size = type_vocab_size
     self.initializer_range = initializer_range
+    self.use_fused_qkv = use_fused_qkv
+    self.compute_dtype = compute_dtype
+    self.recompute_block_size = recompute_block_size
+    self.use_fused_layer_norm = use_fused_layer_norm
+    self.attention_head_size = attention_head_size
+    self.attention_window_size = attention_window_size
+    self.num_global_tokens = num_global_tokens
 
   @classmethod
   def from_dict(cls, json_object):
@@ -135,7 +178,11 @@ class BertModel(object):
                input_mask=None,
                token_type_ids=None,
                use_one_hot_embeddings=False,
-               scope=None):
+               scope=None,
+               remove_padding=False,
+               early_exit_fn=None,
+               output_layers=None,
+               fold_embeddings=False):
     """Constructor for BertModel.
 
     Args:
@@ -148,11 +195,33 @@ class BertModel(object):
       use_one_hot_embeddings: (optional) bool. Whether to use one-hot word
         embeddings or tf.embedding_lookup() for the word embeddings.
       scope: (optional) variable scope. Defaults to "bert".
+      remove_padding: (optional) bool. Whether the encoder drops the tokens
+        where `input_mask` is 0 before its dense layers. The outputs at those
+        positions are then zero. The shapes inside the encoder become
+        dynamic, so this is for CPU/GPU only.
+      early_exit_fn: (optional) function that lets examples stop before the
+        last layer. See `early_exit_transformer_model`. The layers then run
+        one at a time, so in training the config must not set
+        `recompute_block_size`.
+      output_layers: (optional) list of ints. Indexes of the encoder layers
+        that `get_all_encoder_layers()` returns, where negative indexes count
+        from the last layer. The other layers are not kept. Defaults to all
+        layers.
+      fold_embeddings: (optional) bool. Whether the position and token type
+        embeddings are added with a single gather from a table of their sums
+        that is computed once, when local variables are initialized (see
+        `create_folded_embedding_table`). Inference only.
 
     Raises:
       ValueError: The config is invalid or one of the input tensor shapes
         is invalid.
     """
+    if fold_embeddings and is_training:
+      raise ValueError("`fold_embeddings` is for inference only.")
+    if early_exit_fn is not None and is_training and (
+        config.recompute_block_size > 0):
+      raise ValueError(
+          "`recompute_block_size` is not supported with `early_exit_fn`.")
     config = copy.deepcopy(config)
     if not is_training:
       config.hidden_dropout_prob = 0.0
@@ -168,6 +237,15 @@ class BertModel(object):
     if token_type_ids is None:
       token_type_ids = tf.zeros(shape=[batch_size, seq_length], dtype=tf.int32)
 
+    if output_layers is None:
+      output_layers = range(config.num_hidden_layers)
+    output_layers = get_layer_indexes(output_layers, config.num_hidden_layers)
+    self.num_hidden_layers = config.num_hidden_layers
+
+    compute_dtype = tf.as_dtype(config.compute_dtype)
+    if compute_dtype not in (tf.float32, tf.bfloat16, tf.float16):
+      raise ValueError("Unsupported compute_dtype: %s" % config.compute_dtype)
+
     with tf.variable_scope(scope, default_name="bert"):
       with tf.variable_scope("embeddings"):
         # Perform embedding lookup on the word ids.
@@ -191,31 +269,75 @@ class BertModel(object):
             position_embedding_name="position_embeddings",
             initializer_range=config.initializer_range,
             max_position_embeddings=config.max_position_embeddings,
-            dropout_prob=config.hidden_dropout_prob)
-
-      with tf.variable_scope("encoder"):
-        # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
-        # mask of shape [batch_size, seq_length, seq_length] which is used
-        # for the attention scores.
-        attention_mask = create_attention_mask_from_input_mask(
-            input_ids, input_mask)
+            dropout_prob=config.hidden_dropout_prob,
+            use_fused_layer_norm=config.use_fused_layer_norm,
+            use_folded_embeddings=fold_embeddings)
+
+      with tf.variable_scope(
+          "encoder", custom_getter=get_custom_getter(compute_dtype)):
+        # This converts a 2D mask of shape [batch_size, seq_length] to an
+        # additive bias of shape [batch_size, 1, 1, seq_length], which is
+        # computed once and broadcast against the attention scores of every
+        # layer.
+        attention_bias = create_attention_bias_from_input_mask(input_mask)
 
         # Run the stacked transformer.
         # `sequence_output` shape = [batch_size, seq_length, hidden_size].
-        self.all_encoder_layers = transformer_model(
-            input_tensor=self.embedding_output,
-            attention_mask=attention_mask,
-            hidden_size=config.hidden_size,
-            num_hidden_layers=config.num_hidden_layers,
-            num_attention_heads=config.num_attention_heads,
-            intermediate_size=config.intermediate_size,
-            intermediate_act_fn=get_activation(config.hidden_act),
-            hidden_dropout_prob=config.hidden_dropout_prob,
-            attention_probs_dropout_prob=config.attention_probs_dropout_prob,
-            initializer_range=config.initializer_range,
-            do_return_all_layers=True)
+        if early_exit_fn is None:
+          # The last layer is always needed for `sequence_output`.
+          encoder_layers = transformer_model(
+              input_tensor=tf.cast(self.embedding_output, compute_dtype),
+              attention_bias=attention_bias,
+              hidden_size=config.hidden_size,
+              num_hidden_layers=config.num_hidden_layers,
+              num_attention_heads=config.num_attention_heads,
+              attention_head_size=config.attention_head_size,
+              attention_window_size=config.attention_window_size,
+              num_global_tokens=config.num_global_tokens,
+              intermediate_size=config.intermediate_size,
+              intermediate_act_fn=get_activation(config.hidden_act),
+              hidden_dropout_prob=config.hidden_dropout_prob,
+              attention_probs_dropout_prob=config.attention_probs_dropout_prob,
+              initializer_range=config.initializer_range,
+              do_return_all_layers=True,
+              use_fused_qkv=config.use_fused_qkv,
+              use_fused_layer_norm=config.use_fused_layer_norm,
+              input_mask=input_mask,
+              remove_padding=remove_padding,
+              output_layers=output_layers + [config.num_hidden_layers - 1],
+              recompute_block_size=(config.recompute_block_size
+                                    if is_training else 0))
+          self.all_encoder_layers = encoder_layers[:-1]
+          self.sequence_output = encoder_layers[-1]
+          self.num_layers = None
+        else:
+          (self.all_encoder_layers, self.sequence_output,
+           self.num_layers) = early_exit_transformer_model(
+               input_tensor=tf.cast(self.embedding_output, compute_dtype),
+               early_exit_fn=early_exit_fn,
+               attention_bias=attention_bias,
+               input_mask=input_mask,
+               hidden_size=config.hidden_size,
+               num_hidden_layers=config.num_hidden_layers,
+               num_attention_heads=config.num_attention_heads,
+               attention_head_size=config.attention_head_size,
+               attention_window_size=config.attention_window_size,
+               num_global_tokens=config.num_global_tokens,
+               intermediate_size=config.intermediate_size,
+               intermediate_act_fn=get_activation(config.hidden_act),
+               hidden_dropout_prob=config.hidden_dropout_prob,
+               attention_probs_dropout_prob=(
+                   config.attention_probs_dropout_prob),
+               initializer_range=config.initializer_range,
+               use_fused_qkv=config.use_fused_qkv,
+               use_fused_layer_norm=config.use_fused_layer_norm,
+               remove_padding=remove_padding,
+               output_layers=output_layers)
+        self.all_encoder_layers = [
+            tf.cast(x, tf.float32) for x in self.all_encoder_layers
+        ]
+        self.sequence_output = tf.cast(self.sequence_output, tf.float32)
 
-      self.sequence_output = self.all_encoder_layers[-1]
       # The "pooler" converts the encoded sequence tensor of shape
       # [batch_size, seq_length, hidden_size] to a tensor of shape
       # [batch_size, hidden_size]. This is necessary for segment-level
@@ -244,8 +366,26 @@ class BertModel(object):
     return self.sequence_output
 
   def get_all_encoder_layers(self):
+    """Gets the outputs of the encoder layers in `output_layers`.
+
+    Returns:
+      List of float Tensors of shape [batch_size, seq_length, hidden_size], one
+      for each index in `output_layers` (all layers by default).
+    """
     return self.all_encoder_layers
 
+  def get_num_layers(self):
+    """Gets the number of layers that each example ran through.
+
+    Returns:
+      int32 Tensor of shape [batch_size]. This is `num_hidden_layers` unless
+      examples exited early through `early_exit_fn`.
+    """
+    if self.num_layers is None:
+      batch_size = get_shape_list(self.sequence_output, expected_rank=3)[0]
+      return tf.fill([batch_size], self.num_hidden_layers)
+    return self.num_layers
+
   def get_embedding_output(self):
     """Gets output of the embedding lookup (i.e., input to the transformer).
 
@@ -273,7 +413,23 @@ def gelu(x):
     `x` with the GELU activation applied.
   """
   cdf = 0.5 * (1.0 + tf.tanh(
-      (np.sqrt(2 / np.pi) * (x + 0.044715 * tf.pow(x, 3)))))
+      (math.sqrt(2 / math.pi) * (x + 0.044715 * x * x * x))))
+  return x * cdf
+
+
+def gelu_exact(x):
+  """Gaussian Error Linear Unit, computed with the Gaussian CDF.
+
+  `gelu` approximates the CDF with tanh. This computes it exactly with a
+  single erf, which also takes fewer ops.
+
+  Args:
+    x: float Tensor to perform activation.
+
+  Returns:
+    `x` with the GELU activation applied.
+  """
+  cdf = 0.5 * (1.0 + tf.erf(x * (1.0 / math.sqrt(2.0))))
   return x * cdf
 
 
@@ -308,6 +464,8 @@ def get_activation(activation_string):
     return tf.nn.relu
   elif act == "gelu":
     return gelu
+  elif act == "gelu_exact":
+    return gelu_exact
   elif act == "tanh":
     return tf.tanh
   else:
@@ -341,13 +499,16 @@ def get_assignment_map_from_checkpoint(tvars, init_checkpoint):
   return (assignment_map, initialized_variable_names)
 
 
-def dropout(input_tensor, dropout_prob):
+def dropout(input_tensor, dropout_prob, seed=None):
   """Perform dropout.
 
   Args:
     input_tensor: float Tensor.
     dropout_prob: Python float. The probability of dropping out a value (NOT of
       *keeping* a dimension as in `tf.nn.dropout`).
+    seed: (optional) int64 Tensor of shape [2]. If set, the dropout mask is a
+      deterministic function of `seed`, so running the same ops again drops
+      the same values.
 
   Returns:
     A version of `input_tensor` with dropout applied.
@@ -355,19 +516,60 @@ def dropout(input_tensor, dropout_prob):
   if dropout_prob is None or dropout_prob == 0.0:
     return input_tensor
 
-  output = tf.nn.dropout(input_tensor, 1.0 - dropout_prob)
+  if seed is None:
+    output = tf.nn.dropout(input_tensor, 1.0 - dropout_prob)
+    return output
+
+  random_tensor = tf.contrib.stateless.stateless_random_uniform(
+      tf.shape(input_tensor), seed)
+  keep_mask = tf.cast(random_tensor >= dropout_prob, input_tensor.dtype)
+  output = input_tensor * keep_mask * (1.0 / (1.0 - dropout_prob))
   return output
 
 
-def layer_norm(input_tensor, name=None):
-  """Run layer normalization on the last dimension of the tensor."""
-  return tf.contrib.layers.layer_norm(
-      inputs=input_tensor, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
+def get_dropout_seed(seed, index):
+  """Derives the seed of one `dropout` call from `seed`, or returns None."""
+  if seed is None:
+    return None
+  return seed + tf.constant([0, index], dtype=tf.int64)
+
+
+def layer_norm(input_tensor, name=None, fused=False):
+  """Run layer normalization on the last dimension of the tensor.
 
+  The statistics are always computed in float32, and the output has the dtype
+  of `input_tensor`.
 
-def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
+  If `fused`, the mean and the mean of the squares are reduced from the same
+  input, rather than reducing the squared distances to the mean after the
+  mean, and the normalization and the affine transform are folded into one
+  scale and one offset. The variables are the same as those of
+  `tf.contrib.layers.layer_norm`.
+  """
+  inputs = tf.cast(input_tensor, tf.float32)
+  if not fused:
+    output_tensor = tf.contrib.layers.layer_norm(
+        inputs=inputs, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
+    return tf.cast(output_tensor, input_tensor.dtype)
+
+  params_shape = get_shape_list(inputs)[-1:]
+  with tf.variable_scope(name, default_name="LayerNorm"):
+    beta = tf.get_variable(
+        "beta", shape=params_shape, initializer=tf.zeros_initializer())
+    gamma = tf.get_variable(
+        "gamma", shape=params_shape, initializer=tf.ones_initializer())
+    mean = tf.reduce_mean(inputs, axis=-1, keepdims=True)
+    mean_square = tf.reduce_mean(tf.square(inputs), axis=-1, keepdims=True)
+    # The difference can be slightly negative from rounding.
+    variance = tf.maximum(mean_square - tf.square(mean), 0.0)
+    scale = gamma * tf.rsqrt(variance + 1e-12)
+    output_tensor = inputs * scale + (beta - mean * scale)
+  return tf.cast(output_tensor, input_tensor.dtype)
+
+
+def layer_norm_and_dropout(input_tensor, dropout_prob, name=None, fused=False):
   """Runs layer normalization followed by dropout."""
-  output_tensor = layer_norm(input_tensor, name)
+  output_tensor = layer_norm(input_tensor, name, fused=fused)
   output_tensor = dropout(output_tensor, dropout_prob)
   return output_tensor
 
@@ -377,6 +579,29 @@ def create_initializer(initializer_range=0.02):
   return tf.truncated_normal_initializer(stddev=initializer_range)
 
 
+def float32_variable_getter(getter, name, *args, **kwargs):
+  """Custom getter that stores reduced-precision variables in float32.
+
+  A variable requested as bfloat16 or float16 (e.g., by `tf.layers.dense` on a
+  bfloat16 input) is created in float32 and cast to the requested dtype, so
+  checkpoints and the optimizer keep working in float32.
+  """
+  requested_dtype = kwargs.get("dtype")
+  if requested_dtype in (tf.bfloat16, tf.float16):
+    kwargs["dtype"] = tf.float32
+  variable = getter(name, *args, **kwargs)
+  if requested_dtype in (tf.bfloat16, tf.float16):
+    variable = tf.cast(variable, requested_dtype)
+  return variable
+
+
+def get_custom_getter(compute_dtype):
+  """Returns the variable custom getter to use for `compute_dtype`, or None."""
+  if compute_dtype == tf.float32:
+    return None
+  return float32_variable_getter
+
+
 def embedding_lookup(input_ids,
                      vocab_size,
                      embedding_size=128,
@@ -434,7 +659,9 @@ def embedding_postprocessor(input_tensor,
                             position_embedding_name="position_embeddings",
                             initializer_range=0.02,
                             max_position_embeddings=512,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            use_fused_layer_norm=False,
+                            use_folded_embeddings=False):
   """Performs various post-processing on a word embedding tensor.
 
   Args:
@@ -455,6 +682,12 @@ def embedding_postprocessor(input_tensor,
       used with this model. This can be longer than the sequence length of
       input_tensor, but cannot be shorter.
     dropout_prob: float. Dropout probability applied to the final output tensor.
+    use_fused_layer_norm: bool. Whether to use the fused `layer_norm`.
+    use_folded_embeddings: bool. Whether to add the position and token type
+      embeddings with a single gather from the cached table of their sums
+      (see `create_folded_embedding_table`), instead of a one-hot matmul and
+      a slice. This requires `use_token_type` and `use_position_embeddings`,
+      and is for inference only.
 
   Returns:
     float tensor with same shape as `input_tensor`.
@@ -469,6 +702,11 @@ def embedding_postprocessor(input_tensor,
 
   output = input_tensor
 
+  if use_folded_embeddings and not (use_token_type and
+                                    use_position_embeddings):
+    raise ValueError("`use_folded_embeddings` requires `use_token_type` and "
+                     "`use_position_embeddings`.")
+
   if use_token_type:
     if token_type_ids is None:
       raise ValueError("`token_type_ids` must be specified if"
@@ -477,14 +715,16 @@ def embedding_postprocessor(input_tensor,
         name=token_type_embedding_name,
         shape=[token_type_vocab_size, width],
         initializer=create_initializer(initializer_range))
-    # This vocab will be small so we always do one-hot here, since it is always
-    # faster for a small vocabulary.
-    flat_token_type_ids = tf.reshape(token_type_ids, [-1])
-    one_hot_ids = tf.one_hot(flat_token_type_ids, depth=token_type_vocab_size)
-    token_type_embeddings = tf.matmul(one_hot_ids, token_type_table)
-    token_type_embeddings = tf.reshape(token_type_embeddings,
-                                       [batch_size, seq_length, width])
-    output += token_type_embeddings
+    if not use_folded_embeddings:
+      # This vocab will be small so we always do one-hot here, since it is
+      # always faster for a small vocabulary.
+      flat_token_type_ids = tf.reshape(token_type_ids, [-1])
+      one_hot_ids = tf.one_hot(flat_token_type_ids,
+                               depth=token_type_vocab_size)
+      token_type_embeddings = tf.matmul(one_hot_ids, token_type_table)
+      token_type_embeddings = tf.reshape(token_type_embeddings,
+                                         [batch_size, seq_length, width])
+      output += token_type_embeddings
 
   if use_position_embeddings:
     assert_op = tf.assert_less_equal(seq_length, max_position_embeddings)
@@ -493,34 +733,87 @@ def embedding_postprocessor(input_tensor,
           name=position_embedding_name,
           shape=[max_position_embeddings, width],
           initializer=create_initializer(initializer_range))
-      # Since the position embedding table is a learned variable, we create it
-      # using a (long) sequence length `max_position_embeddings`. The actual
-      # sequence length might be shorter than this, for faster training of
-      # tasks that do not have long sequences.
-      #
-      # So `full_position_embeddings` is effectively an embedding table
-      # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
-      # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
-      # perform a slice.
-      position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-                                     [seq_length, -1])
-      num_dims = len(output.shape.as_list())
-
-      # Only the last two dimensions are relevant (`seq_length` and `width`), so
-      # we broadcast among the first dimensions, which is typically just
-      # the batch size.
-      position_broadcast_shape = []
-      for _ in range(num_dims - 2):
-        position_broadcast_shape.append(1)
-      position_broadcast_shape.extend([seq_length, width])
-      position_embeddings = tf.reshape(position_embeddings,
-                                       position_broadcast_shape)
-      output += position_embeddings
-
-  output = layer_norm_and_dropout(output, dropout_prob)
+      if not use_folded_embeddings:
+        # Since the position embedding table is a learned variable, we create
+        # it using a (long) sequence length `max_position_embeddings`. The
+        # actual sequence length might be shorter than this, for faster
+        # training of tasks that do not have long sequences.
+        #
+        # So `full_position_embeddings` is effectively an embedding table
+        # for position [0, 1, 2, ..., max_position_embeddings-1], and the
+        # current sequence has positions [0, 1, 2, ... seq_length-1], so we
+        # can just perform a slice.
+        position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                       [seq_length, -1])
+        num_dims = len(output.shape.as_list())
+
+        # Only the last two dimensions are relevant (`seq_length` and
+        # `width`), so we broadcast among the first dimensions, which is
+        # typically just the batch size.
+        position_broadcast_shape = []
+        for _ in range(num_dims - 2):
+          position_broadcast_shape.append(1)
+        position_broadcast_shape.extend([seq_length, width])
+        position_embeddings = tf.reshape(position_embeddings,
+                                         position_broadcast_shape)
+        output += position_embeddings
+
+  if use_folded_embeddings:
+    # The table is created outside of the control dependencies above, so that
+    # its initializer does not depend on the inputs.
+    folded_table = create_folded_embedding_table(full_position_embeddings,
+                                                 token_type_table)
+    with tf.control_dependencies([assert_op]):
+      folded_ids = (
+          tf.expand_dims(tf.range(seq_length) * token_type_vocab_size, 0) +
+          token_type_ids)
+      output += tf.gather(folded_table, folded_ids)
+
+  output = layer_norm_and_dropout(
+      output, dropout_prob, fused=use_fused_layer_norm)
   return output
 
 
+def create_folded_embedding_table(position_table, token_type_table,
+                                  name="folded_embeddings"):
+  """Creates a cached table of the sums of position and token type embeddings.
+
+  Row `position * token_type_vocab_size + token_type_id` of the table is the
+  sum of the embeddings of `position` and of `token_type_id`, so it covers
+  every sequence length up to `max_position_embeddings`.
+
+  The table is a local variable, computed from the embeddings when local
+  variables are initialized, i.e. after the checkpoint is restored by
+  `tf.train.MonitoredSession`, `tf.estimator.Estimator` or a SavedModel
+  loader. It is neither trained nor updated when the embeddings change, so it
+  is for inference only.
+
+  Args:
+    position_table: float Tensor of shape [max_position_embeddings, width].
+    token_type_table: float Tensor of shape [token_type_vocab_size, width].
+    name: string. Name of the table variable.
+
+  Returns:
+    float Variable of shape
+    [max_position_embeddings * token_type_vocab_size, width].
+  """
+  (max_position_embeddings, width) = get_shape_list(
+      position_table, expected_rank=2)
+  token_type_vocab_size = get_shape_list(token_type_table, expected_rank=2)[0]
+  folded_table = tf.reshape(
+      tf.expand_dims(position_table, 1) + tf.expand_dims(token_type_table, 0),
+      [max_position_embeddings * token_type_vocab_size, width])
+  # A model that reuses the variables of another one also shares its table.
+  with tf.variable_scope(
+      tf.get_variable_scope(), reuse=tf.AUTO_REUSE,
+      auxiliary_name_scope=False):
+    return tf.get_variable(
+        name=name,
+        initializer=folded_table,
+        trainable=False,
+        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+
 def create_attention_mask_from_input_mask(from_tensor, to_mask):
   """Create 3D attention mask from a 2D tensor mask.
 
@@ -555,6 +848,29 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
   return mask
 
 
+def create_attention_bias_from_input_mask(to_mask):
+  """Creates the additive attention bias of a 2D tensor mask.
+
+  Unlike `create_attention_mask_from_input_mask`, this does not materialize a
+  mask for every query position: the bias broadcasts against the attention
+  scores, so it is computed once and shared by all the layers.
+
+  Args:
+    to_mask: int32 Tensor of shape [batch_size, to_seq_length].
+
+  Returns:
+    float32 Tensor of shape [batch_size, 1, 1, to_seq_length], which is 0.0
+    for positions that can be attended to and -10000.0 for the others.
+  """
+  to_shape = get_shape_list(to_mask, expected_rank=2)
+  batch_size = to_shape[0]
+  to_seq_length = to_shape[1]
+
+  to_mask = tf.cast(
+      tf.reshape(to_mask, [batch_size, 1, 1, to_seq_length]), tf.float32)
+  return (1.0 - to_mask) * -10000.0
+
+
 def attention_layer(from_tensor,
                     to_tensor,
                     attention_mask=None,
@@ -568,7 +884,13 @@ def attention_layer(from_tensor,
                     do_return_2d_tensor=False,
                     batch_size=None,
                     from_seq_length=None,
-                    to_seq_length=None):
+                    to_seq_length=None,
+                    use_fused_qkv=False,
+                    packed_indices=None,
+                    dropout_seed=None,
+                    attention_bias=None,
+                    attention_window_size=0,
+                    num_global_tokens=1):
   """Performs multi-headed attention from `from_tensor` to `to_tensor`.
 
   This is an implementation of multi-headed attention based on "Attention
@@ -615,6 +937,31 @@ def attention_layer(from_tensor,
       of the 3D version of the `from_tensor`.
     to_seq_length: (Optional) If the input is 2D, this might be the seq length
       of the 3D version of the `to_tensor`.
+    use_fused_qkv: bool. If True and `from_tensor` is `to_tensor`, the query,
+      key and value projections are computed with a single matmul against
+      their concatenated kernels. The variables are the same either way.
+    packed_indices: (optional) int32 Tensor of shape [num_tokens]. If set,
+      `from_tensor` and `to_tensor` are "packed": they only hold the rows at
+      these indices of the [batch_size * seq_length, width] matrix (see
+      `get_packed_indices`). The projections run on the packed rows and the
+      output is packed the same way. Requires rank 2 inputs, equal
+      `from_seq_length` and `to_seq_length` and `do_return_2d_tensor`.
+    dropout_seed: (optional) int64 Tensor of shape [2], the `seed` of the
+      dropout of the attention probabilities.
+    attention_bias: (optional) float32 Tensor that broadcasts against the
+      attention scores of shape [batch_size, num_attention_heads,
+      from_seq_length, to_seq_length], e.g. from
+      `create_attention_bias_from_input_mask`. It is added to the scores, in
+      addition to `attention_mask`.
+    attention_window_size: int. If positive, each position only attends to
+      the positions at most this many positions away from it and to the
+      global positions, with memory and compute linear in the sequence length
+      (see `sliding_window_attention`). This requires self-attention, and
+      `attention_bias` must then be of shape [batch_size, 1, 1,
+      to_seq_length] if set.
+    num_global_tokens: int. If `attention_window_size` is positive, the
+      number of leading positions (e.g. [CLS]) that attend to and are
+      attended to by every position.
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length,
@@ -652,6 +999,13 @@ def attention_layer(from_tensor,
           "for `batch_size`, `from_seq_length`, and `to_seq_length` "
           "must all be specified.")
 
+  if packed_indices is not None:
+    if (len(from_shape) != 2 or from_seq_length != to_seq_length or
+        not do_return_2d_tensor):
+      raise ValueError(
+          "`packed_indices` requires rank 2 tensors, equal `from_seq_length` "
+          "and `to_seq_length`, and `do_return_2d_tensor`.")
+
   # Scalar dimensions referenced here:
   #   B = batch size (number of sequences)
   #   F = `from_tensor` sequence length
@@ -662,29 +1016,75 @@ def attention_layer(from_tensor,
   from_tensor_2d = reshape_to_matrix(from_tensor)
   to_tensor_2d = reshape_to_matrix(to_tensor)
 
-  # `query_layer` = [B*F, N*H]
-  query_layer = tf.layers.dense(
-      from_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=query_act,
-      name="query",
-      kernel_initializer=create_initializer(initializer_range))
-
-  # `key_layer` = [B*T, N*H]
-  key_layer = tf.layers.dense(
-      to_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=key_act,
-      name="key",
-      kernel_initializer=create_initializer(initializer_range))
-
-  # `value_layer` = [B*T, N*H]
-  value_layer = tf.layers.dense(
-      to_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=value_act,
-      name="value",
-      kernel_initializer=create_initializer(initializer_range))
+  if use_fused_qkv and from_tensor is to_tensor:
+    # Create the same "query", "key" and "value" variables as `tf.layers.dense`
+    # would, so that checkpoints load with either setting, but multiply by
+    # their concatenation. The concat is folded away in frozen graphs.
+    input_width = get_shape_list(from_tensor_2d, expected_rank=2)[1]
+    kernels = []
+    biases = []
+    for name in ["query", "key", "value"]:
+      with tf.variable_scope(name):
+        kernels.append(
+            tf.get_variable(
+                "kernel",
+                shape=[input_width, num_attention_heads * size_per_head],
+                dtype=from_tensor.dtype,
+                initializer=create_initializer(initializer_range)))
+        biases.append(
+            tf.get_variable(
+                "bias",
+                shape=[num_attention_heads * size_per_head],
+                dtype=from_tensor.dtype,
+                initializer=tf.zeros_initializer()))
+
+    # `qkv_layer` = [B*F, 3*N*H]
+    qkv_layer = tf.matmul(from_tensor_2d, tf.concat(kernels, axis=1))
+    qkv_layer = tf.nn.bias_add(qkv_layer, tf.concat(biases, axis=0))
+
+    # `query_layer`, `key_layer`, `value_layer` = [B*F, N*H]
+    (query_layer, key_layer, value_layer) = tf.split(
+        qkv_layer, num_or_size_splits=3, axis=1)
+    if query_act is not None:
+      query_layer = query_act(query_layer)
+    if key_act is not None:
+      key_layer = key_act(key_layer)
+    if value_act is not None:
+      value_layer = value_act(value_layer)
+  else:
+    # `query_layer` = [B*F, N*H]
+    query_layer = tf.layers.dense(
+        from_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=query_act,
+        name="query",
+        kernel_initializer=create_initializer(initializer_range))
+
+    # `key_layer` = [B*T, N*H]
+    key_layer = tf.layers.dense(
+        to_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=key_act,
+        name="key",
+        kernel_initializer=create_initializer(initializer_range))
+
+    # `value_layer` = [B*T, N*H]
+    value_layer = tf.layers.dense(
+        to_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=value_act,
+        name="value",
+        kernel_initializer=create_initializer(initializer_range))
+
+  if packed_indices is not None:
+    # The scores need the per-sequence layout, so only the projections are
+    # put back in place, with zeros at the removed positions. The key and
+    # value rows there are masked out by `attention_mask` or
+    # `attention_bias`.
+    num_rows = batch_size * from_seq_length
+    query_layer = unpack_rows(query_layer, packed_indices, num_rows)
+    key_layer = unpack_rows(key_layer, packed_indices, num_rows)
+    value_layer = unpack_rows(value_layer, packed_indices, num_rows)
 
   # `query_layer` = [B, N, F, H]
   query_layer = transpose_for_scores(query_layer, batch_size,
@@ -695,44 +1095,75 @@ def attention_layer(from_tensor,
   key_layer = transpose_for_scores(key_layer, batch_size, num_attention_heads,
                                    to_seq_length, size_per_head)
 
-  # Take the dot product between "query" and "key" to get the raw
-  # attention scores.
-  # `attention_scores` = [B, N, F, T]
-  attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
-  attention_scores = tf.multiply(attention_scores,
-                                 1.0 / math.sqrt(float(size_per_head)))
-
-  if attention_mask is not None:
-    # `attention_mask` = [B, 1, F, T]
-    attention_mask = tf.expand_dims(attention_mask, axis=[1])
-
-    # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-    # masked positions, this operation will create a tensor which is 0.0 for
-    # positions we want to attend and -10000.0 for masked positions.
-    adder = (1.0 - tf.cast(attention_mask, tf.float32)) * -10000.0
-
-    # Since we are adding it to the raw scores before the softmax, this is
-    # effectively the same as removing these entirely.
-    attention_scores += adder
-
-  # Normalize the attention scores to probabilities.
-  # `attention_probs` = [B, N, F, T]
-  attention_probs = tf.nn.softmax(attention_scores)
-
-  # This is actually dropping out entire tokens to attend to, which might
-  # seem a bit unusual, but is taken from the original Transformer paper.
-  attention_probs = dropout(attention_probs, attention_probs_dropout_prob)
-
-  # `value_layer` = [B, T, N, H]
-  value_layer = tf.reshape(
-      value_layer,
-      [batch_size, to_seq_length, num_attention_heads, size_per_head])
-
-  # `value_layer` = [B, N, T, H]
-  value_layer = tf.transpose(value_layer, [0, 2, 1, 3])
-
-  # `context_layer` = [B, N, F, H]
-  context_layer = tf.matmul(attention_probs, value_layer)
+  if attention_window_size > 0:
+    if attention_mask is not None or from_seq_length != to_seq_length:
+      raise ValueError(
+          "`attention_window_size` requires self-attention, masked with "
+          "`attention_bias` instead of `attention_mask`.")
+
+    # `value_layer` = [B, N, T, H]
+    value_layer = transpose_for_scores(value_layer, batch_size,
+                                       num_attention_heads, to_seq_length,
+                                       size_per_head)
+
+    # `context_layer` = [B, N, F, H]
+    context_layer = sliding_window_attention(
+        query_layer,
+        key_layer,
+        value_layer,
+        attention_window_size=attention_window_size,
+        num_global_tokens=num_global_tokens,
+        attention_bias=attention_bias,
+        attention_probs_dropout_prob=attention_probs_dropout_prob,
+        dropout_seed=dropout_seed)
+  else:
+    # Take the dot product between "query" and "key" to get the raw
+    # attention scores.
+    # `attention_scores` = [B, N, F, T]
+    attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
+    attention_scores = tf.multiply(attention_scores,
+                                   1.0 / math.sqrt(float(size_per_head)))
+
+    # The mask and the softmax are always computed in float32: the scores of
+    # long sequences lose too much precision in bfloat16 or float16.
+    attention_scores = tf.cast(attention_scores, tf.float32)
+
+    if attention_mask is not None:
+      # `attention_mask` = [B, 1, F, T]
+      attention_mask = tf.expand_dims(attention_mask, axis=[1])
+
+      # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
+      # masked positions, this operation will create a tensor which is 0.0 for
+      # positions we want to attend and -10000.0 for masked positions.
+      adder = (1.0 - tf.cast(attention_mask, tf.float32)) * -10000.0
+
+      # Since we are adding it to the raw scores before the softmax, this is
+      # effectively the same as removing these entirely.
+      attention_scores += adder
+
+    if attention_bias is not None:
+      attention_scores += attention_bias
+
+    # Normalize the attention scores to probabilities.
+    # `attention_probs` = [B, N, F, T]
+    attention_probs = tf.nn.softmax(attention_scores)
+
+    # This is actually dropping out entire tokens to attend to, which might
+    # seem a bit unusual, but is taken from the original Transformer paper.
+    attention_probs = dropout(
+        attention_probs, attention_probs_dropout_prob, seed=dropout_seed)
+    attention_probs = tf.cast(attention_probs, value_layer.dtype)
+
+    # `value_layer` = [B, T, N, H]
+    value_layer = tf.reshape(
+        value_layer,
+        [batch_size, to_seq_length, num_attention_heads, size_per_head])
+
+    # `value_layer` = [B, N, T, H]
+    value_layer = tf.transpose(value_layer, [0, 2, 1, 3])
+
+    # `context_layer` = [B, N, F, H]
+    context_layer = tf.matmul(attention_probs, value_layer)
 
   # `context_layer` = [B, F, N, H]
   context_layer = tf.transpose(context_layer, [0, 2, 1, 3])
@@ -742,6 +1173,8 @@ def attention_layer(from_tensor,
     context_layer = tf.reshape(
         context_layer,
         [batch_size * from_seq_length, num_attention_heads * size_per_head])
+    if packed_indices is not None:
+      context_layer = tf.gather(context_layer, packed_indices)
   else:
     # `context_layer` = [B, F, N*H]
     context_layer = tf.reshape(
@@ -751,6 +1184,165 @@ def attention_layer(from_tensor,
   return context_layer
 
 
+def sliding_window_attention(query_layer,
+                             key_layer,
+                             value_layer,
+                             attention_window_size,
+                             num_global_tokens=1,
+                             attention_bias=None,
+                             attention_probs_dropout_prob=0.0,
+                             dropout_seed=None):
+  """Attention from each position to the positions around it.
+
+  Position `i` attends to the positions `j` with `|i - j| <=
+  attention_window_size` and to the first `num_global_tokens` positions. Those
+  global positions attend to every position. The scores are computed for
+  blocks of `attention_window_size` queries against the keys of their own
+  block and of the blocks on either side, so memory and compute grow linearly
+  with the sequence length instead of quadratically.
+
+  Args:
+    query_layer: float Tensor of shape [batch_size, num_attention_heads,
+      seq_length, size_per_head].
+    key_layer: float Tensor of the same shape as `query_layer`.
+    value_layer: float Tensor of the same shape as `query_layer`.
+    attention_window_size: int. Number of positions on either side that each
+      position attends to. `seq_length` must be a multiple of it.
+    num_global_tokens: int. Number of leading global positions.
+    attention_bias: (optional) float32 Tensor of shape [batch_size, 1, 1,
+      seq_length], added to the scores of each key.
+    attention_probs_dropout_prob: float. Dropout probability of the attention
+      probabilities.
+    dropout_seed: (optional) int64 Tensor of shape [2]. See `dropout`.
+
+  Returns:
+    float Tensor of shape [batch_size, num_attention_heads, seq_length,
+    size_per_head].
+
+  Raises:
+    ValueError: If `seq_length` is not a multiple of `attention_window_size`.
+  """
+  (batch_size, num_attention_heads, seq_length,
+   size_per_head) = get_shape_list(query_layer, expected_rank=4)
+  window = attention_window_size
+  if seq_length % window != 0:
+    raise ValueError(
+        "The sequence length (%d) is not a multiple of the attention window "
+        "size (%d)" % (seq_length, window))
+  num_blocks = seq_length // window
+  num_global_tokens = min(num_global_tokens, seq_length)
+
+  # Scalar dimensions referenced here:
+  #   B = batch size (number of sequences)
+  #   N = `num_attention_heads`
+  #   K = `num_blocks`
+  #   W = `attention_window_size`
+  #   G = `num_global_tokens`
+  #   L = `seq_length`
+  #   H = `size_per_head`
+
+  query_layer *= 1.0 / math.sqrt(float(size_per_head))
+
+  if attention_bias is None:
+    key_bias = tf.zeros([batch_size, seq_length])
+  else:
+    key_bias = tf.reshape(attention_bias, [batch_size, seq_length])
+
+  def get_windows(tensor, padding_value):
+    """Returns the [B, N, K, 3*W, ...] rows around each block of `tensor`."""
+    shape = get_shape_list(tensor)
+    blocks = tf.reshape(tensor, shape[:2] + [num_blocks, window] + shape[3:])
+    paddings = [[0, 0]] * len(shape)
+    paddings.insert(2, [1, 1])
+    blocks = tf.pad(blocks, paddings, constant_values=padding_value)
+    return tf.concat(
+        [blocks[:, :, :-2], blocks[:, :, 1:-1], blocks[:, :, 2:]], axis=3)
+
+  # The global positions are attended to through their own scores below, so
+  # they are masked out of the local keys.
+  is_global = tf.cast(tf.range(seq_length) < num_global_tokens, tf.float32)
+  local_key_bias = key_bias - 10000.0 * is_global
+  # `local_key_bias` = [B, 1, K, 1, 3*W]
+  local_key_bias = tf.reshape(
+      get_windows(local_key_bias[:, tf.newaxis], -10000.0),
+      [batch_size, 1, num_blocks, 1, 3 * window])
+
+  # Key `k` of the window of the block of query `q` is `k - W - q` positions
+  # away from it.
+  window_bias = tf.constant(
+      [[0.0 if abs(k - window - q) <= window else -10000.0
+        for k in range(3 * window)]
+       for q in range(window)],
+      dtype=tf.float32)
+
+  # `query_blocks` = [B, N, K, W, H]
+  query_blocks = tf.reshape(
+      query_layer,
+      [batch_size, num_attention_heads, num_blocks, window, size_per_head])
+
+  # `local_scores` = [B, N, K, W, 3*W]
+  local_scores = tf.matmul(
+      query_blocks, get_windows(key_layer, 0.0), transpose_b=True)
+  local_scores = tf.cast(local_scores, tf.float32)
+  local_scores += window_bias + local_key_bias
+  attention_scores = local_scores
+
+  if num_global_tokens > 0:
+    global_keys = key_layer[:, :, :num_global_tokens]
+    global_values = value_layer[:, :, :num_global_tokens]
+
+    # `global_key_scores` = [B, N, K, W, G]
+    global_key_scores = tf.matmul(query_layer, global_keys, transpose_b=True)
+    global_key_scores = tf.reshape(
+        tf.cast(global_key_scores, tf.float32),
+        [batch_size, num_attention_heads, num_blocks, window,
+         num_global_tokens])
+    global_key_scores += tf.reshape(key_bias[:, :num_global_tokens],
+                                    [batch_size, 1, 1, 1, num_global_tokens])
+    attention_scores = tf.concat([local_scores, global_key_scores], axis=-1)
+
+  attention_probs = tf.nn.softmax(attention_scores)
+  attention_probs = dropout(
+      attention_probs, attention_probs_dropout_prob, seed=dropout_seed)
+  attention_probs = tf.cast(attention_probs, value_layer.dtype)
+
+  # `context_layer` = [B, N, L, H]
+  context_layer = tf.matmul(attention_probs[..., :3 * window],
+                            get_windows(value_layer, 0.0))
+  context_layer = tf.reshape(
+      context_layer,
+      [batch_size, num_attention_heads, seq_length, size_per_head])
+  if num_global_tokens == 0:
+    return context_layer
+
+  global_key_probs = tf.reshape(
+      attention_probs[..., 3 * window:],
+      [batch_size, num_attention_heads, seq_length, num_global_tokens])
+  context_layer += tf.matmul(global_key_probs, global_values)
+
+  # The global positions attend to every position.
+  # `global_scores` = [B, N, G, L]
+  global_scores = tf.matmul(
+      query_layer[:, :, :num_global_tokens], key_layer, transpose_b=True)
+  global_scores = tf.cast(global_scores, tf.float32)
+  global_scores += key_bias[:, tf.newaxis, tf.newaxis, :]
+  global_probs = tf.nn.softmax(global_scores)
+  # These probabilities get their own dropout mask.
+  global_dropout_seed = None
+  if dropout_seed is not None:
+    global_dropout_seed = dropout_seed + tf.constant([1, 0], dtype=tf.int64)
+  global_probs = dropout(
+      global_probs, attention_probs_dropout_prob, seed=global_dropout_seed)
+  global_probs = tf.cast(global_probs, value_layer.dtype)
+
+  return tf.concat(
+      [
+          tf.matmul(global_probs, value_layer),
+          context_layer[:, :, num_global_tokens:]
+      ],
+      axis=2)
+
+
 def transformer_model(input_tensor,
                       attention_mask=None,
                       hidden_size=768,
@@ -761,7 +1353,19 @@ def transformer_model(input_tensor,
                       hidden_dropout_prob=0.1,
                       attention_probs_dropout_prob=0.1,
                       initializer_range=0.02,
-                      do_return_all_layers=False):
+                      do_return_all_layers=False,
+                      use_fused_qkv=False,
+                      use_fused_layer_norm=False,
+                      input_mask=None,
+                      remove_padding=False,
+                      first_layer_index=0,
+                      output_layers=None,
+                      recompute_block_size=0,
+                      dropout_seed=None,
+                      attention_bias=None,
+                      attention_head_size=None,
+                      attention_window_size=0,
+                      num_global_tokens=1):
   """Multi-headed, multi-layer Transformer from "Attention is All You Need".
 
   This is almost an exact implementation of the original Transformer encoder.
@@ -779,7 +1383,8 @@ def transformer_model(input_tensor,
       positions that should not be.
     hidden_size: int. Hidden size of the Transformer.
     num_hidden_layers: int. Number of layers (blocks) in the Transformer.
-    num_attention_heads: int. Number of attention heads in the Transformer.
+    num_attention_heads: int. Number of attention heads in the Transformer, or
+      a list with the number of attention heads of each layer.
     intermediate_size: int. The size of the "intermediate" (a.k.a., feed
       forward) layer.
     intermediate_act_fn: function. The non-linear activation function to apply
@@ -791,20 +1396,54 @@ def transformer_model(input_tensor,
       normal).
     do_return_all_layers: Whether to also return all layers or just the final
       layer.
+    use_fused_qkv: bool. Whether to compute the query, key and value
+      projections of each layer with a single matmul.
+    use_fused_layer_norm: bool. Whether to use the fused `layer_norm`.
+    input_mask: (optional) int32 Tensor of shape [batch_size, seq_length],
+      with 1 for real tokens and 0 for padding. Only used if `remove_padding`.
+    remove_padding: bool. If True, the padding tokens are removed before the
+      first layer so that the dense layers only run on real tokens, and the
+      outputs at padding positions are zero.
+    first_layer_index: int. Index of the first layer, which names its variable
+      scope ("layer_%d"). This allows building the layers of one encoder with
+      several calls.
+    output_layers: (optional) list of ints. If `do_return_all_layers`, the
+      indexes of the layers to return, where negative indexes count from the
+      last layer. Defaults to all layers.
+    recompute_block_size: int. If positive, the layers are run in blocks of
+      this many layers whose activations are not kept for the backward pass.
+      Only the input of each block is kept, and the block is run again to
+      compute its gradients. This saves memory at the cost of running the
+      forward pass of the encoder twice in training.
+    dropout_seed: (optional) int64 Tensor of shape [2]. If set, the dropout
+      masks of each layer are derived from it (see `dropout`). This is
+      required to recompute the layers, so it defaults to a random seed if
+      `recompute_block_size` is positive.
+    attention_bias: (optional) float32 Tensor of shape [batch_size, 1, 1,
+      seq_length] (or that otherwise broadcasts against the attention
+      scores), added to the attention scores of every layer. See
+      `create_attention_bias_from_input_mask`. This is cheaper than an
+      `attention_mask` when every position attends to the same positions.
+    attention_head_size: (optional) int. Size of each attention head. Defaults
+      to `hidden_size / num_attention_heads`, and is required if
+      `num_attention_heads` is a list.
+    attention_window_size: int. If positive, each position only attends to the
+      positions at most this many positions away and to the global positions
+      (see `sliding_window_attention`). This requires `attention_bias` instead
+      of `attention_mask`.
+    num_global_tokens: int. Number of leading positions that attend to and are
+      attended to by every position, if `attention_window_size` is positive.
 
   Returns:
     float Tensor of shape [batch_size, seq_length, hidden_size], the final
-    hidden layer of the Transformer.
+    hidden layer of the Transformer, or a list of such Tensors, one for each
+    of `output_layers`, if `do_return_all_layers`.
 
   Raises:
     ValueError: A Tensor shape or parameter is invalid.
   """
-  if hidden_size % num_attention_heads != 0:
-    raise ValueError(
-        "The hidden size (%d) is not a multiple of the number of attention "
-        "heads (%d)" % (hidden_size, num_attention_heads))
-
-  attention_head_size = int(hidden_size / num_attention_heads)
+  (layer_num_attention_heads, attention_head_size) = get_attention_heads(
+      hidden_size, num_attention_heads, num_hidden_layers, attention_head_size)
   input_shape = get_shape_list(input_tensor, expected_rank=3)
   batch_size = input_shape[0]
   seq_length = input_shape[1]
@@ -816,14 +1455,60 @@ def transformer_model(input_tensor,
     raise ValueError("The width of the input tensor (%d) != hidden size (%d)" %
                      (input_width, hidden_size))
 
+  if recompute_block_size > 0:
+    return recompute_transformer_model(
+        input_tensor=input_tensor,
+        recompute_block_size=recompute_block_size,
+        attention_mask=attention_mask,
+        hidden_size=hidden_size,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=layer_num_attention_heads,
+        intermediate_size=intermediate_size,
+        intermediate_act_fn=intermediate_act_fn,
+        hidden_dropout_prob=hidden_dropout_prob,
+        attention_probs_dropout_prob=attention_probs_dropout_prob,
+        initializer_range=initializer_range,
+        do_return_all_layers=do_return_all_layers,
+        use_fused_qkv=use_fused_qkv,
+        use_fused_layer_norm=use_fused_layer_norm,
+        input_mask=input_mask,
+        remove_padding=remove_padding,
+        first_layer_index=first_layer_index,
+        output_layers=output_layers,
+        dropout_seed=dropout_seed,
+        attention_bias=attention_bias,
+        attention_head_size=attention_head_size,
+        attention_window_size=attention_window_size,
+        num_global_tokens=num_global_tokens)
+
   # We keep the representation as a 2D tensor to avoid re-shaping it back and
   # forth from a 3D tensor to a 2D tensor. Re-shapes are normally free on
   # the GPU/CPU but may not be free on the TPU, so we want to minimize them to
   # help the optimizer.
   prev_output = reshape_to_matrix(input_tensor)
 
-  all_layer_outputs = []
-  for layer_idx in range(num_hidden_layers):
+  packed_indices = None
+  if remove_padding:
+    if input_mask is None:
+      raise ValueError("`input_mask` is required to remove padding.")
+    # From here on the layers work on a [num_tokens, hidden_size] matrix of
+    # only the real tokens. `attention_layer` scatters them back into place
+    # for the attention scores.
+    packed_indices = get_packed_indices(input_mask)
+    prev_output = tf.gather(prev_output, packed_indices)
+
+  kept_layers = set()
+  if do_return_all_layers:
+    if output_layers is None:
+      output_layers = range(num_hidden_layers)
+    output_layers = get_layer_indexes(output_layers, num_hidden_layers)
+    kept_layers = set(output_layers)
+
+  # Only the outputs of the requested layers are kept, by their index in this
+  # call.
+  layer_outputs = {}
+  for layer_idx in range(first_layer_index,
+                         first_layer_index + num_hidden_layers):
     with tf.variable_scope("layer_%d" % layer_idx):
       layer_input = prev_output
 
@@ -834,14 +1519,21 @@ def transformer_model(input_tensor,
               from_tensor=layer_input,
               to_tensor=layer_input,
               attention_mask=attention_mask,
-              num_attention_heads=num_attention_heads,
+              num_attention_heads=layer_num_attention_heads[
+                  layer_idx - first_layer_index],
               size_per_head=attention_head_size,
               attention_probs_dropout_prob=attention_probs_dropout_prob,
               initializer_range=initializer_range,
               do_return_2d_tensor=True,
               batch_size=batch_size,
               from_seq_length=seq_length,
-              to_seq_length=seq_length)
+              to_seq_length=seq_length,
+              use_fused_qkv=use_fused_qkv,
+              packed_indices=packed_indices,
+              dropout_seed=get_dropout_seed(dropout_seed, 3 * layer_idx),
+              attention_bias=attention_bias,
+              attention_window_size=attention_window_size,
+              num_global_tokens=num_global_tokens)
           attention_heads.append(attention_head)
 
         attention_output = None
@@ -859,8 +1551,12 @@ def transformer_model(input_tensor,
               attention_output,
               hidden_size,
               kernel_initializer=create_initializer(initializer_range))
-          attention_output = dropout(attention_output, hidden_dropout_prob)
-          attention_output = layer_norm(attention_output + layer_input)
+          attention_output = dropout(
+              attention_output,
+              hidden_dropout_prob,
+              seed=get_dropout_seed(dropout_seed, 3 * layer_idx + 1))
+          attention_output = layer_norm(
+              attention_output + layer_input, fused=use_fused_layer_norm)
 
       # The activation is only applied to the "intermediate" hidden layer.
       with tf.variable_scope("intermediate"):
@@ -876,22 +1572,399 @@ def transformer_model(input_tensor,
             intermediate_output,
             hidden_size,
             kernel_initializer=create_initializer(initializer_range))
-        layer_output = dropout(layer_output, hidden_dropout_prob)
-        layer_output = layer_norm(layer_output + attention_output)
+        layer_output = dropout(
+            layer_output,
+            hidden_dropout_prob,
+            seed=get_dropout_seed(dropout_seed, 3 * layer_idx + 2))
+        layer_output = layer_norm(
+            layer_output + attention_output, fused=use_fused_layer_norm)
         prev_output = layer_output
-        all_layer_outputs.append(layer_output)
+        if layer_idx - first_layer_index in kept_layers:
+          layer_outputs[layer_idx - first_layer_index] = layer_output
 
   if do_return_all_layers:
-    final_outputs = []
-    for layer_output in all_layer_outputs:
-      final_output = reshape_from_matrix(layer_output, input_shape)
-      final_outputs.append(final_output)
-    return final_outputs
+    for (i, layer_output) in layer_outputs.items():
+      if packed_indices is not None:
+        layer_output = unpack_rows(layer_output, packed_indices,
+                                   batch_size * seq_length)
+      layer_outputs[i] = reshape_from_matrix(layer_output, input_shape)
+    return [layer_outputs[i] for i in output_layers]
   else:
+    if packed_indices is not None:
+      prev_output = unpack_rows(prev_output, packed_indices,
+                                batch_size * seq_length)
     final_output = reshape_from_matrix(prev_output, input_shape)
     return final_output
 
 
+def recompute_transformer_model(input_tensor,
+                                recompute_block_size,
+                                attention_mask=None,
+                                hidden_size=768,
+                                num_hidden_layers=12,
+                                num_attention_heads=12,
+                                intermediate_size=3072,
+                                intermediate_act_fn=gelu,
+                                hidden_dropout_prob=0.1,
+                                attention_probs_dropout_prob=0.1,
+                                initializer_range=0.02,
+                                do_return_all_layers=False,
+                                use_fused_qkv=False,
+                                use_fused_layer_norm=False,
+                                input_mask=None,
+                                remove_padding=False,
+                                first_layer_index=0,
+                                output_layers=None,
+                                dropout_seed=None,
+                                attention_bias=None,
+                                attention_head_size=None,
+                                attention_window_size=0,
+                                num_global_tokens=1):
+  """Runs `transformer_model` in blocks that are recomputed for the gradients.
+
+  Each block of `recompute_block_size` layers is wrapped in
+  `tf.contrib.layers.recompute_grad`, so the backward pass only keeps the
+  input of each block (and the requested `output_layers`) and runs the block
+  again to compute its gradients. Dropout uses stateless random ops seeded by
+  `dropout_seed`, so the recomputed block drops the same values. The
+  variables of the blocks are resource variables, which
+  `tf.contrib.layers.recompute_grad` requires; they have the same names, so
+  checkpoints can be used with or without recomputation.
+
+  Args:
+    input_tensor: float Tensor of shape [batch_size, seq_length, hidden_size].
+    recompute_block_size: int. Number of layers in each recomputed block.
+    attention_mask: See `transformer_model`.
+    hidden_size: See `transformer_model`.
+    num_hidden_layers: See `transformer_model`.
+    num_attention_heads: See `transformer_model`.
+    intermediate_size: See `transformer_model`.
+    intermediate_act_fn: See `transformer_model`.
+    hidden_dropout_prob: See `transformer_model`.
+    attention_probs_dropout_prob: See `transformer_model`.
+    initializer_range: See `transformer_model`.
+    do_return_all_layers: See `transformer_model`.
+    use_fused_qkv: See `transformer_model`.
+    use_fused_layer_norm: See `transformer_model`.
+    input_mask: See `transformer_model`.
+    remove_padding: See `transformer_model`.
+    first_layer_index: See `transformer_model`.
+    output_layers: See `transformer_model`.
+    dropout_seed: (optional) int64 Tensor of shape [2]. Defaults to a random
+      seed.
+    attention_bias: See `transformer_model`.
+    attention_head_size: See `transformer_model`.
+    attention_window_size: See `transformer_model`.
+    num_global_tokens: See `transformer_model`.
+
+  Returns:
+    The same as `transformer_model`.
+  """
+  (layer_num_attention_heads, attention_head_size) = get_attention_heads(
+      hidden_size, num_attention_heads, num_hidden_layers, attention_head_size)
+  if dropout_seed is None:
+    dropout_seed = tf.random_uniform(
+        [2], maxval=tf.int64.max, dtype=tf.int64, name="dropout_seed")
+
+  # `recompute_grad` only allows the block to use Tensors that are passed to
+  # it, so the optional masks are passed by name.
+  mask_names = []
+  masks = []
+  for (name, mask) in [("attention_mask", attention_mask),
+                       ("attention_bias", attention_bias),
+                       ("input_mask", input_mask)]:
+    if mask is not None:
+      mask_names.append(name)
+      masks.append(mask)
+
+  def block_fn_builder(block_first_layer_index, block_num_attention_heads):
+    """Returns the function that runs one block, for `recompute_grad`."""
+
+    def block_fn(block_input, block_dropout_seed, *block_masks):
+      with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+        return transformer_model(
+            input_tensor=block_input,
+            hidden_size=hidden_size,
+            num_hidden_layers=len(block_num_attention_heads),
+            num_attention_heads=block_num_attention_heads,
+            attention_head_size=attention_head_size,
+            attention_window_size=attention_window_size,
+            num_global_tokens=num_global_tokens,
+            intermediate_size=intermediate_size,
+            intermediate_act_fn=intermediate_act_fn,
+            hidden_dropout_prob=hidden_dropout_prob,
+            attention_probs_dropout_prob=attention_probs_dropout_prob,
+            initializer_range=initializer_range,
+            do_return_all_layers=True,
+            use_fused_qkv=use_fused_qkv,
+            use_fused_layer_norm=use_fused_layer_norm,
+            remove_padding=remove_padding,
+            first_layer_index=block_first_layer_index,
+            dropout_seed=block_dropout_seed,
+            **dict(zip(mask_names, block_masks)))
+
+    return block_fn
+
+  all_layer_outputs = []
+  prev_output = input_tensor
+  for block_start in range(0, num_hidden_layers, recompute_block_size):
+    block_num_layers = min(recompute_block_size,
+                           num_hidden_layers - block_start)
+    block_fn = block_fn_builder(
+        first_layer_index + block_start,
+        layer_num_attention_heads[block_start:block_start + block_num_layers])
+    block_outputs = tf.contrib.layers.recompute_grad(block_fn)(
+        prev_output, dropout_seed, *masks)
+    all_layer_outputs.extend(block_outputs)
+    prev_output = block_outputs[-1]
+
+  if do_return_all_layers:
+    if output_layers is None:
+      output_layers = range(num_hidden_layers)
+    output_layers = get_layer_indexes(output_layers, num_hidden_layers)
+    return [all_layer_outputs[i] for i in output_layers]
+  else:
+    return prev_output
+
+
+def get_layer_indexes(layer_indexes, num_hidden_layers):
+  """Converts layer indexes that may count from the end to plain indexes.
+
+  Args:
+    layer_indexes: List of ints, where -1 is the last layer.
+    num_hidden_layers: int. Number of layers.
+
+  Returns:
+    A list of ints between 0 and `num_hidden_layers` - 1.
+
+  Raises:
+    ValueError: If an index is out of range.
+  """
+  indexes = []
+  for index in layer_indexes:
+    if not -num_hidden_layers <= index < num_hidden_layers:
+      raise ValueError("Layer index %d is out of range for %d layers." %
+                       (index, num_hidden_layers))
+    indexes.append(index % num_hidden_layers)
+  return indexes
+
+
+def get_attention_heads(hidden_size, num_attention_heads, num_hidden_layers,
+                        attention_head_size=None):
+  """Returns the number of attention heads of each layer and their size.
+
+  Args:
+    hidden_size: int. Hidden size of the Transformer.
+    num_attention_heads: int, or list of ints with one per layer.
+    num_hidden_layers: int. Number of layers.
+    attention_head_size: (optional) int. Size of each attention head. Defaults
+      to `hidden_size / num_attention_heads`.
+
+  Returns:
+    A tuple of a list with the number of attention heads of each layer, and
+    the int size of each head.
+
+  Raises:
+    ValueError: If the number of heads or their size is invalid.
+  """
+  if isinstance(num_attention_heads, (list, tuple)):
+    if len(num_attention_heads) != num_hidden_layers:
+      raise ValueError(
+          "`num_attention_heads` has %d entries for %d layers." %
+          (len(num_attention_heads), num_hidden_layers))
+    if attention_head_size is None:
+      raise ValueError("`attention_head_size` is required when "
+                       "`num_attention_heads` is a list.")
+    layer_num_attention_heads = list(num_attention_heads)
+  else:
+    if attention_head_size is None:
+      if hidden_size % num_attention_heads != 0:
+        raise ValueError(
+            "The hidden size (%d) is not a multiple of the number of attention "
+            "heads (%d)" % (hidden_size, num_attention_heads))
+      attention_head_size = int(hidden_size / num_attention_heads)
+    layer_num_attention_heads = [num_attention_heads] * num_hidden_layers
+
+  if any(x < 1 for x in layer_num_attention_heads):
+    raise ValueError("Every layer needs at least one attention head: %s" %
+                     (layer_num_attention_heads,))
+  return (layer_num_attention_heads, attention_head_size)
+
+
+def early_exit_transformer_model(input_tensor,
+                                 early_exit_fn,
+                                 attention_mask=None,
+                                 input_mask=None,
+                                 hidden_size=768,
+                                 num_hidden_layers=12,
+                                 num_attention_heads=12,
+                                 intermediate_size=3072,
+                                 intermediate_act_fn=gelu,
+                                 hidden_dropout_prob=0.1,
+                                 attention_probs_dropout_prob=0.1,
+                                 initializer_range=0.02,
+                                 use_fused_qkv=False,
+                                 use_fused_layer_norm=False,
+                                 remove_padding=False,
+                                 output_layers=None,
+                                 attention_bias=None,
+                                 attention_head_size=None,
+                                 attention_window_size=0,
+                                 num_global_tokens=1):
+  """Runs `transformer_model` one layer at a time, letting examples exit.
+
+  After each layer but the last, `early_exit_fn(layer_index, layer_output,
+  example_indices)` is called with the output of the examples that are still
+  running, of shape [num_running, seq_length, hidden_size], and with their int32
+  indices in the batch, of shape [num_running]. It returns a bool Tensor of
+  shape [num_running] that is True for the examples that stop after this
+  layer, or None if none of them do. The later layers only run on the
+  remaining examples. Once an example has exited the shapes are dynamic, so
+  exiting is for CPU/GPU only.
+
+  Args:
+    input_tensor: float Tensor of shape [batch_size, seq_length, hidden_size].
+    early_exit_fn: function, as described above.
+    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length,
+      seq_length].
+    input_mask: (optional) int32 Tensor of shape [batch_size, seq_length].
+    hidden_size: See `transformer_model`.
+    num_hidden_layers: See `transformer_model`.
+    num_attention_heads: See `transformer_model`.
+    intermediate_size: See `transformer_model`.
+    intermediate_act_fn: See `transformer_model`.
+    hidden_dropout_prob: See `transformer_model`.
+    attention_probs_dropout_prob: See `transformer_model`.
+    initializer_range: See `transformer_model`.
+    use_fused_qkv: See `transformer_model`.
+    use_fused_layer_norm: See `transformer_model`.
+    remove_padding: See `transformer_model`.
+    output_layers: See `transformer_model`.
+    attention_bias: (optional) float32 Tensor of shape [batch_size, 1, 1,
+      seq_length]. See `transformer_model`.
+    attention_head_size: See `transformer_model`.
+    attention_window_size: See `transformer_model`.
+    num_global_tokens: See `transformer_model`.
+
+  Returns:
+    A tuple of:
+      all_layer_outputs: List of float Tensors of shape [batch_size,
+        seq_length, hidden_size], one for each of `output_layers`. The rows of
+        the examples that exited before a layer are zero.
+      final_output: float Tensor of shape [batch_size, seq_length,
+        hidden_size], the output of the last layer that each example ran.
+      num_layers: int32 Tensor of shape [batch_size], the number of layers that
+        each example ran.
+  """
+  if output_layers is None:
+    output_layers = range(num_hidden_layers)
+  output_layers = get_layer_indexes(output_layers, num_hidden_layers)
+  (layer_num_attention_heads, attention_head_size) = get_attention_heads(
+      hidden_size, num_attention_heads, num_hidden_layers, attention_head_size)
+
+  batch_size = get_shape_list(input_tensor, expected_rank=3)[0]
+  example_indices = tf.range(batch_size)
+  # Until an example exits, the running examples are the whole batch and
+  # nothing needs to be gathered or scattered.
+  has_exited = False
+
+  layer_output = input_tensor
+  layer_outputs = {}
+  final_output = tf.zeros_like(input_tensor)
+  num_layers = tf.zeros([batch_size], dtype=tf.int32)
+  for layer_idx in range(num_hidden_layers):
+    layer_output = transformer_model(
+        input_tensor=layer_output,
+        attention_mask=attention_mask,
+        hidden_size=hidden_size,
+        num_hidden_layers=1,
+        num_attention_heads=layer_num_attention_heads[layer_idx],
+        attention_head_size=attention_head_size,
+        attention_window_size=attention_window_size,
+        num_global_tokens=num_global_tokens,
+        intermediate_size=intermediate_size,
+        intermediate_act_fn=intermediate_act_fn,
+        hidden_dropout_prob=hidden_dropout_prob,
+        attention_probs_dropout_prob=attention_probs_dropout_prob,
+        initializer_range=initializer_range,
+        use_fused_qkv=use_fused_qkv,
+        use_fused_layer_norm=use_fused_layer_norm,
+        input_mask=input_mask,
+        remove_padding=remove_padding,
+        first_layer_index=layer_idx,
+        attention_bias=attention_bias)
+
+    full_layer_output = layer_output
+    if has_exited:
+      full_layer_output = unpack_rows(layer_output, example_indices,
+                                      batch_size)
+      num_layers += unpack_rows(
+          tf.ones_like(example_indices), example_indices, batch_size)
+    else:
+      num_layers += 1
+    if layer_idx in output_layers:
+      layer_outputs[layer_idx] = full_layer_output
+
+    if layer_idx == num_hidden_layers - 1:
+      final_output += full_layer_output
+      break
+
+    exited = early_exit_fn(layer_idx, layer_output, example_indices)
+    if exited is None:
+      continue
+
+    exit_indices = tf.where(exited)[:, 0]
+    final_output += unpack_rows(
+        tf.gather(layer_output, exit_indices),
+        tf.gather(example_indices, exit_indices), batch_size)
+
+    running_indices = tf.where(tf.logical_not(exited))[:, 0]
+    layer_output = tf.gather(layer_output, running_indices)
+    example_indices = tf.gather(example_indices, running_indices)
+    if attention_mask is not None:
+      attention_mask = tf.gather(attention_mask, running_indices)
+    if attention_bias is not None:
+      attention_bias = tf.gather(attention_bias, running_indices)
+    if input_mask is not None:
+      input_mask = tf.gather(input_mask, running_indices)
+    has_exited = True
+
+  all_layer_outputs = [layer_outputs[i] for i in output_layers]
+  return (all_layer_outputs, final_output, num_layers)
+
+
+def get_packed_indices(input_mask):
+  """Returns the indices of the real tokens in the flattened `input_mask`.
+
+  Args:
+    input_mask: int32 Tensor of shape [batch_size, seq_length].
+
+  Returns:
+    int32 Tensor of shape [num_tokens], the indices of the rows of a
+    [batch_size * seq_length, width] matrix where `input_mask` is not 0.
+  """
+  flat_mask = tf.reshape(input_mask, [-1])
+  return tf.cast(tf.where(tf.not_equal(flat_mask, 0))[:, 0], tf.int32)
+
+
+def unpack_rows(packed_tensor, packed_indices, num_rows):
+  """Scatters packed rows back into a zero-filled tensor.
+
+  Args:
+    packed_tensor: Tensor of shape [num_packed, ...], e.g. [num_tokens, width].
+    packed_indices: int32 Tensor of shape [num_packed], e.g. from
+      `get_packed_indices`.
+    num_rows: int or int32 scalar Tensor. Number of rows of the output, e.g.
+      batch_size * seq_length.
+
+  Returns:
+    Tensor of shape [num_rows, ...].
+  """
+  shape = [num_rows] + get_shape_list(packed_tensor)[1:]
+  return tf.scatter_nd(
+      tf.expand_dims(packed_indices, axis=1), packed_tensor, shape)
+
+
 def get_shape_list(tensor, expected_rank=None, name=None):
   """Returns a list of the shape of tensor, preferring static dimensions.
 
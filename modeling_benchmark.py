@@ -0,0 +1,220 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Microbenchmark for the activation and layer normalization of modeling.py.
+
+Times the GELU implementations and the layer normalization implementations
+on their own, and one encoder layer with each combination of them, so that
+the effect of `hidden_act` and `use_fused_layer_norm` can be seen per layer.
+Also times `embedding_postprocessor` with and without the folded position and
+token type embeddings.
+
+Example:
+
+  python modeling_benchmark.py --batch_size=8 --seq_length=128 \
+    --output_file=/tmp/modeling_benchmark.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import platform
+import timeit
+import modeling
+import numpy as np
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer("batch_size", 8, "Batch size of the inputs.")
+
+flags.DEFINE_integer("seq_length", 128, "Sequence length of the inputs.")
+
+flags.DEFINE_integer("hidden_size", 768, "Hidden size of the layer.")
+
+flags.DEFINE_integer("num_attention_heads", 12,
+                     "Number of attention heads of the layer.")
+
+flags.DEFINE_integer("intermediate_size", 3072,
+                     "Size of the intermediate (feed-forward) layer.")
+
+flags.DEFINE_integer("num_iterations", 50,
+                     "Number of timed runs of each benchmark.")
+
+flags.DEFINE_integer("num_warmup_iterations", 5,
+                     "Number of untimed runs of each benchmark before timing.")
+
+flags.DEFINE_bool(
+    "do_backward", True,
+    "Whether to also time the encoder layer with its gradients, as in "
+    "training.")
+
+flags.DEFINE_string("output_file", None,
+                    "If set, the results are written to this JSON file.")
+
+ACTIVATIONS = ["gelu", "gelu_exact"]
+
+LAYER_NORMS = collections.OrderedDict([("contrib", False), ("fused", True)])
+
+EMBEDDINGS = collections.OrderedDict([("unfolded", False), ("folded", True)])
+
+
+def create_variable(name, shape):
+  """Returns a random variable, so that the benchmarks are not folded."""
+  return tf.get_variable(
+      name,
+      shape=shape,
+      initializer=tf.random_normal_initializer(),
+      trainable=False)
+
+
+def get_fetches(tensors):
+  """Returns the first element of each of `tensors`, to run them.
+
+  Running `tf.group(tensors)` instead lets the graph optimizations prune the
+  computation, and fetching whole tensors would also time the copies.
+  """
+  return [tf.reshape(x, [-1])[:1] for x in tensors]
+
+
+def create_benchmarks():
+  """Builds the benchmarks in the default graph.
+
+  Returns:
+    An OrderedDict of benchmark name to the fetches to time.
+  """
+  num_rows = FLAGS.batch_size * FLAGS.seq_length
+  benchmarks = collections.OrderedDict()
+
+  intermediate = create_variable("intermediate",
+                                 [num_rows, FLAGS.intermediate_size])
+  for act in ACTIVATIONS:
+    output = modeling.get_activation(act)(intermediate)
+    benchmarks["activation/%s" % act] = get_fetches([output])
+
+  hidden = create_variable("hidden", [num_rows, FLAGS.hidden_size])
+  for (name, fused) in LAYER_NORMS.items():
+    output = modeling.layer_norm(hidden, name="layer_norm_%s" % name,
+                                 fused=fused)
+    benchmarks["layer_norm/%s" % name] = get_fetches([output])
+
+  word_embeddings = create_variable(
+      "word_embeddings",
+      [FLAGS.batch_size, FLAGS.seq_length, FLAGS.hidden_size])
+  token_type_ids = tf.constant(
+      np.random.randint(2, size=[FLAGS.batch_size, FLAGS.seq_length]),
+      dtype=tf.int32)
+  for (name, folded) in EMBEDDINGS.items():
+    # Both share the same embedding variables.
+    with tf.variable_scope("embeddings", reuse=tf.AUTO_REUSE):
+      output = modeling.embedding_postprocessor(
+          word_embeddings,
+          use_token_type=True,
+          token_type_ids=token_type_ids,
+          token_type_vocab_size=2,
+          max_position_embeddings=FLAGS.seq_length,
+          dropout_prob=0.0,
+          use_folded_embeddings=folded)
+    benchmarks["embeddings/%s" % name] = get_fetches([output])
+
+  layer_input = create_variable(
+      "layer_input", [FLAGS.batch_size, FLAGS.seq_length, FLAGS.hidden_size])
+  attention_bias = tf.zeros([FLAGS.batch_size, 1, 1, FLAGS.seq_length])
+  for act in ACTIVATIONS:
+    for (name, fused) in LAYER_NORMS.items():
+      with tf.variable_scope("%s_%s" % (act, name)):
+        output = modeling.transformer_model(
+            input_tensor=layer_input,
+            hidden_size=FLAGS.hidden_size,
+            num_hidden_layers=1,
+            num_attention_heads=FLAGS.num_attention_heads,
+            intermediate_size=FLAGS.intermediate_size,
+            intermediate_act_fn=modeling.get_activation(act),
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            use_fused_layer_norm=fused,
+            attention_bias=attention_bias)
+        benchmarks["layer/%s/%s" % (act, name)] = get_fetches([output])
+        if FLAGS.do_backward:
+          tvars = tf.trainable_variables(tf.get_variable_scope().name)
+          grads = tf.gradients(tf.reduce_sum(output), [layer_input] + tvars)
+          benchmarks["layer_backward/%s/%s" % (act,
+                                               name)] = get_fetches(grads)
+  return benchmarks
+
+
+def run_benchmark(sess, fetches, num_iterations, num_warmup_iterations):
+  """Times `fetches`, returning a dict of results."""
+  for _ in range(num_warmup_iterations):
+    sess.run(fetches)
+
+  timer = timeit.default_timer
+  latencies = np.zeros([num_iterations], dtype=np.float64)
+  for i in range(num_iterations):
+    start = timer()
+    sess.run(fetches)
+    latencies[i] = timer() - start
+
+  return collections.OrderedDict([
+      ("iterations", num_iterations),
+      ("mean_ms", float(np.mean(latencies) * 1e3)),
+      ("p50_ms", float(np.percentile(latencies, 50) * 1e3)),
+      ("p90_ms", float(np.percentile(latencies, 90) * 1e3)),
+  ])
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  benchmarks = create_benchmarks()
+  results = collections.OrderedDict()
+  # The first benchmark of each group uses the defaults ("gelu",
+  # `tf.contrib.layers.layer_norm` and unfolded embeddings), and the others
+  # are compared with it.
+  group_baselines = {}
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+    for (name, fetches) in benchmarks.items():
+      result = run_benchmark(sess, fetches, FLAGS.num_iterations,
+                             FLAGS.num_warmup_iterations)
+      group = name.split("/", 1)[0]
+      baseline = group_baselines.setdefault(group, result)
+      result["speedup"] = baseline["mean_ms"] / result["mean_ms"]
+      results[name] = result
+      tf.logging.info("%s: mean %.3fms, p50 %.3fms, p90 %.3fms, %.2fx", name,
+                      result["mean_ms"], result["p50_ms"], result["p90_ms"],
+                      result["speedup"])
+
+  if FLAGS.output_file:
+    output = collections.OrderedDict([
+        ("python", platform.python_version()),
+        ("tensorflow", tf.__version__),
+        ("batch_size", FLAGS.batch_size),
+        ("seq_length", FLAGS.seq_length),
+        ("hidden_size", FLAGS.hidden_size),
+        ("intermediate_size", FLAGS.intermediate_size),
+        ("results", results),
+    ])
+    with tf.gfile.GFile(FLAGS.output_file, "w") as writer:
+      writer.write(json.dumps(output, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -18,10 +18,12 @@ from __future__ import print_function
 
 import collections
 import json
+import math
 import random
 import re
 
 import modeling
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -132,6 +134,549 @@ class BertModelTest(tf.test.TestCase):
     self.assertEqual(obj["vocab_size"], 99)
     self.assertEqual(obj["hidden_size"], 37)
 
+  def test_fused_qkv(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      input_mask = BertModelTest.ids_tensor([3, 7], vocab_size=2)
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          input_mask=input_mask,
+          scope="bert")
+      variable_names = [x.name for x in tf.global_variables()]
+
+      # The fused model must reuse exactly the same variables.
+      config.use_fused_qkv = True
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        fused_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert")
+      self.assertEqual([x.name for x in tf.global_variables()],
+                       variable_names)
+
+      sess.run(tf.global_variables_initializer())
+      (sequence_output, fused_sequence_output) = sess.run(
+          [model.get_sequence_output(),
+           fused_model.get_sequence_output()])
+      self.assertAllClose(sequence_output, fused_sequence_output, atol=1e-5)
+
+  def test_fused_layer_norm(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          scope="bert")
+      variable_names = [x.name for x in tf.global_variables()]
+
+      # The fused model must reuse exactly the same variables.
+      config.use_fused_layer_norm = True
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        fused_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            scope="bert")
+      self.assertEqual([x.name for x in tf.global_variables()],
+                       variable_names)
+
+      sess.run(tf.global_variables_initializer())
+      rng = np.random.RandomState(12345)
+      for variable in tf.global_variables():
+        if "LayerNorm" in variable.name:
+          variable.load(
+              rng.normal(size=variable.shape.as_list()).astype(np.float32),
+              sess)
+      (sequence_output, fused_sequence_output) = sess.run(
+          [model.get_sequence_output(),
+           fused_model.get_sequence_output()])
+      self.assertAllClose(sequence_output, fused_sequence_output, atol=1e-4)
+
+  def test_gelu(self):
+    with self.test_session() as sess:
+      x = np.linspace(-6.0, 6.0, 49).astype(np.float32)
+      (approximate, exact) = sess.run(
+          [modeling.gelu(tf.constant(x)),
+           modeling.get_activation("gelu_exact")(tf.constant(x))])
+      expected = [v * 0.5 * (1.0 + math.erf(v / math.sqrt(2.0))) for v in x]
+      self.assertAllClose(exact, expected, atol=1e-6)
+      self.assertAllClose(approximate, expected, atol=1e-3)
+
+  def test_remove_padding(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      input_mask = tf.constant([[1, 1, 1, 1, 1, 1, 1], [1, 1, 1, 0, 0, 0, 0],
+                                [1, 0, 0, 0, 0, 0, 0]])
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          input_mask=input_mask,
+          scope="bert")
+      variable_names = [x.name for x in tf.global_variables()]
+
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        packed_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert",
+            remove_padding=True)
+      self.assertEqual([x.name for x in tf.global_variables()],
+                       variable_names)
+
+      sess.run(tf.global_variables_initializer())
+      (mask, sequence_output, packed_sequence_output, pooled_output,
+       packed_pooled_output) = sess.run([
+           input_mask,
+           model.get_sequence_output(),
+           packed_model.get_sequence_output(),
+           model.get_pooled_output(),
+           packed_model.get_pooled_output()
+       ])
+      # Real tokens are unchanged and padding tokens are zero.
+      self.assertAllClose(sequence_output[mask == 1],
+                          packed_sequence_output[mask == 1], atol=1e-5)
+      self.assertAllEqual(packed_sequence_output[mask == 0],
+                          0 * packed_sequence_output[mask == 0])
+      self.assertAllClose(pooled_output, packed_pooled_output, atol=1e-5)
+
+  def test_folded_embeddings(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      token_type_ids = BertModelTest.ids_tensor([3, 7], vocab_size=2)
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          max_position_embeddings=16,
+          type_vocab_size=2)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          token_type_ids=token_type_ids,
+          scope="bert")
+      variable_names = [x.name for x in tf.global_variables()]
+
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        folded_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            token_type_ids=token_type_ids,
+            scope="bert",
+            fold_embeddings=True)
+      self.assertEqual([x.name for x in tf.global_variables()],
+                       variable_names)
+      self.assertEqual([x.name for x in tf.local_variables()],
+                       ["bert/embeddings/folded_embeddings:0"])
+      self.assertEqual(tf.local_variables()[0].shape.as_list(), [32, 32])
+
+      sess.run(tf.global_variables_initializer())
+      sess.run(tf.local_variables_initializer())
+      (embedding_output, folded_embedding_output, pooled_output,
+       folded_pooled_output) = sess.run([
+           model.get_embedding_output(),
+           folded_model.get_embedding_output(),
+           model.get_pooled_output(),
+           folded_model.get_pooled_output()
+       ])
+      self.assertAllClose(embedding_output, folded_embedding_output,
+                          atol=1e-5)
+      self.assertAllClose(pooled_output, folded_pooled_output, atol=1e-5)
+
+      with self.assertRaises(ValueError):
+        modeling.BertModel(
+            config=config,
+            is_training=True,
+            input_ids=input_ids,
+            scope="training",
+            fold_embeddings=True)
+
+  def test_compute_dtype(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      input_mask = BertModelTest.ids_tensor([3, 7], vocab_size=2)
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          input_mask=input_mask,
+          scope="bert")
+      variable_names = [x.name for x in tf.global_variables()]
+
+      outputs = [model.get_sequence_output(), model.get_pooled_output()]
+      for compute_dtype in ["bfloat16", "float16"]:
+        config.compute_dtype = compute_dtype
+        for use_fused_qkv in [False, True]:
+          config.use_fused_qkv = use_fused_qkv
+          with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            half_model = modeling.BertModel(
+                config=config,
+                is_training=False,
+                input_ids=input_ids,
+                input_mask=input_mask,
+                scope="bert")
+          outputs.append(half_model.get_sequence_output())
+          outputs.append(half_model.get_pooled_output())
+
+      # The variables are the same float32 variables.
+      self.assertEqual([x.name for x in tf.global_variables()],
+                       variable_names)
+      for x in tf.global_variables():
+        self.assertEqual(x.dtype.base_dtype, tf.float32)
+
+      sess.run(tf.global_variables_initializer())
+      results = sess.run(outputs)
+      (sequence_output, pooled_output) = results[:2]
+      for i in range(2, len(results), 2):
+        self.assertEqual(results[i].dtype, sequence_output.dtype)
+        # The outputs are layer normalized, so this is a relative tolerance.
+        self.assertAllClose(sequence_output, results[i], atol=0.05)
+        self.assertAllClose(pooled_output, results[i + 1], atol=0.05)
+
+    with self.assertRaises(ValueError):
+      modeling.BertModel(
+          config=modeling.BertConfig(vocab_size=99, compute_dtype="int32"),
+          is_training=False,
+          input_ids=input_ids)
+
+  def test_output_layers(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      input_mask = BertModelTest.ids_tensor([3, 7], vocab_size=2)
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=3,
+          num_attention_heads=4,
+          intermediate_size=37)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          input_mask=input_mask,
+          scope="bert")
+
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        layers_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert",
+            remove_padding=True,
+            output_layers=[-1, 0])
+        no_layers_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert",
+            output_layers=[])
+      self.assertEqual(len(layers_model.get_all_encoder_layers()), 2)
+      self.assertEqual(no_layers_model.get_all_encoder_layers(), [])
+
+      sess.run(tf.global_variables_initializer())
+      (mask, all_encoder_layers, output_layers, sequence_output) = sess.run([
+          input_mask,
+          model.get_all_encoder_layers(),
+          layers_model.get_all_encoder_layers(),
+          no_layers_model.get_sequence_output()
+      ])
+      self.assertAllClose(output_layers[0][mask == 1],
+                          all_encoder_layers[2][mask == 1], atol=1e-5)
+      self.assertAllClose(output_layers[1][mask == 1],
+                          all_encoder_layers[0][mask == 1], atol=1e-5)
+      self.assertAllClose(sequence_output, all_encoder_layers[2])
+
+    with self.assertRaises(ValueError):
+      modeling.get_layer_indexes([3], 3)
+    self.assertEqual(modeling.get_layer_indexes([-1, -3, 1], 3), [2, 0, 1])
+
+  def test_attention_bias(self):
+    with self.test_session() as sess:
+      input_tensor = tf.random_normal([3, 7, 32], seed=1)
+      input_mask = BertModelTest.ids_tensor([3, 7], vocab_size=2)
+      attention_bias = modeling.create_attention_bias_from_input_mask(
+          input_mask)
+      self.assertAllEqual(attention_bias.shape.as_list(), [3, 1, 1, 7])
+
+      kwargs = dict(
+          input_tensor=input_tensor,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          hidden_dropout_prob=0.0,
+          attention_probs_dropout_prob=0.0)
+      with tf.variable_scope("encoder"):
+        output = modeling.transformer_model(
+            attention_mask=modeling.create_attention_mask_from_input_mask(
+                input_tensor, input_mask),
+            **kwargs)
+      with tf.variable_scope("encoder", reuse=True):
+        bias_output = modeling.transformer_model(
+            attention_bias=attention_bias, **kwargs)
+
+      sess.run(tf.global_variables_initializer())
+      (output, bias_output) = sess.run([output, bias_output])
+      self.assertAllClose(output, bias_output, atol=1e-5)
+
+  def test_sliding_window_attention(self):
+    batch_size = 3
+    seq_length = 12
+    rng = np.random.RandomState(12345)
+    input_mask = rng.randint(2, size=[batch_size, seq_length])
+    input_mask[:, 0] = 1
+    input_mask[0] = 1
+    positions = np.arange(seq_length)
+    with self.test_session() as sess:
+      input_tensor = tf.random_normal([batch_size, seq_length, 32], seed=1)
+      attention_bias = modeling.create_attention_bias_from_input_mask(
+          tf.constant(input_mask.astype(np.int32)))
+      kwargs = dict(
+          input_tensor=input_tensor,
+          hidden_size=32,
+          num_hidden_layers=2,
+          num_attention_heads=4,
+          intermediate_size=37,
+          hidden_dropout_prob=0.0,
+          attention_probs_dropout_prob=0.0)
+      outputs = []
+      for (window, num_global_tokens) in [(2, 1), (3, 2), (4, 0)]:
+        # The same pattern as a dense mask.
+        is_global = positions < num_global_tokens
+        attention_mask = (
+            (np.abs(positions[:, np.newaxis] - positions[np.newaxis, :]) <=
+             window) | is_global[:, np.newaxis] | is_global[np.newaxis, :])
+        attention_mask = (attention_mask[np.newaxis] &
+                          (input_mask[:, np.newaxis] > 0))
+
+        scope = "encoder_%d_%d" % (window, num_global_tokens)
+        with tf.variable_scope(scope):
+          output = modeling.transformer_model(
+              attention_mask=tf.constant(attention_mask.astype(np.int32)),
+              **kwargs)
+        with tf.variable_scope(scope, reuse=True):
+          window_output = modeling.transformer_model(
+              attention_bias=attention_bias,
+              attention_window_size=window,
+              num_global_tokens=num_global_tokens,
+              **kwargs)
+        outputs.append((output, window_output))
+
+      sess.run(tf.global_variables_initializer())
+      for (output, window_output) in sess.run(outputs):
+        self.assertAllClose(output, window_output, atol=1e-5)
+
+    with self.assertRaises(ValueError):
+      modeling.sliding_window_attention(
+          tf.zeros([1, 2, 10, 8]), tf.zeros([1, 2, 10, 8]),
+          tf.zeros([1, 2, 10, 8]), attention_window_size=4)
+
+  def test_per_layer_attention_heads(self):
+    # The heads of the full encoder that the pruned encoder keeps.
+    kept_heads = [[0, 3], [1, 2, 3]]
+    with self.test_session() as sess:
+      input_tensor = tf.random_normal([2, 5, 32], seed=1)
+      kwargs = dict(
+          input_tensor=input_tensor,
+          hidden_size=32,
+          num_hidden_layers=2,
+          intermediate_size=37,
+          hidden_dropout_prob=0.0,
+          attention_probs_dropout_prob=0.0)
+      with tf.variable_scope("full"):
+        output = modeling.transformer_model(num_attention_heads=4, **kwargs)
+      with tf.variable_scope("pruned"):
+        pruned_output = modeling.transformer_model(
+            num_attention_heads=[len(x) for x in kept_heads],
+            attention_head_size=8,
+            **kwargs)
+
+      variables = dict((x.op.name, x) for x in tf.global_variables())
+      self.assertAllEqual(
+          variables["pruned/layer_0/attention/self/query/kernel"].shape,
+          [32, 16])
+      self.assertAllEqual(
+          variables["pruned/layer_1/attention/output/dense/kernel"].shape,
+          [24, 32])
+
+      sess.run(tf.global_variables_initializer())
+      for (layer_idx, heads) in enumerate(kept_heads):
+        columns = np.concatenate([np.arange(8) + 8 * x for x in heads])
+        for name in [
+            "self/query/kernel", "self/query/bias", "self/key/kernel",
+            "self/key/bias", "self/value/kernel", "self/value/bias",
+            "output/dense/kernel"
+        ]:
+          name = "layer_%d/attention/%s" % (layer_idx, name)
+          value = sess.run(variables["full/" + name])
+          if name.endswith("output/dense/kernel"):
+            # Removing a head is the same as dropping its output.
+            pruned_rows = np.ones([32], dtype=np.bool_)
+            pruned_rows[columns] = False
+            value[pruned_rows] = 0.0
+            variables["full/" + name].load(value, sess)
+            value = value[columns]
+          else:
+            value = value[..., columns]
+          variables["pruned/" + name].load(value, sess)
+        for name in sorted(variables):
+          if (name.startswith("full/layer_%d/" % layer_idx) and
+              "/attention/" not in name):
+            variables[name.replace("full/", "pruned/", 1)].load(
+                sess.run(variables[name]), sess)
+
+      (output, pruned_output) = sess.run([output, pruned_output])
+      self.assertAllClose(output, pruned_output, atol=1e-5)
+
+    with self.assertRaises(ValueError):
+      modeling.get_attention_heads(32, [4, 4], 2)
+    with self.assertRaises(ValueError):
+      modeling.get_attention_heads(32, [4], 2, attention_head_size=8)
+    with self.assertRaises(ValueError):
+      modeling.get_attention_heads(32, [4, 0], 2, attention_head_size=8)
+    self.assertEqual(modeling.get_attention_heads(32, 4, 2), ([4, 4], 8))
+
+  def test_recompute(self):
+    with self.test_session() as sess:
+      input_tensor = tf.random_normal([2, 5, 32], seed=1)
+      dropout_seed = tf.constant([12345, 0], dtype=tf.int64)
+      kwargs = dict(
+          input_tensor=input_tensor,
+          hidden_size=32,
+          num_hidden_layers=3,
+          num_attention_heads=4,
+          intermediate_size=37,
+          do_return_all_layers=True,
+          output_layers=[0, 2],
+          dropout_seed=dropout_seed)
+      with tf.variable_scope("encoder"):
+        recompute_layers = modeling.transformer_model(
+            recompute_block_size=2, **kwargs)
+      with tf.variable_scope("encoder", reuse=True):
+        layers = modeling.transformer_model(**kwargs)
+
+      tvars = tf.trainable_variables()
+      self.assertEqual(len(tvars), 3 * 16)
+      self.assertEqual(tvars[0].op.name,
+                       "encoder/layer_0/attention/self/query/kernel")
+
+      loss = tf.reduce_sum(layers[0]) + tf.reduce_sum(tf.square(layers[1]))
+      recompute_loss = (
+          tf.reduce_sum(recompute_layers[0]) +
+          tf.reduce_sum(tf.square(recompute_layers[1])))
+      grads = tf.gradients(loss, tvars + [input_tensor])
+      recompute_grads = tf.gradients(recompute_loss, tvars + [input_tensor])
+
+      sess.run(tf.global_variables_initializer())
+      (values, recompute_values) = sess.run([layers + grads,
+                                             recompute_layers + recompute_grads])
+      for (value, recompute_value) in zip(values, recompute_values):
+        self.assertAllClose(value, recompute_value, atol=1e-5)
+
+  def test_early_exit(self):
+    with self.test_session() as sess:
+      input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+      input_mask = BertModelTest.ids_tensor([3, 7], vocab_size=2)
+      config = modeling.BertConfig(
+          vocab_size=99,
+          hidden_size=32,
+          num_hidden_layers=3,
+          num_attention_heads=4,
+          intermediate_size=37)
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=input_ids,
+          input_mask=input_mask,
+          scope="bert")
+      variable_names = [x.name for x in tf.global_variables()]
+
+      # Example 1 exits after the first layer and example 2 after the second.
+      def early_exit_fn(layer_index, layer_output, example_indices):
+        del layer_output  # Unused.
+        return tf.equal(example_indices, layer_index + 1)
+
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        exit_model = modeling.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope="bert",
+            early_exit_fn=early_exit_fn)
+      self.assertEqual([x.name for x in tf.global_variables()],
+                       variable_names)
+
+      sess.run(tf.global_variables_initializer())
+      (all_encoder_layers, exit_sequence_output, exit_all_encoder_layers,
+       num_layers) = sess.run([
+           model.get_all_encoder_layers(),
+           exit_model.get_sequence_output(),
+           exit_model.get_all_encoder_layers(),
+           exit_model.get_num_layers()
+       ])
+      self.assertAllEqual(num_layers, [3, 1, 2])
+      for (i, layer_index) in enumerate([2, 0, 1]):
+        self.assertAllClose(exit_sequence_output[i],
+                            all_encoder_layers[layer_index][i], atol=1e-5)
+      self.assertAllClose(exit_all_encoder_layers[1][[0, 2]],
+                          all_encoder_layers[1][[0, 2]], atol=1e-5)
+      self.assertAllEqual(exit_all_encoder_layers[1][1],
+                          0 * all_encoder_layers[1][1])
+
+  def test_early_exit_recompute(self):
+    input_ids = BertModelTest.ids_tensor([3, 7], vocab_size=99)
+    config = modeling.BertConfig(
+        vocab_size=99,
+        hidden_size=32,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        intermediate_size=37,
+        recompute_block_size=2)
+    with self.assertRaises(ValueError):
+      modeling.BertModel(
+          config=config,
+          is_training=True,
+          input_ids=input_ids,
+          early_exit_fn=lambda *args: None)
+
   def run_tester(self, tester):
     with self.test_session() as sess:
       ops = tester.create_model()
@@ -0,0 +1,337 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Removes the least important attention heads of a BERTAR classifier.
+
+The importance of each head is the absolute change in the classification loss
+of an example if the output of the head is scaled (the gradient of the loss
+with respect to a multiplier of the head, as in "Are Sixteen Heads Really
+Better than One?"), summed over the first `--num_importance_examples`
+training examples and normalized within each layer. The `--prune_ratio`
+lowest-scoring heads are removed from the checkpoint: their columns of the
+`query`, `key` and `value` kernels and biases and their rows of the
+`attention/output/dense` kernel (and the same entries of their Adam slots) are
+dropped, and the written `bert_config.json` lists the number of heads left in
+each layer. The pruned model has smaller matmuls and no masking at runtime, and
+can be fine-tuned further with `run_classifier_discrimination.py`.
+
+The original and the pruned checkpoints are then run on the test split and
+compared. The other flags (`--data_dir`, `--init_checkpoint`,
+`--max_seq_length`, ...) are those of `run_classifier_discrimination.py`, and
+`--init_checkpoint` is the fine-tuned checkpoint.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import copy
+import os
+import re
+import checkpoint_utils
+import modeling
+import numpy as np
+import run_classifier_discrimination
+import tokenization
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    "num_importance_examples", 512,
+    "Number of examples that the importance of the heads is computed on.")
+
+flags.DEFINE_float(
+    "prune_ratio", 0.25,
+    "Fraction of all attention heads to remove, starting with the least "
+    "important.")
+
+flags.DEFINE_integer("min_heads_per_layer", 1,
+                     "Number of attention heads that each layer keeps.")
+
+# Variables of a layer whose last dimension has one slice per attention head.
+HEAD_COLUMN_VARIABLES = re.compile(
+    r"^bert/encoder/layer_(\d+)/attention/self/(query|key|value)/"
+    r"(kernel|bias)$")
+
+# Variables of a layer whose first dimension has one slice per attention head.
+HEAD_ROW_VARIABLES = re.compile(
+    r"^bert/encoder/layer_(\d+)/attention/output/dense/kernel$")
+
+
+def get_attention_probs(num_hidden_layers):
+  """Finds the attention probabilities of each layer in the default graph.
+
+  Args:
+    num_hidden_layers: int. Number of encoder layers.
+
+  Returns:
+    A list with the output of the softmax of each layer, of shape
+    [batch_size, num_heads, seq_length, seq_length].
+
+  Raises:
+    ValueError: If a layer has no softmax.
+  """
+  attention_probs = []
+  for layer_idx in range(num_hidden_layers):
+    prefix = "bert/encoder/layer_%d/attention/self/" % layer_idx
+    softmax_ops = [
+        x for x in tf.get_default_graph().get_operations()
+        if x.type == "Softmax" and x.name.startswith(prefix)
+    ]
+    if len(softmax_ops) != 1:
+      raise ValueError("Expected one Softmax under %s, found %d" %
+                       (prefix, len(softmax_ops)))
+    attention_probs.append(softmax_ops[0].outputs[0])
+  return attention_probs
+
+
+def compute_head_importance(bert_config, num_labels, features):
+  """Computes the importance of each attention head on `features`.
+
+  Multiplying the output of a head by a scalar multiplies its attention
+  probabilities by it, so the gradient of the loss with respect to that scalar
+  is the sum of the probabilities times their gradients.
+
+  Args:
+    bert_config: `BertConfig` of the model.
+    num_labels: int. Number of classifier labels.
+    features: List of `InputFeatures` to score the heads on.
+
+  Returns:
+    A list with a float64 array of the importance of the heads of each layer,
+    normalized to unit L2 norm within the layer.
+  """
+  with tf.Graph().as_default():
+    input_ids = tf.placeholder(tf.int32, [None, FLAGS.max_seq_length])
+    input_mask = tf.placeholder(tf.int32, [None, FLAGS.max_seq_length])
+    segment_ids = tf.placeholder(tf.int32, [None, FLAGS.max_seq_length])
+    label_ids = tf.placeholder(tf.int32, [None])
+    (_, per_example_loss, _, _, _,
+     _) = run_classifier_discrimination.create_model(
+         bert_config, False, input_ids, input_mask, segment_ids, label_ids,
+         num_labels, use_one_hot_embeddings=False)
+
+    attention_probs = get_attention_probs(bert_config.num_hidden_layers)
+    # The loss of each example only depends on its own rows, so the gradients
+    # of the summed loss give the score of each example.
+    grads = tf.gradients(tf.reduce_sum(per_example_loss), attention_probs)
+    batch_importance = []
+    for (probs, grad) in zip(attention_probs, grads):
+      probs = tf.cast(probs, tf.float32)
+      grad = tf.cast(grad, tf.float32)
+      example_scores = tf.reduce_sum(probs * grad, axis=[2, 3])
+      batch_importance.append(tf.reduce_sum(tf.abs(example_scores), axis=0))
+
+    (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+        tf.global_variables(), FLAGS.init_checkpoint)
+    tf.train.init_from_checkpoint(FLAGS.init_checkpoint, assignment_map)
+
+    importance = None
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      batch_size = FLAGS.predict_batch_size
+      for start in range(0, len(features), batch_size):
+        batch = features[start:start + batch_size]
+        results = sess.run(
+            batch_importance,
+            feed_dict={
+                input_ids: [x.input_ids for x in batch],
+                input_mask: [x.input_mask for x in batch],
+                segment_ids: [x.segment_ids for x in batch],
+                label_ids: [x.label_id for x in batch],
+            })
+        if importance is None:
+          importance = [x.astype(np.float64) for x in results]
+        else:
+          importance = [x + y for (x, y) in zip(importance, results)]
+
+  return [x / max(np.linalg.norm(x), 1e-12) for x in importance]
+
+
+def select_heads(importance, num_heads_to_prune, min_heads_per_layer):
+  """Selects the heads to keep, pruning the least important ones first.
+
+  Args:
+    importance: List with an array of the importance of the heads of each
+      layer.
+    num_heads_to_prune: int. Number of heads to remove in total.
+    min_heads_per_layer: int. Number of heads that each layer keeps, which
+      may leave fewer than `num_heads_to_prune` heads removed.
+
+  Returns:
+    A list with a sorted int64 array of the indices of the kept heads of each
+    layer.
+  """
+  candidates = []
+  for (layer_idx, layer_importance) in enumerate(importance):
+    for (head, score) in enumerate(layer_importance):
+      candidates.append((score, layer_idx, head))
+  candidates.sort()
+
+  kept = [set(range(len(x))) for x in importance]
+  num_pruned = 0
+  for (_, layer_idx, head) in candidates:
+    if num_pruned >= num_heads_to_prune:
+      break
+    if len(kept[layer_idx]) <= min_heads_per_layer:
+      continue
+    kept[layer_idx].remove(head)
+    num_pruned += 1
+  return [np.array(sorted(x), dtype=np.int64) for x in kept]
+
+
+def prune_variables(variables, kept_heads, attention_head_size):
+  """Drops the slices of the removed heads from `variables`.
+
+  Args:
+    variables: OrderedDict of the checkpoint variables.
+    kept_heads: List with an array of the indices of the kept heads of each
+      layer.
+    attention_head_size: int. Size of each attention head.
+
+  Returns:
+    A new OrderedDict of the pruned variables.
+  """
+  pruned = type(variables)()
+  for (name, value) in variables.items():
+    base_name = checkpoint_utils.get_slot_base_name(name)
+    column_match = HEAD_COLUMN_VARIABLES.match(base_name)
+    row_match = HEAD_ROW_VARIABLES.match(base_name)
+    match = column_match or row_match
+    if not match:
+      pruned[name] = value
+      continue
+    heads = kept_heads[int(match.group(1))]
+    indices = (heads[:, np.newaxis] * attention_head_size +
+               np.arange(attention_head_size)).reshape([-1])
+    if column_match:
+      pruned[name] = value[..., indices]
+    else:
+      pruned[name] = value[indices]
+  return pruned
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  processors = {
+      "bertar": run_classifier_discrimination.BERTARProcessor,
+  }
+
+  task_name = FLAGS.task_name.lower()
+  if task_name not in processors:
+    raise ValueError("Task not found: %s" % (task_name))
+
+  processor = processors[task_name]()
+  label_list = processor.get_labels()
+
+  bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+
+  (num_heads, attention_head_size) = modeling.get_attention_heads(
+      bert_config.hidden_size, bert_config.num_attention_heads,
+      bert_config.num_hidden_layers, bert_config.attention_head_size)
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+
+  # The BERTAR task has no dev split, and the test split is held out for the
+  # comparison below.
+  importance_examples = processor.get_train_examples(
+      FLAGS.data_dir)[:FLAGS.num_importance_examples]
+  importance_features = (
+      run_classifier_discrimination.convert_examples_to_features(
+          importance_examples, label_list, FLAGS.max_seq_length, tokenizer))
+
+  importance = compute_head_importance(bert_config, len(label_list),
+                                       importance_features)
+  num_heads_to_prune = int(FLAGS.prune_ratio * sum(num_heads))
+  kept_heads = select_heads(importance, num_heads_to_prune,
+                            FLAGS.min_heads_per_layer)
+  for (layer_idx, heads) in enumerate(kept_heads):
+    tf.logging.info("  layer_%d: importance %s, keeping %s", layer_idx,
+                    np.array2string(importance[layer_idx], precision=3),
+                    heads.tolist())
+
+  variables = checkpoint_utils.load_variables(FLAGS.init_checkpoint)
+  pruned_variables = prune_variables(variables, kept_heads,
+                                     attention_head_size)
+
+  pruned_config = copy.deepcopy(bert_config)
+  pruned_config.num_attention_heads = [len(x) for x in kept_heads]
+  pruned_config.attention_head_size = attention_head_size
+  with tf.gfile.GFile(os.path.join(FLAGS.output_dir, "bert_config.json"),
+                      "w") as writer:
+    writer.write(pruned_config.to_json_string())
+  pruned_checkpoint = checkpoint_utils.save_variables(
+      pruned_variables, os.path.join(FLAGS.output_dir, "model.ckpt"))
+  tf.logging.info("Wrote %s", pruned_checkpoint)
+
+  test_examples = processor.get_test_examples(FLAGS.data_dir)
+  label_ids = np.array([label_list.index(x.label) for x in test_examples])
+  predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+  run_classifier_discrimination.file_based_convert_examples_to_features(
+      test_examples, label_list, FLAGS.max_seq_length, tokenizer, predict_file)
+
+  (predictions, examples_per_second) = (
+      run_classifier_discrimination.predict_label_ids(
+          bert_config, len(label_list), FLAGS.init_checkpoint, predict_file,
+          FLAGS.max_seq_length, FLAGS.predict_batch_size))
+  (pruned_predictions, pruned_examples_per_second) = (
+      run_classifier_discrimination.predict_label_ids(
+          pruned_config, len(label_list), pruned_checkpoint, predict_file,
+          FLAGS.max_seq_length, FLAGS.predict_batch_size))
+
+  def count_parameters(variables):
+    return sum(
+        x.size for (name, x) in variables.items()
+        if checkpoint_utils.get_slot_base_name(name) == name)
+
+  accuracy = np.mean(predictions == label_ids)
+  pruned_accuracy = np.mean(pruned_predictions == label_ids)
+  result = collections.OrderedDict([
+      ("num_test_examples", len(test_examples)),
+      ("num_heads", sum(num_heads)),
+      ("num_pruned_heads", sum(num_heads) - sum(len(x) for x in kept_heads)),
+      ("pruned_num_attention_heads", pruned_config.num_attention_heads),
+      ("num_parameters", count_parameters(variables)),
+      ("pruned_num_parameters", count_parameters(pruned_variables)),
+      ("accuracy", accuracy),
+      ("pruned_accuracy", pruned_accuracy),
+      ("accuracy_delta", pruned_accuracy - accuracy),
+      ("prediction_agreement", np.mean(predictions == pruned_predictions)),
+      ("examples_per_second", examples_per_second),
+      ("pruned_examples_per_second", pruned_examples_per_second),
+      ("speedup", pruned_examples_per_second / examples_per_second),
+  ])
+
+  output_file = os.path.join(FLAGS.output_dir, "pruning_results.txt")
+  with tf.gfile.GFile(output_file, "w") as writer:
+    tf.logging.info("***** Pruning results *****")
+    for (key, value) in result.items():
+      tf.logging.info("  %s = %s", key, str(value))
+      writer.write("%s = %s\n" % (key, str(value)))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("data_dir")
+  flags.mark_flag_as_required("vocab_file")
+  flags.mark_flag_as_required("bert_config_file")
+  flags.mark_flag_as_required("init_checkpoint")
+  flags.mark_flag_as_required("output_dir")
+  tf.app.run()
@@ -0,0 +1,86 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import numpy as np
+import prune_attention_heads
+import tensorflow as tf
+
+
+class PruneAttentionHeadsTest(tf.test.TestCase):
+
+  def test_select_heads(self):
+    importance = [
+        np.array([0.5, 0.1, 0.9]),
+        np.array([0.2, 0.3, 0.05]),
+    ]
+    kept = prune_attention_heads.select_heads(
+        importance, num_heads_to_prune=3, min_heads_per_layer=1)
+    self.assertAllEqual(kept[0], [0, 2])
+    self.assertAllEqual(kept[1], [1])
+
+    # Each layer keeps two heads, so only two heads can be removed.
+    kept = prune_attention_heads.select_heads(
+        importance, num_heads_to_prune=3, min_heads_per_layer=2)
+    self.assertAllEqual(kept[0], [0, 2])
+    self.assertAllEqual(kept[1], [0, 1])
+    self.assertEqual(kept[0].dtype, np.int64)
+
+  def test_prune_variables(self):
+    hidden_size = 6
+    attention_head_size = 2
+    rng = np.random.RandomState(12345)
+    prefix = "bert/encoder/layer_0/attention/"
+    variables = collections.OrderedDict()
+    for name in ["self/query/kernel", "self/key/kernel", "self/value/kernel",
+                 "output/dense/kernel"]:
+      variables[prefix + name] = rng.normal(
+          size=[hidden_size, hidden_size]).astype(np.float32)
+    variables[prefix + "self/query/bias"] = rng.normal(
+        size=[hidden_size]).astype(np.float32)
+    variables[prefix + "self/query/kernel/adam_m"] = rng.normal(
+        size=[hidden_size, hidden_size]).astype(np.float32)
+    variables[prefix + "output/dense/kernel/adam_v"] = rng.normal(
+        size=[hidden_size, hidden_size]).astype(np.float32)
+    variables[prefix + "output/dense/bias"] = rng.normal(
+        size=[hidden_size]).astype(np.float32)
+    variables["global_step"] = np.array(42, dtype=np.int64)
+
+    # Heads 0 and 2 are kept, i.e. the slices [0, 2) and [4, 6).
+    pruned = prune_attention_heads.prune_variables(
+        variables, [np.array([0, 2])], attention_head_size)
+    indices = [0, 1, 4, 5]
+
+    self.assertEqual(list(pruned.keys()), list(variables.keys()))
+    for name in ["self/query/kernel", "self/key/kernel", "self/value/kernel",
+                 "self/query/kernel/adam_m"]:
+      self.assertAllEqual(pruned[prefix + name],
+                          variables[prefix + name][:, indices])
+    self.assertAllEqual(pruned[prefix + "self/query/bias"],
+                        variables[prefix + "self/query/bias"][indices])
+    for name in ["output/dense/kernel", "output/dense/kernel/adam_v"]:
+      self.assertAllEqual(pruned[prefix + name],
+                          variables[prefix + name][indices])
+    # The output bias and the other variables have no per-head slices.
+    self.assertAllEqual(pruned[prefix + "output/dense/bias"],
+                        variables[prefix + "output/dense/bias"])
+    self.assertAllEqual(pruned["global_step"], variables["global_step"])
+
+
+if __name__ == "__main__":
+  tf.test.main()
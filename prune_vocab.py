@@ -0,0 +1,158 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shrinks the vocabulary of a BERT checkpoint to a target vocab file.
+
+The rows of `bert/embeddings/word_embeddings` and `cls/predictions/output_bias`
+(and of their Adam slots) are gathered so that row `i` of the new checkpoint
+belongs to token `i` of `--target_vocab_file`. Tokens of the target vocab that
+the checkpoint has no row for are initialized from the `[UNK]` row, which is
+what the old model saw for them, and get zero Adam slots.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import checkpoint_utils
+import modeling
+import numpy as np
+import tokenization
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "bert_config_file", None,
+    "The config json file corresponding to the checkpoint.")
+
+flags.DEFINE_string("init_checkpoint", None, "The checkpoint to prune.")
+
+flags.DEFINE_string(
+    "source_vocab_file", None,
+    "The vocabulary file that the rows of the checkpoint correspond to.")
+
+flags.DEFINE_string("target_vocab_file", None,
+                    "The vocabulary file to prune the checkpoint to.")
+
+flags.DEFINE_string(
+    "output_dir", None,
+    "The output directory where bert_config.json and bert_model.ckpt will be "
+    "written.")
+
+flags.DEFINE_string("unk_token", "[UNK]",
+                    "Token whose row initializes tokens that are new.")
+
+# Variables with one row per vocabulary entry.
+VOCAB_VARIABLES = ("bert/embeddings/word_embeddings",
+                   "cls/predictions/output_bias")
+
+
+def create_row_map(source_tokens, target_tokens, unk_token):
+  """Maps each target token to its row in the source vocabulary.
+
+  Args:
+    source_tokens: List of tokens that the checkpoint rows correspond to.
+    target_tokens: List of tokens of the pruned vocabulary.
+    unk_token: Token whose row is used for target tokens missing in the
+      source.
+
+  Returns:
+    A tuple of an int64 array with the source row of each target token, and a
+    bool array that is True for target tokens missing in the source.
+  """
+  # As in `load_vocab`, a token listed twice maps to its last occurrence,
+  # since that is the id the tokenizer produced during training.
+  source_vocab = dict(zip(source_tokens, range(len(source_tokens))))
+  if unk_token not in source_vocab:
+    raise ValueError("`%s` is not in the source vocabulary." % unk_token)
+  unk_row = source_vocab[unk_token]
+
+  rows = np.zeros([len(target_tokens)], dtype=np.int64)
+  is_new = np.zeros([len(target_tokens)], dtype=np.bool_)
+  for (i, token) in enumerate(target_tokens):
+    row = source_vocab.get(token)
+    if row is None:
+      row = unk_row
+      is_new[i] = True
+    rows[i] = row
+  return (rows, is_new)
+
+
+def prune_variables(variables, rows, is_new):
+  """Gathers the vocabulary rows of `variables`, returning a new dict."""
+  pruned = type(variables)()
+  for (name, value) in variables.items():
+    base_name = checkpoint_utils.get_slot_base_name(name)
+    if base_name not in VOCAB_VARIABLES:
+      pruned[name] = value
+      continue
+    value = value[rows]
+    if base_name != name:
+      # New rows start with fresh optimizer moments.
+      value[is_new] = 0
+    pruned[name] = value
+    tf.logging.info("  %s: %s -> %s", name, variables[name].shape,
+                    value.shape)
+  return pruned
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  source_tokens = tokenization.load_vocab_tokens(FLAGS.source_vocab_file)
+  target_tokens = tokenization.load_vocab_tokens(FLAGS.target_vocab_file)
+
+  if len(source_tokens) > bert_config.vocab_size:
+    raise ValueError(
+        "The source vocabulary has %d tokens, but the checkpoint only has %d "
+        "rows (`vocab_size`)." % (len(source_tokens), bert_config.vocab_size))
+
+  (rows, is_new) = create_row_map(source_tokens, target_tokens,
+                                  FLAGS.unk_token)
+  tf.logging.info(
+      "Pruning vocab_size %d to %d (%d target tokens are new and start from "
+      "`%s`)", bert_config.vocab_size, len(target_tokens), np.sum(is_new),
+      FLAGS.unk_token)
+
+  variables = checkpoint_utils.load_variables(FLAGS.init_checkpoint)
+  for name in VOCAB_VARIABLES:
+    if name in variables and (variables[name].shape[0] !=
+                              bert_config.vocab_size):
+      raise ValueError("`%s` has shape %s, which does not match vocab_size %d."
+                       % (name, variables[name].shape, bert_config.vocab_size))
+  variables = prune_variables(variables, rows, is_new)
+
+  bert_config.vocab_size = len(target_tokens)
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+  with tf.gfile.GFile(os.path.join(FLAGS.output_dir, "bert_config.json"),
+                      "w") as writer:
+    writer.write(bert_config.to_json_string())
+  checkpoint = checkpoint_utils.save_variables(
+      variables, os.path.join(FLAGS.output_dir, "bert_model.ckpt"))
+  tf.logging.info("Wrote %s", checkpoint)
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("bert_config_file")
+  flags.mark_flag_as_required("init_checkpoint")
+  flags.mark_flag_as_required("source_vocab_file")
+  flags.mark_flag_as_required("target_vocab_file")
+  flags.mark_flag_as_required("output_dir")
+  tf.app.run()
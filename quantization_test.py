@@ -0,0 +1,135 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import numpy as np
+import quantization
+import tensorflow as tf
+
+
+class QuantizationTest(tf.test.TestCase):
+
+  def test_quantize_per_channel(self):
+    rng = np.random.RandomState(12345)
+    kernel = rng.normal(size=[6, 4]).astype(np.float32)
+    kernel[:, 1] *= 100.0
+    kernel[:, 3] = 0.0
+
+    (values, scale) = quantization.quantize_per_channel(kernel, 1)
+    self.assertEqual(values.dtype, np.int8)
+    self.assertAllEqual(scale.shape, [1, 4])
+    # Each channel has its own scale, so the large channel does not affect
+    # the precision of the others.
+    self.assertAllClose(np.max(np.abs(values), axis=0)[:3], [127, 127, 127])
+    self.assertAllEqual(values[:, 3], np.zeros([6]))
+    self.assertTrue(
+        np.all(
+            np.abs(quantization.dequantize(values, scale) - kernel) <=
+            scale / 2 + 1e-6))
+
+    (values_t, scale_t) = quantization.quantize_per_channel(kernel.T, 0)
+    self.assertAllEqual(values_t, values.T)
+    self.assertAllEqual(scale_t, scale.T)
+
+  def test_select_clip(self):
+    rng = np.random.RandomState(12345)
+    kernel = rng.normal(size=[64, 2]).astype(np.float32)
+    # A single outlier wastes most of the int8 range of channel 0.
+    kernel[0, 0] = 50.0
+    inputs = rng.normal(size=[32, 64]).astype(np.float32)
+    inputs[:, 0] = 0.0
+
+    clip_ratios = [1.0, 0.1]
+    errors = quantization.compute_clip_errors(kernel, 1, inputs, clip_ratios)
+    self.assertAllEqual(errors.shape, [2, 2])
+    clip = quantization.select_clip(kernel, 1, errors, clip_ratios)
+    self.assertAllClose(clip, [5.0, np.max(np.abs(kernel[:, 1]))])
+
+    # The same kernel transposed, as `output_weights` are stored.
+    errors_t = quantization.compute_clip_errors(kernel.T, 0, inputs,
+                                                clip_ratios)
+    self.assertAllClose(errors_t, errors)
+
+  def test_quantize_variables(self):
+    variables = collections.OrderedDict([
+        ("bert/encoder/layer_0/output/dense/kernel",
+         np.ones([3, 2], dtype=np.float32)),
+        ("bert/encoder/layer_0/output/dense/kernel/adam_m",
+         np.ones([3, 2], dtype=np.float32)),
+        ("bert/encoder/layer_0/output/dense/bias",
+         np.ones([2], dtype=np.float32)),
+        ("output_weights", np.ones([2, 3], dtype=np.float32)),
+    ])
+    quantized = quantization.quantize_variables(
+        variables, {
+            "bert/encoder/layer_0/output/dense/kernel": None,
+            "output_weights": None,
+        })
+    self.assertEqual(
+        list(quantized.keys()), [
+            "bert/encoder/layer_0/output/dense/kernel/int8",
+            "bert/encoder/layer_0/output/dense/kernel/scale",
+            "bert/encoder/layer_0/output/dense/bias",
+            "output_weights/int8",
+            "output_weights/scale",
+        ])
+    self.assertAllEqual(quantized["output_weights/scale"].shape, [2, 1])
+
+  def test_quantized_getter(self):
+    rng = np.random.RandomState(12345)
+    kernel = rng.normal(size=[4, 3]).astype(np.float32)
+    (values, scale) = quantization.quantize_per_channel(kernel, 1)
+    inputs = rng.normal(size=[2, 4]).astype(np.float32)
+
+    with self.test_session() as sess:
+      custom_getter = quantization.get_quantized_getter(["layer/dense/kernel"])
+      with tf.variable_scope("layer", custom_getter=custom_getter):
+        output = tf.layers.dense(tf.constant(inputs), 3)
+
+      variables = dict((x.op.name, x) for x in tf.global_variables())
+      self.assertEqual(
+          sorted(variables.keys()), [
+              "layer/dense/bias", "layer/dense/kernel/int8",
+              "layer/dense/kernel/scale"
+          ])
+      self.assertEqual(variables["layer/dense/kernel/int8"].dtype.base_dtype,
+                       tf.int8)
+      self.assertEqual(len(tf.trainable_variables()), 1)
+
+      sess.run(tf.global_variables_initializer())
+      variables["layer/dense/kernel/int8"].load(values, sess)
+      variables["layer/dense/kernel/scale"].load(scale, sess)
+      self.assertAllClose(
+          sess.run(output),
+          np.matmul(inputs, quantization.dequantize(values, scale)),
+          atol=1e-5)
+
+  def test_is_quantizable(self):
+    self.assertTrue(
+        quantization.is_quantizable(
+            "bert/encoder/layer_3/attention/self/query/kernel"))
+    self.assertTrue(quantization.is_quantizable("bert/pooler/dense/kernel"))
+    self.assertTrue(quantization.is_quantizable("output_weights"))
+    self.assertFalse(
+        quantization.is_quantizable("bert/embeddings/word_embeddings"))
+    self.assertFalse(
+        quantization.is_quantizable("bert/encoder/layer_3/output/dense/bias"))
+
+
+if __name__ == "__main__":
+  tf.test.main()
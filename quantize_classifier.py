@@ -0,0 +1,277 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compresses the kernels of a fine-tuned BERTAR classifier to int8.
+
+The dense kernels of the encoder and pooler and the classifier
+`output_weights` are quantized with one scale per output channel. Each
+channel is clipped at the fraction of its largest value (from
+`--calibration_clip_ratios`) that minimizes the error of its matmul outputs on
+a sample of the training data. The quantized checkpoint is then run on the
+test split and compared against the float32 checkpoint.
+
+The kernels are dequantized to float32 before their matmuls (see
+`quantization.py`), so this compresses the checkpoint rather than speeding up
+inference. The examples/sec of both checkpoints are reported next to their
+accuracies to show that.
+
+The other flags (`--data_dir`, `--init_checkpoint`, `--max_seq_length`, ...)
+are those of `run_classifier_discrimination.py`, and `--init_checkpoint` is
+the fine-tuned checkpoint.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import checkpoint_utils
+import modeling
+import numpy as np
+import quantization
+import run_classifier_discrimination
+import tokenization
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    "num_calibration_examples", 256,
+    "Number of training examples that the clipping is calibrated on.")
+
+flags.DEFINE_string(
+    "calibration_clip_ratios", "1.0,0.99,0.98,0.96,0.93,0.9",
+    "Comma-separated clipping ratios to calibrate between. Each output channel "
+    "is clipped at one of these fractions of its largest absolute value.")
+
+
+def get_matmul_inputs(variable):
+  """Finds the tensor that `variable` is multiplied with.
+
+  Args:
+    variable: A kernel variable.
+
+  Returns:
+    The first input of the `MatMul` that the value of `variable` (possibly
+    cast or concatenated with other kernels) is the second input of.
+
+  Raises:
+    ValueError: If no such `MatMul` is found.
+  """
+  stack = [variable.op.outputs[0]]
+  while stack:
+    tensor = stack.pop()
+    for op in tensor.consumers():
+      if op.type == "MatMul" and op.inputs[1] is tensor:
+        return op.inputs[0]
+      if op.type in ("Identity", "Cast", "ConcatV2"):
+        stack.extend(op.outputs)
+  raise ValueError("No MatMul found for %s" % variable.op.name)
+
+
+def calibrate(bert_config, num_labels, features, variables, clip_ratios):
+  """Selects the clip of each kernel from the activations on `features`.
+
+  Args:
+    bert_config: `BertConfig` of the model.
+    num_labels: int. Number of classifier labels.
+    features: List of `InputFeatures` to calibrate on.
+    variables: OrderedDict of the float32 checkpoint variables.
+    clip_ratios: List of clipping ratios to select from.
+
+  Returns:
+    A dict from the name of each kernel to quantize to its per-channel clip.
+  """
+  with tf.Graph().as_default():
+    input_ids = tf.placeholder(tf.int32, [None, FLAGS.max_seq_length])
+    input_mask = tf.placeholder(tf.int32, [None, FLAGS.max_seq_length])
+    segment_ids = tf.placeholder(tf.int32, [None, FLAGS.max_seq_length])
+    label_ids = tf.placeholder(tf.int32, [None])
+    run_classifier_discrimination.create_model(
+        bert_config, False, input_ids, input_mask, segment_ids, label_ids,
+        num_labels, use_one_hot_embeddings=False)
+
+    matmul_inputs = collections.OrderedDict()
+    for variable in tf.global_variables():
+      name = variable.op.name
+      if quantization.is_quantizable(name) and name in variables:
+        matmul_inputs[name] = get_matmul_inputs(variable)
+    tf.logging.info("Calibrating %d kernels on %d examples",
+                    len(matmul_inputs), len(features))
+
+    (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+        tf.global_variables(), FLAGS.init_checkpoint)
+    tf.train.init_from_checkpoint(FLAGS.init_checkpoint, assignment_map)
+
+    errors = {}
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      batch_size = FLAGS.predict_batch_size
+      for start in range(0, len(features), batch_size):
+        batch = features[start:start + batch_size]
+        mask = np.array([x.input_mask for x in batch])
+        results = sess.run(
+            matmul_inputs,
+            feed_dict={
+                input_ids: [x.input_ids for x in batch],
+                input_mask: mask,
+                segment_ids: [x.segment_ids for x in batch],
+                label_ids: [x.label_id for x in batch],
+            })
+        is_token = mask.reshape([-1]) > 0
+        for (name, inputs) in results.items():
+          inputs = inputs.astype(np.float32)
+          if inputs.shape[0] == is_token.shape[0]:
+            # Padding tokens do not affect the predictions.
+            inputs = inputs[is_token]
+          batch_errors = quantization.compute_clip_errors(
+              variables[name], quantization.get_channel_axis(name), inputs,
+              clip_ratios)
+          errors[name] = errors.get(name, 0) + batch_errors
+
+  clips = {}
+  for name in matmul_inputs:
+    clips[name] = quantization.select_clip(
+        variables[name], quantization.get_channel_axis(name), errors[name],
+        clip_ratios)
+  return clips
+
+
+def model_fn_builder(bert_config, num_labels, init_checkpoint,
+                     quantized_names):
+  """Returns a predict-only `model_fn` that reads quantized kernels."""
+
+  def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
+    """The `model_fn` for TPUEstimator."""
+    if mode != tf.estimator.ModeKeys.PREDICT:
+      raise ValueError("Only PREDICT modes are supported: %s" % (mode))
+
+    custom_getter = None
+    if quantized_names:
+      custom_getter = quantization.get_quantized_getter(quantized_names)
+    with tf.variable_scope(
+        tf.get_variable_scope(), custom_getter=custom_getter):
+      (_, _, _, probabilities, _,
+       _) = run_classifier_discrimination.create_model(
+           bert_config, False, features["input_ids"], features["input_mask"],
+           features["segment_ids"], features["label_ids"], num_labels,
+           use_one_hot_embeddings=False)
+
+    # The int8 kernels and their scales are not trainable variables.
+    (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+        tf.global_variables(), init_checkpoint)
+    tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+
+    return tf.contrib.tpu.TPUEstimatorSpec(
+        mode=mode, predictions={"probabilities": probabilities})
+
+  return model_fn
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  processors = {
+      "bertar": run_classifier_discrimination.BERTARProcessor,
+  }
+
+  task_name = FLAGS.task_name.lower()
+  if task_name not in processors:
+    raise ValueError("Task not found: %s" % (task_name))
+
+  processor = processors[task_name]()
+  label_list = processor.get_labels()
+
+  bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+  clip_ratios = [float(x) for x in FLAGS.calibration_clip_ratios.split(",")]
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+
+  calibration_examples = processor.get_train_examples(FLAGS.data_dir)
+  calibration_examples = calibration_examples[:FLAGS.num_calibration_examples]
+  calibration_features = (
+      run_classifier_discrimination.convert_examples_to_features(
+          calibration_examples, label_list, FLAGS.max_seq_length, tokenizer))
+
+  variables = checkpoint_utils.load_variables(FLAGS.init_checkpoint)
+  clips = calibrate(bert_config, len(label_list), calibration_features,
+                    variables, clip_ratios)
+  quantized_variables = quantization.quantize_variables(variables, clips)
+
+  with tf.gfile.GFile(os.path.join(FLAGS.output_dir, "bert_config.json"),
+                      "w") as writer:
+    writer.write(bert_config.to_json_string())
+  quantized_checkpoint = checkpoint_utils.save_variables(
+      quantized_variables, os.path.join(FLAGS.output_dir, "model.ckpt"))
+  tf.logging.info("Wrote %s", quantized_checkpoint)
+
+  test_examples = processor.get_test_examples(FLAGS.data_dir)
+  label_ids = np.array([label_list.index(x.label) for x in test_examples])
+  predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+  run_classifier_discrimination.file_based_convert_examples_to_features(
+      test_examples, label_list, FLAGS.max_seq_length, tokenizer, predict_file)
+
+  (float_predictions, float_examples_per_second) = (
+      run_classifier_discrimination.predict_label_ids(
+          bert_config, len(label_list), FLAGS.init_checkpoint, predict_file,
+          FLAGS.max_seq_length, FLAGS.predict_batch_size,
+          model_fn=model_fn_builder(bert_config, len(label_list),
+                                    FLAGS.init_checkpoint, [])))
+  (int8_predictions, int8_examples_per_second) = (
+      run_classifier_discrimination.predict_label_ids(
+          bert_config, len(label_list), quantized_checkpoint, predict_file,
+          FLAGS.max_seq_length, FLAGS.predict_batch_size,
+          model_fn=model_fn_builder(bert_config, len(label_list),
+                                    quantized_checkpoint, list(clips.keys()))))
+
+  float_accuracy = np.mean(float_predictions == label_ids)
+  int8_accuracy = np.mean(int8_predictions == label_ids)
+  result = collections.OrderedDict([
+      ("num_test_examples", len(test_examples)),
+      ("num_quantized_kernels", len(clips)),
+      ("float32_kernel_bytes", sum(variables[x].nbytes for x in clips)),
+      ("int8_kernel_bytes",
+       sum(quantized_variables[x + quantization.INT8_SUFFIX].nbytes +
+           quantized_variables[x + quantization.SCALE_SUFFIX].nbytes
+           for x in clips)),
+      ("float32_accuracy", float_accuracy),
+      ("int8_accuracy", int8_accuracy),
+      ("accuracy_delta", int8_accuracy - float_accuracy),
+      ("prediction_agreement", np.mean(float_predictions == int8_predictions)),
+      ("float32_examples_per_second", float_examples_per_second),
+      ("int8_examples_per_second", int8_examples_per_second),
+      ("int8_speedup", (int8_examples_per_second / float_examples_per_second
+                        if float_examples_per_second else 0.0)),
+  ])
+
+  output_file = os.path.join(FLAGS.output_dir, "quantization_results.txt")
+  with tf.gfile.GFile(output_file, "w") as writer:
+    tf.logging.info("***** Quantization results *****")
+    for (key, value) in result.items():
+      tf.logging.info("  %s = %s", key, str(value))
+      writer.write("%s = %s\n" % (key, str(value)))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("data_dir")
+  flags.mark_flag_as_required("vocab_file")
+  flags.mark_flag_as_required("bert_config_file")
+  flags.mark_flag_as_required("init_checkpoint")
+  flags.mark_flag_as_required("output_dir")
+  tf.app.run()
@@ -6,13 +6,20 @@ from __future__ import print_function
 
 import collections
 import csv
+import json
 import os
+import bucketing
+import losses
 import modeling
 import optimization
 import tokenization
+import windowing
 import random
+import time
 import nltk
+import numpy as np
 import tensorflow as tf
+from tensorflow.python.grappler import tf_optimizer
 
 
 nltk.download('punkt')
@@ -72,6 +79,67 @@ flags.DEFINE_integer("eval_batch_size", 8, "Total batch size for eval.")
 
 flags.DEFINE_integer("predict_batch_size", 8, "Total batch size for predict.")
 
+flags.DEFINE_string(
+    "predict_bucket_lengths", None,
+    "Comma-separated sequence lengths, e.g. 16,32,64. If set, prediction "
+    "groups examples by length and runs each group at the shortest of these "
+    "lengths that fits it, instead of padding every example to "
+    "`max_seq_length`. The output order is unchanged.")
+
+flags.DEFINE_bool(
+    "predict_remove_padding", False,
+    "Whether the encoder skips padding tokens in its dense layers during "
+    "prediction. CPU/GPU only.")
+
+flags.DEFINE_bool(
+    "predict_fold_embeddings", False,
+    "Whether prediction adds the position and token type embeddings with a "
+    "single gather from a table of their sums that is computed once after "
+    "the checkpoint is restored. CPU/GPU only.")
+
+flags.DEFINE_integer(
+    "predict_window_stride", 0,
+    "If positive, prediction splits texts longer than `max_seq_length` into "
+    "overlapping windows whose starts are this many tokens apart instead of "
+    "truncating them, and aggregates the probabilities of the windows of "
+    "each text. The windows of all texts are batched together.")
+
+flags.DEFINE_string(
+    "predict_window_aggregation", "mean",
+    "How the probabilities of the windows of a text are aggregated: \"mean\", "
+    "\"max\" or \"attention\" (weighted towards the confident windows).")
+
+flags.DEFINE_bool(
+    "predict_window_baseline", False,
+    "Whether prediction with `predict_window_stride` also predicts the "
+    "truncated texts, as without windows, in a separately timed pass, and "
+    "compares their accuracy and examples per second in "
+    "`window_results.txt`. This runs the model twice.")
+
+flags.DEFINE_string(
+    "export_dir", None,
+    "If set, the classifier (the fine-tuned checkpoint in `output_dir`, or "
+    "else `init_checkpoint`) is exported to this directory as a frozen and "
+    "optimized SavedModel for serving. It must not exist yet.")
+
+flags.DEFINE_string(
+    "early_exit_layers", None,
+    "Comma-separated indexes (from 0) of the encoder layers that get an "
+    "early-exit classifier, e.g. 3,6,9. The exit classifiers are trained "
+    "together with the model.")
+
+flags.DEFINE_bool(
+    "early_exit_distill", False,
+    "Whether the early-exit classifiers are trained to match the predictions "
+    "of the final classifier instead of the labels. Their gradients then do "
+    "not reach the encoder, so exits can be added to a fine-tuned model.")
+
+flags.DEFINE_float(
+    "early_exit_threshold", 0.0,
+    "During prediction, an example stops at the first early-exit classifier "
+    "whose largest probability is at least this. 0 disables early exit. "
+    "CPU/GPU only.")
+
 flags.DEFINE_float("learning_rate", 5e-5, "The initial learning rate for Adam.")
 
 flags.DEFINE_float("num_train_epochs", 3.0,
@@ -91,7 +159,9 @@ flags.DEFINE_integer("iterations_per_loop", 1000,
 flags.DEFINE_bool("use_tpu", True, "Whether to use TPU or GPU/CPU.")
 
 tf.flags.DEFINE_string(
-    "tpu_name", 'grpc://' + os.environ['COLAB_TPU_ADDR'],
+    "tpu_name",
+    ('grpc://' + os.environ['COLAB_TPU_ADDR']
+     if 'COLAB_TPU_ADDR' in os.environ else None),
     "The Cloud TPU to use for training. This should be either the name "
     "used when creating the Cloud TPU, or a grpc://ip.address.of.tpu:8470 "
     "url.")
@@ -199,43 +269,10 @@ class BERTARProcessor(DataProcessor):
   def get_train_examples(self, data_dir):
     """See base class."""
     examples = []
-    with tf.gfile.GFile(data_dir+"machine.train.txt.balanced", "r") as reader:
-      i = 0
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-        guid = "train-machine-%d" % (i)
-        text_b = None
-        text_a = tokenization.convert_to_unicode(line)
-        if len(text_a.split(" ")) > FLAGS.max_seq_length:
-            temp = nltk.tokenize.sent_tokenize(text_a)
-            if(len(temp)>=2):
-              text_a = " ".join(temp[:int(len(temp)/2)])
-              text_b = " ".join(temp[int(len(temp)/2):])
-        label = tokenization.convert_to_unicode("machine")
-        examples.append(
-            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-
-    with tf.gfile.GFile(data_dir+"human.train.txt.balanced", "r") as reader:
-      i = 0
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-        guid = "train-human-%d" % (i)
-        text_b = None
-        text_a = tokenization.convert_to_unicode(line)
-        if len(text_a.split(" ")) > FLAGS.max_seq_length:
-            temp = nltk.tokenize.sent_tokenize(text_a)
-            if(len(temp)>=2):
-              text_a = " ".join(temp[:int(len(temp)/2)])
-              text_b = " ".join(temp[int(len(temp)/2):])
-        label = tokenization.convert_to_unicode("human")
-        examples.append(
-            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+    examples.extend(self._create_examples(
+        data_dir+"machine.train.txt.balanced", "train", "machine"))
+    examples.extend(self._create_examples(
+        data_dir+"human.train.txt.balanced", "train", "human"))
     
     random.shuffle(examples)
     return examples
@@ -243,49 +280,42 @@ class BERTARProcessor(DataProcessor):
   def get_test_examples(self, data_dir):
     """See base class."""
     examples = []
-    with tf.gfile.GFile(data_dir+"machine.test.txt.balanced", "r") as reader:
-      i = 0
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-        guid = "test-machine-%d" % (i)
-        text_b = None
-        text_a = tokenization.convert_to_unicode(line)
-        if len(text_a.split(" ")) > FLAGS.max_seq_length:
-            temp = nltk.tokenize.sent_tokenize(text_a)
-            if(len(temp)>=2):
-              text_a = " ".join(temp[:int(len(temp)/2)])
-              text_b = " ".join(temp[int(len(temp)/2):])
-        label = tokenization.convert_to_unicode("machine")
-        examples.append(
-            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-
-    with tf.gfile.GFile(data_dir+"human.test.txt.unbalanced.new", "r") as reader:
-      i = 0
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-        guid = "test-human-%d" % (i)
-        text_b = None
-        text_a = tokenization.convert_to_unicode(line)
-        if len(text_a.split(" ")) > FLAGS.max_seq_length:
-            temp = nltk.tokenize.sent_tokenize(text_a)
-            if(len(temp)>=2):
-              text_a = " ".join(temp[:int(len(temp)/2)])
-              text_b = " ".join(temp[int(len(temp)/2):])
-        label = tokenization.convert_to_unicode("human")
-        examples.append(
-            InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+    examples.extend(self._create_examples(
+        data_dir+"machine.test.txt.balanced", "test", "machine"))
+    examples.extend(self._create_examples(
+        data_dir+"human.test.txt.unbalanced.new", "test", "human"))
+    return examples
+
+  def _create_examples(self, input_file, set_type, label):
+    """Creates examples with a single label from a file of one text per line."""
+    examples = []
+    for (i, line) in enumerate(tokenization.read_lines(input_file)):
+      guid = "%s-%s-%d" % (set_type, label, i)
+      examples.append(
+          create_example(guid, line, label, FLAGS.max_seq_length))
     return examples
 
   def get_labels(self):
     """See base class."""
     return ["machine", "human"]
 
+
+def create_example(guid, text, label, max_seq_length):
+  """Creates the `InputExample` of a text as `BERTARProcessor` does.
+
+  A text of more than `max_seq_length` words is split into a pair at the
+  middle of its sentences.
+  """
+  text_b = None
+  text_a = text.strip()
+  if len(text_a.split(" ")) > max_seq_length:
+    sentences = nltk.tokenize.sent_tokenize(text_a)
+    if len(sentences) >= 2:
+      text_a = " ".join(sentences[:len(sentences) // 2])
+      text_b = " ".join(sentences[len(sentences) // 2:])
+  return InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
+
+
 def convert_single_example(ex_index, example, label_list, max_seq_length,
                            tokenizer):
   """Converts a single `InputExample` into a single `InputFeatures`."""
@@ -335,38 +365,22 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   # For classification tasks, the first vector (corresponding to [CLS]) is
   # used as the "sentence vector". Note that this only makes sense because
   # the entire model is fine-tuned.
-  tokens = []
-  segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
-
+  tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
+  num_tokens_a = len(tokens)
   if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
+    tokens += tokens_b + ["[SEP]"]
 
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
+  # The features are zero-padded up to the sequence length.
+  input_ids = np.zeros(max_seq_length, dtype=np.int32)
+  input_ids[:len(tokens)] = tokenizer.convert_tokens_to_ids_array(tokens)
 
   # The mask has 1 for real tokens and 0 for padding tokens. Only real
   # tokens are attended to.
-  input_mask = [1] * len(input_ids)
-
-  # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
+  input_mask = np.zeros(max_seq_length, dtype=np.int32)
+  input_mask[:len(tokens)] = 1
 
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
+  segment_ids = np.zeros(max_seq_length, dtype=np.int32)
+  segment_ids[num_tokens_a:len(tokens)] = 1
 
   label_id = label_map[example.label]
   if ex_index < 5:
@@ -388,6 +402,45 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   return feature
 
 
+def convert_example_to_windows(ex_index, example, label_list, max_seq_length,
+                               stride, tokenizer):
+  """Converts an `InputExample` into the `InputFeatures` of its windows.
+
+  The tokens of `text_a` and `text_b` are concatenated and split into windows
+  of `max_seq_length - 2` tokens whose starts are `stride` tokens apart (see
+  `windowing.get_window_starts`). Each window is a single sequence, even if
+  `BERTARProcessor` split the text into a pair, which `convert_single_example`
+  encodes as two segments that are both truncated.
+  """
+  label_map = {}
+  for (i, label) in enumerate(label_list):
+    label_map[label] = i
+
+  tokens = tokenizer.tokenize(example.text_a)
+  if example.text_b:
+    tokens.extend(tokenizer.tokenize(example.text_b))
+
+  features = []
+  window_length = max_seq_length - 2
+  for start in windowing.get_window_starts(len(tokens), window_length, stride):
+    window_tokens = ["[CLS]"] + tokens[start:start + window_length] + ["[SEP]"]
+    input_ids = tokenizer.convert_tokens_to_ids(window_tokens)
+    input_mask = [1] * len(input_ids)
+    padding = [0] * (max_seq_length - len(input_ids))
+    features.append(
+        InputFeatures(
+            input_ids=input_ids + padding,
+            input_mask=input_mask + padding,
+            segment_ids=[0] * max_seq_length,
+            label_id=label_map[example.label],
+            is_real_example=True))
+
+  if ex_index < 5:
+    tf.logging.info("guid: %s, %d tokens in %d windows" %
+                    (example.guid, len(tokens), len(features)))
+  return features
+
+
 def file_based_convert_examples_to_features(
     examples, label_list, max_seq_length, tokenizer, output_file):
   """Convert a set of `InputExample`s to a TFRecord file."""
@@ -401,26 +454,146 @@ def file_based_convert_examples_to_features(
     feature = convert_single_example(ex_index, example, label_list,
                                      max_seq_length, tokenizer)
 
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
-
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(feature.input_ids)
-    features["input_mask"] = create_int_feature(feature.input_mask)
-    features["segment_ids"] = create_int_feature(feature.segment_ids)
-    features["label_ids"] = create_int_feature([feature.label_id])
-    features["is_real_example"] = create_int_feature(
-        [int(feature.is_real_example)])
-
-    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+    tf_example = create_tf_example(feature, max_seq_length)
     writer.write(tf_example.SerializeToString())
   writer.close()
 
 
+def create_tf_example(feature, seq_length):
+  """Converts an `InputFeatures` to a `tf.train.Example`.
+
+  Features padded to a longer length are truncated to `seq_length`, which must
+  not be shorter than their real length.
+  """
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(feature.input_ids[:seq_length])
+  features["input_mask"] = create_int_feature(feature.input_mask[:seq_length])
+  features["segment_ids"] = create_int_feature(
+      feature.segment_ids[:seq_length])
+  features["label_ids"] = create_int_feature([feature.label_id])
+  features["is_real_example"] = create_int_feature(
+      [int(feature.is_real_example)])
+
+  return tf.train.Example(features=tf.train.Features(feature=features))
+
+
+def file_based_predict_by_length(estimator, examples, label_list,
+                                 max_seq_length, bucket_lengths, tokenizer,
+                                 output_dir):
+  """Runs `estimator` on `examples` with one predict call per length bucket.
+
+  Each bucket is written to its own TFRecord file in `output_dir`. On TPU,
+  buckets are padded to a multiple of `FLAGS.predict_batch_size`.
+
+  Yields:
+    The prediction dict of each example, in the order of `examples`.
+  """
+  features = []
+  for (ex_index, example) in enumerate(examples):
+    features.append(
+        convert_single_example(ex_index, example, label_list, max_seq_length,
+                               tokenizer))
+  return file_based_predict_features_by_length(
+      estimator, features, label_list, bucket_lengths, tokenizer, output_dir)
+
+
+def file_based_predict_features_by_length(estimator, features, label_list,
+                                          bucket_lengths, tokenizer,
+                                          output_dir):
+  """Runs `estimator` on `InputFeatures` with one call per length bucket.
+
+  See `file_based_predict_by_length`.
+
+  Yields:
+    The prediction dict of each of `features`, in order.
+  """
+  lengths = [sum(feature.input_mask) for feature in features]
+  buckets = bucketing.bucket_by_length(lengths, bucket_lengths)
+
+  def indexed_results():
+    for (seq_length, indexes) in buckets.items():
+      predict_file = os.path.join(output_dir,
+                                  "predict_%d.tf_record" % seq_length)
+      writer = tf.python_io.TFRecordWriter(predict_file)
+      num_records = 0
+      for index in indexes:
+        writer.write(
+            create_tf_example(features[index], seq_length).SerializeToString())
+        num_records += 1
+      if FLAGS.use_tpu:
+        padding_feature = convert_single_example(
+            0, PaddingInputExample(), label_list, seq_length, tokenizer)
+        while num_records % FLAGS.predict_batch_size != 0:
+          writer.write(create_tf_example(padding_feature,
+                                         seq_length).SerializeToString())
+          num_records += 1
+      writer.close()
+
+      tf.logging.info("  Predicting %d examples at sequence length %d",
+                      len(indexes), seq_length)
+      predict_input_fn = file_based_input_fn_builder(
+          input_file=predict_file,
+          seq_length=seq_length,
+          is_training=False,
+          drop_remainder=FLAGS.use_tpu)
+      results = estimator.predict(input_fn=predict_input_fn)
+      for (index, result) in zip(indexes, results):
+        yield (index, result)
+
+  return bucketing.restore_order(indexed_results())
+
+
+def file_based_predict_windows(estimator, examples, label_list,
+                               max_seq_length, stride, aggregation,
+                               bucket_lengths, tokenizer, output_dir):
+  """Predicts each example from the predictions of its windows.
+
+  The windows of all examples (see `convert_example_to_windows`) are predicted
+  in batches, by length bucket as in `file_based_predict_by_length`.
+
+  Yields:
+    The prediction dict of each example, in the order of `examples`. Its
+    "probabilities" are those of its windows aggregated with `aggregation`
+    (see `windowing.aggregate_probabilities`), and its other values are
+    averaged over its windows. It also has the "num_windows" of the example.
+  """
+  features = []
+  document_indexes = []
+  for (ex_index, example) in enumerate(examples):
+    windows = convert_example_to_windows(ex_index, example, label_list,
+                                         max_seq_length, stride, tokenizer)
+    features.extend(windows)
+    document_indexes.extend([ex_index] * len(windows))
+  tf.logging.info("  Num windows = %d", len(features))
+
+  results = file_based_predict_features_by_length(
+      estimator, features, label_list, bucket_lengths, tokenizer, output_dir)
+  for (_, window_results) in windowing.group_windows(document_indexes,
+                                                     results):
+    prediction = {}
+    for key in window_results[0]:
+      values = [x[key] for x in window_results]
+      if key == "probabilities":
+        prediction[key] = windowing.aggregate_probabilities(values,
+                                                            aggregation)
+      else:
+        prediction[key] = sum(values) / len(values)
+    prediction["num_windows"] = len(window_results)
+    yield prediction
+
+
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                                drop_remainder, extra_name_to_features=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  `extra_name_to_features` optionally maps the names of additional features
+  of the records to their `tf.FixedLenFeature`.
+  """
 
   name_to_features = {
       "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
@@ -429,6 +602,8 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
       "label_ids": tf.FixedLenFeature([], tf.int64),
       "is_real_example": tf.FixedLenFeature([], tf.int64),
   }
+  if extra_name_to_features:
+    name_to_features.update(extra_name_to_features)
 
   def _decode_record(record, name_to_features):
     """Decodes a record to a TensorFlow example."""
@@ -466,6 +641,66 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
   return input_fn
 
 
+class _SessionStartHook(tf.train.SessionRunHook):
+  """Records when the session is created and the checkpoint is restored."""
+
+  def __init__(self):
+    self.start_time = None
+
+  def after_create_session(self, session, coord):
+    self.start_time = time.time()
+
+
+def predict_label_ids(bert_config, num_labels, init_checkpoint, predict_file,
+                      seq_length, batch_size, model_fn=None):
+  """Predicts the label ids of the examples in `predict_file` on the CPU/GPU.
+
+  Args:
+    bert_config: `BertConfig` of the classifier.
+    num_labels: int. Number of labels.
+    init_checkpoint: The classifier checkpoint.
+    predict_file: TFRecord file of the examples.
+    seq_length: int. Sequence length of the examples.
+    batch_size: int. Prediction batch size.
+    model_fn: (optional) `model_fn` to run instead of that of
+      `model_fn_builder`. Its predictions must have the "probabilities".
+
+  Returns:
+    A tuple of an int64 array of the predicted label ids and the examples per
+    second. The time starts once the session is created, so it excludes
+    building the graph and loading the checkpoint.
+  """
+  if model_fn is None:
+    model_fn = model_fn_builder(
+        bert_config=bert_config,
+        num_labels=num_labels,
+        init_checkpoint=init_checkpoint,
+        learning_rate=0.0,
+        num_train_steps=None,
+        num_warmup_steps=None,
+        use_tpu=False,
+        use_one_hot_embeddings=False)
+  estimator = tf.contrib.tpu.TPUEstimator(
+      use_tpu=False,
+      model_fn=model_fn,
+      config=tf.contrib.tpu.RunConfig(),
+      predict_batch_size=batch_size)
+  input_fn = file_based_input_fn_builder(
+      input_file=predict_file,
+      seq_length=seq_length,
+      is_training=False,
+      drop_remainder=False)
+
+  start_hook = _SessionStartHook()
+  predictions = [
+      np.argmax(x["probabilities"])
+      for x in estimator.predict(input_fn=input_fn, hooks=[start_hook])
+  ]
+  seconds = time.time() - start_hook.start_time
+  examples_per_second = len(predictions) / seconds if seconds > 0 else 0.0
+  return (np.array(predictions, dtype=np.int64), examples_per_second)
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
   """Truncates a sequence pair in place to the maximum length."""
 
@@ -483,16 +718,86 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
       tokens_b.pop()
 
 
+def create_exit_logits(bert_config, is_training, layer_output, num_labels):
+  """Creates an early-exit classifier on the output of an encoder layer."""
+  first_token_tensor = tf.cast(
+      tf.squeeze(layer_output[:, 0:1, :], axis=1), tf.float32)
+  pooled_output = tf.layers.dense(
+      first_token_tensor,
+      bert_config.hidden_size,
+      activation=tf.tanh,
+      kernel_initializer=modeling.create_initializer(
+          bert_config.initializer_range),
+      name="pooler")
+
+  output_weights = tf.get_variable(
+      "output_weights", [num_labels, bert_config.hidden_size],
+      initializer=tf.truncated_normal_initializer(stddev=0.02))
+
+  output_bias = tf.get_variable(
+      "output_bias", [num_labels], initializer=tf.zeros_initializer())
+
+  if is_training:
+    # I.e., 0.1 dropout
+    pooled_output = tf.nn.dropout(pooled_output, keep_prob=0.9)
+
+  logits = tf.matmul(pooled_output, output_weights, transpose_b=True)
+  return tf.nn.bias_add(logits, output_bias)
+
+
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels, use_one_hot_embeddings):
-  """Creates a classification model."""
+                 labels, num_labels, use_one_hot_embeddings,
+                 remove_padding=False, early_exit_layers=None,
+                 early_exit_threshold=0.0, early_exit_distill=False,
+                 output_layers=None, fold_embeddings=False):
+  """Creates a classification model.
+
+  With `early_exit_layers`, a classifier is also attached to each of these
+  encoder layers. In training their losses are added to the loss. With an
+  `early_exit_threshold`, each example stops at the first of them that is
+  confident enough, and its logits and probabilities come from that
+  classifier.
+
+  The last returned value is the list of the outputs of the encoder layers in
+  `output_layers` (see `BertModel`), which is empty by default.
+  """
+  batch_size = modeling.get_shape_list(input_ids, expected_rank=2)[0]
+  root_scope = tf.get_variable_scope()
+  # (logits, example_indices, exited) of each early-exit classifier.
+  exits = []
+
+  def early_exit_fn(layer_index, layer_output, example_indices):
+    """Runs the early-exit classifier of `layer_index`, if there is one."""
+    if layer_index not in early_exit_layers:
+      return None
+    if early_exit_distill:
+      layer_output = tf.stop_gradient(layer_output)
+    # The classifiers are not part of "bert/encoder".
+    with tf.variable_scope(root_scope, auxiliary_name_scope=False):
+      with tf.variable_scope("early_exit/layer_%d" % layer_index):
+        exit_logits = create_exit_logits(bert_config, is_training,
+                                         layer_output, num_labels)
+    exited = None
+    if early_exit_threshold > 0:
+      exit_probabilities = tf.nn.softmax(exit_logits, axis=-1)
+      exited = tf.greater_equal(
+          tf.reduce_max(exit_probabilities, axis=-1), early_exit_threshold)
+    exits.append((exit_logits, example_indices, exited))
+    return exited
+
+  use_early_exit = early_exit_layers and (is_training or
+                                          early_exit_threshold > 0)
   model = modeling.BertModel(
       config=bert_config,
       is_training=is_training,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      use_one_hot_embeddings=use_one_hot_embeddings)
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      remove_padding=remove_padding,
+      early_exit_fn=early_exit_fn if use_early_exit else None,
+      output_layers=output_layers or [],
+      fold_embeddings=fold_embeddings)
 
   # In the demo, we are doing a simple classification task on the entire
   # segment.
@@ -517,20 +822,44 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
 
     logits = tf.matmul(output_layer, output_weights, transpose_b=True)
     logits = tf.nn.bias_add(logits, output_bias)
-    probabilities = tf.nn.softmax(logits, axis=-1)
-    log_probs = tf.nn.log_softmax(logits, axis=-1)
 
-    one_hot_labels = tf.one_hot(labels, depth=num_labels, dtype=tf.float32)
+    exit_losses = []
+    for (exit_logits, example_indices, exited) in exits:
+      if exited is not None:
+        # Use the logits of the examples that stopped at this classifier.
+        exit_rows = tf.where(exited)[:, 0]
+        exit_indices = tf.gather(example_indices, exit_rows)
+        is_exit = modeling.unpack_rows(
+            tf.ones_like(exit_indices), exit_indices, batch_size) > 0
+        logits = tf.where(
+            is_exit,
+            modeling.unpack_rows(
+                tf.gather(exit_logits, exit_rows), exit_indices, batch_size),
+            logits)
+      elif early_exit_distill:
+        exit_losses.append(-tf.reduce_sum(
+            tf.stop_gradient(tf.nn.softmax(logits, axis=-1)) *
+            tf.nn.log_softmax(exit_logits, axis=-1),
+            axis=-1))
+      else:
+        exit_losses.append(losses.sparse_softmax_loss(exit_logits, labels))
+
+    probabilities = tf.nn.softmax(logits, axis=-1)
 
-    per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
+    per_example_loss = losses.sparse_softmax_loss(logits, labels)
     loss = tf.reduce_mean(per_example_loss)
+    for exit_loss in exit_losses:
+      loss += tf.reduce_mean(exit_loss)
 
-    return (loss, per_example_loss, logits, probabilities)
+    return (loss, per_example_loss, logits, probabilities,
+            model.get_num_layers(), model.get_all_encoder_layers())
 
 
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, predict_remove_padding=False,
+                     early_exit_layers=None, early_exit_threshold=0.0,
+                     early_exit_distill=False, predict_fold_embeddings=False):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -552,9 +881,16 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
 
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
-    (total_loss, per_example_loss, logits, probabilities) = create_model(
-        bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
-        num_labels, use_one_hot_embeddings)
+    is_predict = (mode == tf.estimator.ModeKeys.PREDICT)
+    (total_loss, per_example_loss, logits, probabilities, num_layers,
+     _) = create_model(
+         bert_config, is_training, input_ids, input_mask, segment_ids,
+         label_ids, num_labels, use_one_hot_embeddings,
+         remove_padding=predict_remove_padding and is_predict,
+         early_exit_layers=early_exit_layers,
+         early_exit_threshold=early_exit_threshold if is_predict else 0.0,
+         early_exit_distill=early_exit_distill,
+         fold_embeddings=predict_fold_embeddings and is_predict)
 
     tvars = tf.trainable_variables()
     initialized_variable_names = {}
@@ -611,15 +947,153 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
           eval_metrics=eval_metrics,
           scaffold_fn=scaffold_fn)
     else:
+      predictions = {"probabilities": probabilities}
+      if early_exit_layers:
+        predictions["num_layers"] = num_layers
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
           mode=mode,
-          predictions={"probabilities": probabilities},
+          predictions=predictions,
           scaffold_fn=scaffold_fn)
     return output_spec
 
   return model_fn
 
 
+# The inputs of the serving signature of `export_saved_model`, each of shape
+# [batch_size, seq_length].
+SERVING_INPUT_NAMES = ("input_ids", "input_mask", "segment_ids")
+
+# The optimizations of `optimize_graph_def`. The layout and remapping (op
+# fusion) optimizations depend on the device, so they are left to the session
+# that loads the SavedModel.
+EXPORT_GRAPPLER_OPTIMIZERS = ("pruning", "constfold", "arithmetic",
+                              "dependency", "loop")
+
+
+def optimize_graph_def(graph_def, output_names):
+  """Optimizes a frozen `graph_def` with Grappler.
+
+  Args:
+    graph_def: `GraphDef` without variables.
+    output_names: List of the names of the nodes to keep. Nodes that they do
+      not depend on are removed.
+
+  Returns:
+    The optimized `GraphDef`.
+  """
+  with tf.Graph().as_default() as graph:
+    tf.import_graph_def(graph_def, name="")
+    # Grappler keeps the nodes in the "train_op" collection.
+    for name in output_names:
+      graph.add_to_collection("train_op", graph.get_operation_by_name(name))
+    meta_graph = tf.train.export_meta_graph(graph=graph)
+
+  config = tf.ConfigProto()
+  rewrite_options = config.graph_options.rewrite_options
+  rewrite_options.optimizers.extend(EXPORT_GRAPPLER_OPTIMIZERS)
+  rewrite_options.meta_optimizer_iterations = 2
+  return tf_optimizer.OptimizeGraph(config, meta_graph)
+
+
+def export_saved_model(bert_config, label_list, checkpoint, export_dir,
+                       remove_padding=False, early_exit_layers=None,
+                       early_exit_threshold=0.0):
+  """Exports the classifier as a frozen and optimized SavedModel.
+
+  The default serving signature takes the `SERVING_INPUT_NAMES` int32 inputs
+  of shape [batch_size, seq_length], where both dimensions may change between
+  calls, and returns the `probabilities` of shape [batch_size, num_labels].
+  The model is built for inference, so it has no dropout, and its position
+  and token type embeddings are folded. The variables of `checkpoint` are
+  frozen into constants and the graph is optimized with `optimize_graph_def`.
+
+  Texts are tokenized outside of the graph, so the vocabulary and
+  `serving_config.json` (`do_lower_case`, `max_seq_length` and `labels`) are
+  written to `assets.extra/`.
+
+  Args:
+    bert_config: `BertConfig` of the model.
+    label_list: List of the label strings.
+    checkpoint: The fine-tuned checkpoint to export.
+    export_dir: The directory to write the SavedModel to. It must not exist.
+    remove_padding: See `create_model`.
+    early_exit_layers: See `create_model`.
+    early_exit_threshold: See `create_model`.
+
+  Raises:
+    ValueError: If `bert_config` has a positive `attention_window_size`,
+      which needs a sequence length that is known when the graph is built.
+  """
+  if bert_config.attention_window_size > 0:
+    raise ValueError(
+        "Cannot export a model with `attention_window_size` (%d), which needs "
+        "a fixed sequence length." % bert_config.attention_window_size)
+
+  with tf.Graph().as_default() as graph:
+    inputs = [
+        tf.placeholder(tf.int32, [None, None], name=name)
+        for name in SERVING_INPUT_NAMES
+    ]
+    (input_ids, input_mask, segment_ids) = inputs
+    (_, _, _, probabilities, _, _) = create_model(
+        bert_config, False, input_ids, input_mask, segment_ids,
+        tf.zeros_like(input_ids[:, 0]), len(label_list),
+        use_one_hot_embeddings=False,
+        remove_padding=remove_padding,
+        early_exit_layers=early_exit_layers,
+        early_exit_threshold=early_exit_threshold,
+        fold_embeddings=True)
+    probabilities = tf.identity(probabilities, name="probabilities")
+
+    (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+        tf.global_variables(), checkpoint)
+    tf.train.init_from_checkpoint(checkpoint, assignment_map)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      # The folded embeddings are computed from the restored variables.
+      sess.run(tf.local_variables_initializer())
+      graph_def = tf.graph_util.convert_variables_to_constants(
+          sess, graph.as_graph_def(), [probabilities.op.name])
+
+  num_nodes = len(graph_def.node)
+  graph_def = optimize_graph_def(graph_def, [probabilities.op.name])
+  tf.logging.info("Optimized the frozen graph from %d to %d nodes", num_nodes,
+                  len(graph_def.node))
+
+  builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+  with tf.Graph().as_default() as graph:
+    tf.import_graph_def(graph_def, name="")
+    signature = tf.saved_model.signature_def_utils.predict_signature_def(
+        inputs={
+            name: graph.get_tensor_by_name(name + ":0")
+            for name in SERVING_INPUT_NAMES
+        },
+        outputs={
+            "probabilities": graph.get_tensor_by_name(probabilities.name)
+        })
+    with tf.Session() as sess:
+      builder.add_meta_graph_and_variables(
+          sess, [tf.saved_model.tag_constants.SERVING],
+          signature_def_map={
+              tf.saved_model.signature_constants
+              .DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature
+          })
+  builder.save()
+
+  assets_dir = os.path.join(export_dir, "assets.extra")
+  tf.gfile.MakeDirs(assets_dir)
+  tf.gfile.Copy(FLAGS.vocab_file, os.path.join(assets_dir, "vocab.txt"))
+  serving_config = collections.OrderedDict([
+      ("do_lower_case", FLAGS.do_lower_case),
+      ("max_seq_length", FLAGS.max_seq_length),
+      ("labels", label_list),
+  ])
+  with tf.gfile.GFile(os.path.join(assets_dir, "serving_config.json"),
+                      "w") as writer:
+    writer.write(json.dumps(serving_config, indent=2) + "\n")
+  tf.logging.info("Exported the SavedModel to %s", export_dir)
+
+
 # This function is not used by this file but is still used by the Colab and
 # people who depend on it.
 def input_fn_builder(features, seq_length, is_training, drop_remainder):
@@ -702,9 +1176,11 @@ def main(_):
   tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case,
                                                 FLAGS.init_checkpoint)
 
-  if not FLAGS.do_train and not FLAGS.do_eval and not FLAGS.do_predict:
+  if (not FLAGS.do_train and not FLAGS.do_eval and not FLAGS.do_predict and
+      not FLAGS.export_dir):
     raise ValueError(
-        "At least one of `do_train`, `do_eval` or `do_predict' must be True.")
+        "At least one of `do_train`, `do_eval` or `do_predict' must be True, "
+        "or `export_dir` must be set.")
 
   bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
 
@@ -714,6 +1190,43 @@ def main(_):
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, bert_config.max_position_embeddings))
 
+  if FLAGS.export_dir and bert_config.attention_window_size > 0:
+    raise ValueError("`export_dir` does not support `attention_window_size`.")
+
+  if FLAGS.use_tpu and FLAGS.predict_remove_padding:
+    raise ValueError("`predict_remove_padding` is not supported on TPU.")
+
+  if FLAGS.use_tpu and FLAGS.predict_fold_embeddings:
+    raise ValueError("`predict_fold_embeddings` is not supported on TPU.")
+
+  if FLAGS.predict_window_stride > 0:
+    if FLAGS.predict_window_stride > FLAGS.max_seq_length - 2:
+      raise ValueError(
+          "`predict_window_stride` (%d) cannot be larger than the %d tokens "
+          "of a window." % (FLAGS.predict_window_stride,
+                            FLAGS.max_seq_length - 2))
+    if FLAGS.predict_window_aggregation not in windowing.AGGREGATION_METHODS:
+      raise ValueError("Unknown predict_window_aggregation: %s" %
+                       FLAGS.predict_window_aggregation)
+  elif FLAGS.predict_window_baseline:
+    raise ValueError(
+        "`predict_window_baseline` requires a positive `predict_window_stride`.")
+
+  early_exit_layers = None
+  if FLAGS.early_exit_layers:
+    early_exit_layers = [int(x) for x in FLAGS.early_exit_layers.split(",")]
+    for layer_index in early_exit_layers:
+      if not 0 <= layer_index < bert_config.num_hidden_layers - 1:
+        raise ValueError(
+            "Early-exit layers must be between 0 and %d: %s" %
+            (bert_config.num_hidden_layers - 2, FLAGS.early_exit_layers))
+
+  if FLAGS.early_exit_threshold > 0:
+    if not early_exit_layers:
+      raise ValueError("`early_exit_threshold` requires `early_exit_layers`.")
+    if FLAGS.use_tpu:
+      raise ValueError("`early_exit_threshold` is not supported on TPU.")
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
@@ -761,7 +1274,12 @@ def main(_):
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      predict_remove_padding=FLAGS.predict_remove_padding,
+      early_exit_layers=early_exit_layers,
+      early_exit_threshold=FLAGS.early_exit_threshold,
+      early_exit_distill=FLAGS.early_exit_distill,
+      predict_fold_embeddings=FLAGS.predict_fold_embeddings)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -837,33 +1355,71 @@ def main(_):
   if FLAGS.do_predict:
     predict_examples = processor.get_test_examples(FLAGS.data_dir)
     num_actual_predict_examples = len(predict_examples)
-    if FLAGS.use_tpu:
-      # TPU requires a fixed batch size for all batches, therefore the number
-      # of examples must be a multiple of the batch size, or else examples
-      # will get dropped. So we pad with fake examples which are ignored
-      # later on.
-      while len(predict_examples) % FLAGS.predict_batch_size != 0:
-        predict_examples.append(PaddingInputExample())
-
-    predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
-    file_based_convert_examples_to_features(predict_examples, label_list,
-                                            FLAGS.max_seq_length, tokenizer,
-                                            predict_file)
-
-    tf.logging.info("***** Running prediction*****")
-    tf.logging.info("  Num examples = %d (%d actual, %d padding)",
-                    len(predict_examples), num_actual_predict_examples,
-                    len(predict_examples) - num_actual_predict_examples)
-    tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
-
-    predict_drop_remainder = True if FLAGS.use_tpu else False
-    predict_input_fn = file_based_input_fn_builder(
-        input_file=predict_file,
-        seq_length=FLAGS.max_seq_length,
-        is_training=False,
-        drop_remainder=predict_drop_remainder)
-
-    result = estimator.predict(input_fn=predict_input_fn)
+    if FLAGS.predict_window_stride > 0:
+      bucket_lengths = [FLAGS.max_seq_length]
+      if FLAGS.predict_bucket_lengths:
+        bucket_lengths = bucketing.parse_bucket_lengths(
+            FLAGS.predict_bucket_lengths, FLAGS.max_seq_length)
+
+      tf.logging.info("***** Running prediction*****")
+      tf.logging.info("  Num examples = %d", num_actual_predict_examples)
+      tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
+      tf.logging.info("  Window stride = %d", FLAGS.predict_window_stride)
+
+      result = file_based_predict_windows(
+          estimator, predict_examples, label_list, FLAGS.max_seq_length,
+          FLAGS.predict_window_stride, FLAGS.predict_window_aggregation,
+          bucket_lengths, tokenizer, FLAGS.output_dir)
+    elif FLAGS.predict_bucket_lengths:
+      bucket_lengths = bucketing.parse_bucket_lengths(
+          FLAGS.predict_bucket_lengths, FLAGS.max_seq_length)
+
+      tf.logging.info("***** Running prediction*****")
+      tf.logging.info("  Num examples = %d", num_actual_predict_examples)
+      tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
+      tf.logging.info("  Bucket lengths = %s", bucket_lengths)
+
+      result = file_based_predict_by_length(
+          estimator, predict_examples, label_list, FLAGS.max_seq_length,
+          bucket_lengths, tokenizer, FLAGS.output_dir)
+    else:
+      if FLAGS.use_tpu:
+        # TPU requires a fixed batch size for all batches, therefore the number
+        # of examples must be a multiple of the batch size, or else examples
+        # will get dropped. So we pad with fake examples which are ignored
+        # later on.
+        while len(predict_examples) % FLAGS.predict_batch_size != 0:
+          predict_examples.append(PaddingInputExample())
+
+      predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+      file_based_convert_examples_to_features(predict_examples, label_list,
+                                              FLAGS.max_seq_length, tokenizer,
+                                              predict_file)
+
+      tf.logging.info("***** Running prediction*****")
+      tf.logging.info("  Num examples = %d (%d actual, %d padding)",
+                      len(predict_examples), num_actual_predict_examples,
+                      len(predict_examples) - num_actual_predict_examples)
+      tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
+
+      predict_drop_remainder = True if FLAGS.use_tpu else False
+      predict_input_fn = file_based_input_fn_builder(
+          input_file=predict_file,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=predict_drop_remainder)
+
+      result = estimator.predict(input_fn=predict_input_fn)
+
+    # `result` is computed lazily, so this times the prediction itself.
+    start_time = time.time()
+    total_num_layers = 0
+    total_num_windows = 0
+    num_correct = 0
+
+    def is_correct(probabilities, example):
+      label_id = max(range(len(label_list)), key=lambda x: probabilities[x])
+      return label_list[label_id] == example.label
 
     output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
     with tf.gfile.GFile(output_predict_file, "w") as writer:
@@ -878,7 +1434,85 @@ def main(_):
             for class_probability in probabilities) + "\n"
         writer.write(output_line)
         num_written_lines += 1
+        if early_exit_layers:
+          total_num_layers += prediction["num_layers"]
+        if early_exit_layers or FLAGS.predict_window_stride > 0:
+          if is_correct(probabilities, predict_examples[i]):
+            num_correct += 1
+        if FLAGS.predict_window_stride > 0:
+          total_num_windows += prediction["num_windows"]
     assert num_written_lines == num_actual_predict_examples
+    predict_seconds = time.time() - start_time
+
+    if early_exit_layers:
+      result = collections.OrderedDict([
+          ("early_exit_layers", FLAGS.early_exit_layers),
+          ("early_exit_threshold", FLAGS.early_exit_threshold),
+          ("num_examples", num_written_lines),
+          ("average_num_layers", total_num_layers / num_written_lines),
+          ("accuracy", num_correct / num_written_lines),
+          ("predict_seconds", predict_seconds),
+          ("examples_per_second", num_written_lines / predict_seconds),
+      ])
+      output_early_exit_file = os.path.join(FLAGS.output_dir,
+                                            "early_exit_results.txt")
+      with tf.gfile.GFile(output_early_exit_file, "w") as writer:
+        tf.logging.info("***** Early exit results *****")
+        for (key, value) in result.items():
+          tf.logging.info("  %s = %s", key, str(value))
+          writer.write("%s = %s\n" % (key, str(value)))
+
+    if FLAGS.predict_window_stride > 0:
+      result = collections.OrderedDict([
+          ("predict_window_stride", FLAGS.predict_window_stride),
+          ("predict_window_aggregation", FLAGS.predict_window_aggregation),
+          ("num_examples", num_written_lines),
+          ("num_windows", total_num_windows),
+          ("average_num_windows", total_num_windows / num_written_lines),
+          ("accuracy", num_correct / num_written_lines),
+          ("predict_seconds", predict_seconds),
+          ("examples_per_second", num_written_lines / predict_seconds),
+      ])
+
+      if FLAGS.predict_window_baseline:
+        # The same texts truncated as without windows, with the same length
+        # buckets.
+        tf.logging.info("***** Running truncated prediction *****")
+        start_time = time.time()
+        num_truncated_correct = 0
+        for (example, prediction) in zip(
+            predict_examples,
+            file_based_predict_by_length(
+                estimator, predict_examples, label_list, FLAGS.max_seq_length,
+                bucket_lengths, tokenizer, FLAGS.output_dir)):
+          if is_correct(prediction["probabilities"], example):
+            num_truncated_correct += 1
+        truncated_seconds = time.time() - start_time
+        result["truncated_accuracy"] = (
+            num_truncated_correct / num_written_lines)
+        result["truncated_predict_seconds"] = truncated_seconds
+        result["truncated_examples_per_second"] = (
+            num_written_lines / truncated_seconds)
+
+      output_window_file = os.path.join(FLAGS.output_dir,
+                                        "window_results.txt")
+      with tf.gfile.GFile(output_window_file, "w") as writer:
+        tf.logging.info("***** Window results *****")
+        for (key, value) in result.items():
+          tf.logging.info("  %s = %s", key, str(value))
+          writer.write("%s = %s\n" % (key, str(value)))
+
+  if FLAGS.export_dir:
+    # Like `estimator.predict`, this uses the fine-tuned checkpoint if there
+    # is one.
+    checkpoint = (tf.train.latest_checkpoint(FLAGS.output_dir) or
+                  FLAGS.init_checkpoint)
+    tf.logging.info("***** Exporting %s *****", checkpoint)
+    export_saved_model(
+        bert_config, label_list, checkpoint, FLAGS.export_dir,
+        remove_padding=FLAGS.predict_remove_padding,
+        early_exit_layers=early_exit_layers,
+        early_exit_threshold=FLAGS.early_exit_threshold)
 
 
 if __name__ == "__main__":
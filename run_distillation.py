@@ -0,0 +1,460 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Distills a fine-tuned BERTAR classifier into a smaller student classifier.
+
+The student (`--bert_config_file`, `--vocab_file`) is trained on the training
+split against the probabilities of the teacher (`--teacher_config_file`,
+`--teacher_checkpoint`) at `--distill_temperature`, mixed with the labels by
+`--distill_alpha`. With `--distill_hidden_weight`, the first-token hidden state
+of each student layer is also trained to match that of a teacher layer
+(through a projection if the hidden sizes differ).
+
+The student can use fewer layers, a smaller hidden size and a pruned
+vocabulary (see `prune_vocab.py`). If `--teacher_vocab_file` differs from
+`--vocab_file`, each model reads the examples tokenized with its own
+vocabulary. The student checkpoints in `--output_dir` do not contain the
+teacher, and can be used with `run_classifier_discrimination.py` like any
+fine-tuned checkpoint. `--init_checkpoint` optionally initializes the student,
+e.g. from a pre-trained small model.
+
+With `--do_predict`, the student and the teacher are both run on the test
+split, and their accuracy, agreement and throughput are written to
+`distillation_results.txt`.
+
+The other flags (`--data_dir`, `--max_seq_length`, `--learning_rate`, ...) are
+those of `run_classifier_discrimination.py`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import modeling
+import numpy as np
+import optimization
+import run_classifier_discrimination
+import tokenization
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("teacher_config_file", None,
+                    "The config json file of the teacher model.")
+
+flags.DEFINE_string("teacher_checkpoint", None,
+                    "The fine-tuned checkpoint of the teacher model.")
+
+flags.DEFINE_string(
+    "teacher_vocab_file", None,
+    "The vocabulary file of the teacher model. Defaults to `vocab_file`.")
+
+flags.DEFINE_float(
+    "distill_temperature", 2.0,
+    "Temperature that the teacher and student logits are divided by for the "
+    "distillation loss.")
+
+flags.DEFINE_float(
+    "distill_alpha", 0.9,
+    "Weight of the loss against the teacher's probabilities. The loss against "
+    "the labels gets 1 - alpha.")
+
+flags.DEFINE_float(
+    "distill_hidden_weight", 0.0,
+    "Weight of the mean squared error between the first-token hidden states "
+    "of the student layers and those of the matching teacher layers. 0 "
+    "disables it.")
+
+# Prefix of the teacher inputs in the training records, when the teacher has
+# its own vocabulary.
+TEACHER_PREFIX = "teacher_"
+
+
+def get_teacher_layers(num_student_layers, num_teacher_layers):
+  """Maps each student layer to the teacher layer whose output it learns.
+
+  The student layers are spread evenly over the teacher layers, and the last
+  student layer always learns the last teacher layer.
+
+  Args:
+    num_student_layers: int. Number of student encoder layers.
+    num_teacher_layers: int. Number of teacher encoder layers.
+
+  Returns:
+    A list of `num_student_layers` teacher layer indexes.
+
+  Raises:
+    ValueError: If the student has more layers than the teacher.
+  """
+  if num_student_layers > num_teacher_layers:
+    raise ValueError(
+        "The student has more layers (%d) than the teacher (%d)." %
+        (num_student_layers, num_teacher_layers))
+  return [
+      (i + 1) * num_teacher_layers // num_student_layers - 1
+      for i in range(num_student_layers)
+  ]
+
+
+def teacher_variable_getter(getter, name, *args, **kwargs):
+  """Creates the teacher variables as non-trainable local variables.
+
+  They are not updated by the optimizer and are not saved in the student
+  checkpoints, and `local_init_op` loads them from the teacher checkpoint
+  whenever a session is created.
+  """
+  kwargs["trainable"] = False
+  kwargs["collections"] = [tf.GraphKeys.LOCAL_VARIABLES]
+  return getter(name, *args, **kwargs)
+
+
+def soft_cross_entropy(logits, teacher_logits, temperature):
+  """Returns the per-example cross-entropy against the teacher's predictions.
+
+  Both logits are divided by `temperature`, and the loss is multiplied by the
+  square of `temperature` so that its gradients keep the same scale.
+  """
+  teacher_probabilities = tf.nn.softmax(teacher_logits / temperature, axis=-1)
+  log_probabilities = tf.nn.log_softmax(logits / temperature, axis=-1)
+  return -tf.reduce_sum(
+      teacher_probabilities * log_probabilities,
+      axis=-1) * (temperature * temperature)
+
+
+def model_fn_builder(bert_config, teacher_config, num_labels, init_checkpoint,
+                     teacher_checkpoint, learning_rate, num_train_steps,
+                     num_warmup_steps, use_tpu, use_one_hot_embeddings,
+                     has_teacher_inputs):
+  """Returns `model_fn` closure for TPUEstimator.
+
+  Only training distills. The other modes run the student alone, with the
+  `model_fn` of `run_classifier_discrimination.model_fn_builder`.
+  """
+  student_model_fn = run_classifier_discrimination.model_fn_builder(
+      bert_config=bert_config,
+      num_labels=num_labels,
+      init_checkpoint=init_checkpoint,
+      learning_rate=learning_rate,
+      num_train_steps=num_train_steps,
+      num_warmup_steps=num_warmup_steps,
+      use_tpu=use_tpu,
+      use_one_hot_embeddings=use_one_hot_embeddings)
+
+  def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
+    """The `model_fn` for TPUEstimator."""
+    if mode != tf.estimator.ModeKeys.TRAIN:
+      return student_model_fn(features, labels, mode, params)
+
+    tf.logging.info("*** Features ***")
+    for name in sorted(features.keys()):
+      tf.logging.info("  name = %s, shape = %s" % (name, features[name].shape))
+
+    label_ids = features["label_ids"]
+    teacher_prefix = TEACHER_PREFIX if has_teacher_inputs else ""
+
+    student_layers = None
+    teacher_layers = None
+    if FLAGS.distill_hidden_weight > 0:
+      student_layers = list(range(bert_config.num_hidden_layers))
+      teacher_layers = get_teacher_layers(bert_config.num_hidden_layers,
+                                          teacher_config.num_hidden_layers)
+
+    (hard_loss, _, logits, _, _,
+     student_outputs) = run_classifier_discrimination.create_model(
+         bert_config, True, features["input_ids"], features["input_mask"],
+         features["segment_ids"], label_ids, num_labels,
+         use_one_hot_embeddings, output_layers=student_layers)
+
+    with tf.variable_scope("teacher", custom_getter=teacher_variable_getter):
+      (_, _, teacher_logits, _, _,
+       teacher_outputs) = run_classifier_discrimination.create_model(
+           teacher_config, False, features[teacher_prefix + "input_ids"],
+           features[teacher_prefix + "input_mask"],
+           features[teacher_prefix + "segment_ids"], label_ids, num_labels,
+           use_one_hot_embeddings, output_layers=teacher_layers)
+    teacher_logits = tf.stop_gradient(teacher_logits)
+
+    with tf.variable_scope("distillation"):
+      soft_loss = tf.reduce_mean(
+          soft_cross_entropy(logits, teacher_logits,
+                             FLAGS.distill_temperature))
+      total_loss = (FLAGS.distill_alpha * soft_loss +
+                    (1.0 - FLAGS.distill_alpha) * hard_loss)
+
+      if student_layers:
+        hidden_losses = []
+        for (student_index, student_output,
+             teacher_output) in zip(student_layers, student_outputs,
+                                    teacher_outputs):
+          # The first token is [CLS] in both models, even if their
+          # vocabularies split the rest of the text differently.
+          student_hidden = student_output[:, 0, :]
+          teacher_hidden = tf.stop_gradient(teacher_output[:, 0, :])
+          if bert_config.hidden_size != teacher_config.hidden_size:
+            student_hidden = tf.layers.dense(
+                student_hidden,
+                teacher_config.hidden_size,
+                kernel_initializer=modeling.create_initializer(
+                    bert_config.initializer_range),
+                name="layer_%d" % student_index)
+          hidden_losses.append(
+              tf.reduce_mean(tf.square(student_hidden - teacher_hidden)))
+        total_loss += FLAGS.distill_hidden_weight * tf.add_n(hidden_losses)
+
+    tvars = tf.trainable_variables()
+    initialized_variable_names = {}
+    if init_checkpoint:
+      (assignment_map, initialized_variable_names
+      ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+      tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+
+    # The teacher must be complete, so every variable is loaded by name.
+    teacher_assignment_map = collections.OrderedDict()
+    for var in tf.local_variables():
+      name = var.op.name
+      if name.startswith("teacher/"):
+        teacher_assignment_map[name[len("teacher/"):]] = var
+    tf.train.init_from_checkpoint(teacher_checkpoint, teacher_assignment_map)
+
+    tf.logging.info("**** Trainable Variables ****")
+    for var in tvars:
+      init_string = ""
+      if var.name in initialized_variable_names:
+        init_string = ", *INIT_FROM_CKPT*"
+      tf.logging.info("  name = %s, shape = %s%s", var.name, var.shape,
+                      init_string)
+    tf.logging.info("  %d teacher variables from %s",
+                    len(teacher_assignment_map), teacher_checkpoint)
+
+    train_op = optimization.create_optimizer(
+        total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+
+    return tf.contrib.tpu.TPUEstimatorSpec(
+        mode=mode, loss=total_loss, train_op=train_op)
+
+  return model_fn
+
+
+def file_based_convert_examples_to_features(examples, label_list,
+                                            max_seq_length, tokenizer,
+                                            teacher_tokenizer, output_file):
+  """Writes the training records, with the teacher's inputs if needed.
+
+  If `teacher_tokenizer` is not None, each record also has the teacher's
+  "input_ids", "input_mask" and "segment_ids" under `TEACHER_PREFIX`.
+  """
+  writer = tf.python_io.TFRecordWriter(output_file)
+
+  for (ex_index, example) in enumerate(examples):
+    if ex_index % 10000 == 0:
+      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+
+    feature = run_classifier_discrimination.convert_single_example(
+        ex_index, example, label_list, max_seq_length, tokenizer)
+    tf_example = run_classifier_discrimination.create_tf_example(
+        feature, max_seq_length)
+
+    if teacher_tokenizer is not None:
+      teacher_feature = run_classifier_discrimination.convert_single_example(
+          ex_index, example, label_list, max_seq_length, teacher_tokenizer)
+      teacher_example = run_classifier_discrimination.create_tf_example(
+          teacher_feature, max_seq_length)
+      for name in ["input_ids", "input_mask", "segment_ids"]:
+        tf_example.features.feature[TEACHER_PREFIX + name].CopyFrom(
+            teacher_example.features.feature[name])
+
+    writer.write(tf_example.SerializeToString())
+  writer.close()
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  processors = {
+      "bertar": run_classifier_discrimination.BERTARProcessor,
+  }
+
+  if not FLAGS.do_train and not FLAGS.do_predict:
+    raise ValueError("At least one of `do_train` or `do_predict' must be True.")
+
+  if FLAGS.do_eval:
+    raise ValueError(
+        "`do_eval` is not supported, since the BERTAR task has no dev split. "
+        "`do_predict` evaluates on the test split.")
+
+  bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
+  teacher_config = modeling.BertConfig.from_json_file(
+      FLAGS.teacher_config_file)
+
+  for config in [bert_config, teacher_config]:
+    if FLAGS.max_seq_length > config.max_position_embeddings:
+      raise ValueError(
+          "Cannot use sequence length %d because the BERT model "
+          "was only trained up to sequence length %d" %
+          (FLAGS.max_seq_length, config.max_position_embeddings))
+
+  if FLAGS.distill_hidden_weight > 0:
+    get_teacher_layers(bert_config.num_hidden_layers,
+                       teacher_config.num_hidden_layers)
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+
+  task_name = FLAGS.task_name.lower()
+
+  if task_name not in processors:
+    raise ValueError("Task not found: %s" % (task_name))
+
+  processor = processors[task_name]()
+
+  label_list = processor.get_labels()
+
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+  teacher_tokenizer = None
+  if FLAGS.teacher_vocab_file and FLAGS.teacher_vocab_file != FLAGS.vocab_file:
+    teacher_tokenizer = tokenization.FullTokenizer(
+        vocab_file=FLAGS.teacher_vocab_file,
+        do_lower_case=FLAGS.do_lower_case)
+
+  tpu_cluster_resolver = None
+  if FLAGS.use_tpu and FLAGS.tpu_name:
+    tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(
+        FLAGS.tpu_name, zone=FLAGS.tpu_zone, project=FLAGS.gcp_project)
+
+  is_per_host = tf.contrib.tpu.InputPipelineConfig.PER_HOST_V2
+  run_config = tf.contrib.tpu.RunConfig(
+      cluster=tpu_cluster_resolver,
+      master=FLAGS.master,
+      model_dir=FLAGS.output_dir,
+      save_checkpoints_steps=FLAGS.save_checkpoints_steps,
+      tpu_config=tf.contrib.tpu.TPUConfig(
+          iterations_per_loop=FLAGS.iterations_per_loop,
+          num_shards=FLAGS.num_tpu_cores,
+          per_host_input_for_training=is_per_host))
+
+  train_examples = None
+  num_train_steps = None
+  num_warmup_steps = None
+  if FLAGS.do_train:
+    train_examples = processor.get_train_examples(FLAGS.data_dir)
+    num_train_steps = int(
+        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+    num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
+
+  model_fn = model_fn_builder(
+      bert_config=bert_config,
+      teacher_config=teacher_config,
+      num_labels=len(label_list),
+      init_checkpoint=FLAGS.init_checkpoint,
+      teacher_checkpoint=FLAGS.teacher_checkpoint,
+      learning_rate=FLAGS.learning_rate,
+      num_train_steps=num_train_steps,
+      num_warmup_steps=num_warmup_steps,
+      use_tpu=FLAGS.use_tpu,
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      has_teacher_inputs=teacher_tokenizer is not None)
+
+  estimator = tf.contrib.tpu.TPUEstimator(
+      use_tpu=FLAGS.use_tpu,
+      model_fn=model_fn,
+      config=run_config,
+      train_batch_size=FLAGS.train_batch_size,
+      predict_batch_size=FLAGS.predict_batch_size)
+
+  if FLAGS.do_train:
+    train_file = os.path.join(FLAGS.output_dir, "distill_train.tf_record")
+    file_based_convert_examples_to_features(train_examples, label_list,
+                                            FLAGS.max_seq_length, tokenizer,
+                                            teacher_tokenizer, train_file)
+    tf.logging.info("***** Running distillation *****")
+    tf.logging.info("  Num examples = %d", len(train_examples))
+    tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
+    tf.logging.info("  Num steps = %d", num_train_steps)
+
+    extra_name_to_features = None
+    if teacher_tokenizer is not None:
+      extra_name_to_features = dict(
+          (TEACHER_PREFIX + name,
+           tf.FixedLenFeature([FLAGS.max_seq_length], tf.int64))
+          for name in ["input_ids", "input_mask", "segment_ids"])
+    train_input_fn = run_classifier_discrimination.file_based_input_fn_builder(
+        input_file=train_file,
+        seq_length=FLAGS.max_seq_length,
+        is_training=True,
+        drop_remainder=True,
+        extra_name_to_features=extra_name_to_features)
+    estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
+
+  if FLAGS.do_predict:
+    predict_examples = processor.get_test_examples(FLAGS.data_dir)
+    label_ids = np.array([label_list.index(x.label) for x in predict_examples])
+
+    predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+    run_classifier_discrimination.file_based_convert_examples_to_features(
+        predict_examples, label_list, FLAGS.max_seq_length, tokenizer,
+        predict_file)
+    teacher_predict_file = predict_file
+    if teacher_tokenizer is not None:
+      teacher_predict_file = os.path.join(FLAGS.output_dir,
+                                          "teacher_predict.tf_record")
+      run_classifier_discrimination.file_based_convert_examples_to_features(
+          predict_examples, label_list, FLAGS.max_seq_length,
+          teacher_tokenizer, teacher_predict_file)
+
+    tf.logging.info("***** Running prediction*****")
+    tf.logging.info("  Num examples = %d", len(predict_examples))
+    tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
+
+    (student_predictions, student_speed) = (
+        run_classifier_discrimination.predict_label_ids(
+            bert_config, len(label_list),
+            tf.train.latest_checkpoint(FLAGS.output_dir), predict_file,
+            FLAGS.max_seq_length, FLAGS.predict_batch_size))
+    (teacher_predictions, teacher_speed) = (
+        run_classifier_discrimination.predict_label_ids(
+            teacher_config, len(label_list), FLAGS.teacher_checkpoint,
+            teacher_predict_file, FLAGS.max_seq_length,
+            FLAGS.predict_batch_size))
+
+    result = collections.OrderedDict([
+        ("num_test_examples", len(predict_examples)),
+        ("student_accuracy", np.mean(student_predictions == label_ids)),
+        ("teacher_accuracy", np.mean(teacher_predictions == label_ids)),
+        ("prediction_agreement",
+         np.mean(student_predictions == teacher_predictions)),
+        ("student_examples_per_second", student_speed),
+        ("teacher_examples_per_second", teacher_speed),
+        ("speedup", student_speed / teacher_speed),
+    ])
+
+    output_file = os.path.join(FLAGS.output_dir, "distillation_results.txt")
+    with tf.gfile.GFile(output_file, "w") as writer:
+      tf.logging.info("***** Distillation results *****")
+      for (key, value) in result.items():
+        tf.logging.info("  %s = %s", key, str(value))
+        writer.write("%s = %s\n" % (key, str(value)))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("data_dir")
+  flags.mark_flag_as_required("vocab_file")
+  flags.mark_flag_as_required("bert_config_file")
+  flags.mark_flag_as_required("teacher_config_file")
+  flags.mark_flag_as_required("teacher_checkpoint")
+  flags.mark_flag_as_required("output_dir")
+  tf.app.run()
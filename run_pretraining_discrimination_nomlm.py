@@ -19,6 +19,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import losses
 import modeling
 import optimization
 import tensorflow as tf
@@ -331,8 +332,7 @@ def get_next_sentence_output(bert_config, input_tensor, labels):
     logits = tf.nn.bias_add(logits, output_bias)
     log_probs = tf.nn.log_softmax(logits, axis=-1)
     labels = tf.reshape(labels, [-1])
-    one_hot_labels = tf.one_hot(labels, depth=2, dtype=tf.float32)
-    per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
+    per_example_loss = losses.sparse_softmax_loss(logits, labels)
     loss = tf.reduce_mean(per_example_loss)
     return (loss, per_example_loss, log_probs)
 
@@ -354,8 +354,7 @@ def get_synthetic_text_output(bert_config, input_tensor, labels):
     logits = tf.nn.bias_add(logits, output_bias)
     log_probs = tf.nn.log_softmax(logits, axis=-1)
     labels = tf.reshape(labels, [-1])
-    one_hot_labels = tf.one_hot(labels, depth=2, dtype=tf.float32)
-    per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
+    per_example_loss = losses.sparse_softmax_loss(logits, labels)
     loss = tf.reduce_mean(per_example_loss)
     return (loss, per_example_loss, log_probs)
 
@@ -19,6 +19,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import losses
 import modeling
 import optimization
 import tensorflow as tf
@@ -110,6 +111,11 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_integer(
+    "masked_lm_num_sampled", 0,
+    "If > 0, training uses a sampled softmax over this many candidate "
+    "tokens for the masked LM loss (see `losses.masked_lm_loss`).")
+
   
 # class SaveMetricsHook(tf.train.SessionRunHook):
 #   """Prints the given tensors every N local steps, every N seconds, or at end.
@@ -157,7 +163,7 @@ flags.DEFINE_integer(
 
 def model_fn_builder(bert_config, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, masked_lm_num_sampled=0):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -191,7 +197,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
     (masked_lm_loss,
      masked_lm_example_loss, masked_lm_log_probs) = get_masked_lm_output(
          bert_config, model.get_sequence_output(), model.get_embedding_table(),
-         masked_lm_positions, masked_lm_ids, masked_lm_weights)
+         masked_lm_positions, masked_lm_ids, masked_lm_weights,
+         num_sampled=(masked_lm_num_sampled if is_training else 0))
 
     (synthetic_loss, synthetic_example_loss,
      synthetic_log_probs) = get_synthetic_text_output(
@@ -324,8 +331,11 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
 
 def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
-                         label_ids, label_weights):
-  """Get loss and log probs for the masked LM."""
+                         label_ids, label_weights, num_sampled=0):
+  """Get loss and log probs for the masked LM.
+
+  See `losses.masked_lm_loss` for `num_sampled`.
+  """
   input_tensor = gather_indexes(input_tensor, positions)
 
   with tf.variable_scope("cls/predictions"):
@@ -346,21 +356,16 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
         "output_bias",
         shape=[bert_config.vocab_size],
         initializer=tf.zeros_initializer())
-    logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
-    logits = tf.nn.bias_add(logits, output_bias)
-    log_probs = tf.nn.log_softmax(logits, axis=-1)
-
     label_ids = tf.reshape(label_ids, [-1])
     label_weights = tf.reshape(label_weights, [-1])
 
-    one_hot_labels = tf.one_hot(
-        label_ids, depth=bert_config.vocab_size, dtype=tf.float32)
+    (per_example_loss, log_probs) = losses.masked_lm_loss(
+        input_tensor, output_weights, output_bias, label_ids, num_sampled)
 
     # The `positions` tensor might be zero-padded (if the sequence is too
     # short to have the maximum number of predictions). The `label_weights`
     # tensor has a value of 1.0 for every real prediction and 0.0 for the
     # padding predictions.
-    per_example_loss = -tf.reduce_sum(log_probs * one_hot_labels, axis=[-1])
     numerator = tf.reduce_sum(label_weights * per_example_loss)
     denominator = tf.reduce_sum(label_weights) + 1e-5
     loss = numerator / denominator
@@ -385,8 +390,7 @@ def get_synthetic_text_output(bert_config, input_tensor, labels):
     logits = tf.nn.bias_add(logits, output_bias)
     log_probs = tf.nn.log_softmax(logits, axis=-1)
     labels = tf.reshape(labels, [-1])
-    one_hot_labels = tf.one_hot(labels, depth=2, dtype=tf.float32)
-    per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
+    per_example_loss = losses.sparse_softmax_loss(logits, labels)
     loss = tf.reduce_mean(per_example_loss)
     return (loss, per_example_loss, log_probs)
 
@@ -498,6 +502,9 @@ def main(_):
   if not FLAGS.do_train and not FLAGS.do_eval:
     raise ValueError("At least one of `do_train` or `do_eval` must be True.")
 
+  losses.check_masked_lm_num_sampled(FLAGS.masked_lm_num_sampled,
+                                     FLAGS.use_tpu)
+
   bert_config = modeling.BertConfig.from_json_file(FLAGS.bert_config_file)
 
   tf.gfile.MakeDirs(FLAGS.output_dir)
@@ -534,7 +541,8 @@ def main(_):
       num_train_steps=FLAGS.num_train_steps,
       num_warmup_steps=FLAGS.num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      masked_lm_num_sampled=FLAGS.masked_lm_num_sampled)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
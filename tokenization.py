@@ -18,9 +18,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bz2
 import collections
+import itertools
 import re
+import struct
 import unicodedata
+import zlib
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -118,27 +123,226 @@ def printable_text(text):
     raise ValueError("Not running on Python2 or Python 3?")
 
 
+# Input files are read in blocks of this many bytes.
+_READ_BLOCK_SIZE = 1 << 22
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_BZ2_MAGIC = b"BZh"
+_BZ2_BLOCK_MAGIC = b"1AY&SY"
+
+
+def _read_blocks(input_file, block_size):
+  """Yields the contents of `input_file` as byte blocks.
+
+  gzip and bz2 files are detected from their header and decompressed on the
+  fly. Concatenated streams (e.g. from `cat a.gz b.gz`) are supported.
+  """
+  with tf.gfile.GFile(input_file, "rb") as reader:
+    # The first read is always large enough to hold the compression header.
+    block = reader.read(max(block_size, 16))
+    if block[:2] == _GZIP_MAGIC:
+      new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif block[:3] == _BZ2_MAGIC and block[4:10] == _BZ2_BLOCK_MAGIC:
+      new_decompressor = bz2.BZ2Decompressor
+    else:
+      new_decompressor = None
+
+    if new_decompressor is None:
+      while block:
+        yield block
+        block = reader.read(block_size)
+      return
+
+    decompressor = new_decompressor()
+    while block:
+      while block:
+        # A stream can end exactly at the end of a block, in which case the
+        # next stream starts with the next block.
+        if decompressor.eof:
+          decompressor = new_decompressor()
+        yield decompressor.decompress(block)
+        block = decompressor.unused_data
+      block = reader.read(block_size)
+
+
+def read_lines(input_file, block_size=_READ_BLOCK_SIZE):
+  """Yields the lines of a text file as Unicode, without trailing newlines.
+
+  The file is read in large blocks and only the complete lines of each block
+  are decoded, in a single call, so the cost per line is a `split` instead of
+  a `readline()` and a `convert_to_unicode()`. gzip and bz2 compressed inputs
+  are decompressed transparently.
+
+  Args:
+    input_file: Path to a (possibly gzip or bz2 compressed) UTF-8 text file.
+    block_size: Number of bytes to read at a time.
+
+  Yields:
+    Each line of the file.
+  """
+  pending = []
+  for block in _read_blocks(input_file, block_size):
+    end = block.rfind(b"\n")
+    if end < 0:
+      pending.append(block)
+      continue
+    pending.append(block[:end])
+    lines = convert_to_unicode(b"".join(pending)).split(u"\n")
+    pending = [block[end + 1:]]
+    for line in lines:
+      yield line
+  tail = b"".join(pending)
+  if tail:
+    yield convert_to_unicode(tail)
+
+
+def read_tokenized_batches(input_file, tokenizer, batch_size=1024):
+  """Lazily tokenizes a text file, one stripped line at a time.
+
+  Args:
+    input_file: Path to a (possibly gzip or bz2 compressed) UTF-8 text file.
+    tokenizer: Object with a `tokenize` method, e.g. a `FullTokenizer`.
+    batch_size: Maximum number of lines in each yielded batch.
+
+  Yields:
+    Lists of up to `batch_size` token lists, one per line. Blank lines are
+    yielded as `None` so that callers can use them as document delimiters.
+  """
+  batch = []
+  for line in read_lines(input_file):
+    line = line.strip()
+    batch.append(tokenizer.tokenize(line) if line else None)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+# `write_token_table` compiles a vocab.txt into `<vocab_file>.table`, which
+# `load_vocab_tokens` reads in its place. The table is a header followed by the
+# stripped UTF-8 tokens joined by newlines. The header holds the size and
+# CRC32 of the vocab.txt that it was compiled from, so a table that no longer
+# matches its vocab.txt is ignored.
+TOKEN_TABLE_SUFFIX = ".table"
+
+_TOKEN_TABLE_MAGIC = b"BVOCAB\x00\x02"
+# Magic, vocab.txt size, vocab.txt CRC32 and number of tokens.
+_TOKEN_TABLE_HEADER = struct.Struct("<8sQII")
+
+
+def _parse_vocab_text(data):
+  """Returns the tokens of the contents of a vocab.txt file."""
+  # Decoding and splitting the whole file at once is much faster than reading
+  # it line by line, and gives the same tokens as long as we only split on
+  # "\n" (which is what `readline()` does).
+  lines = convert_to_unicode(data).split("\n")
+  if lines and not lines[-1]:
+    lines.pop()
+  return [line.strip() for line in lines]
+
+
+def _read_token_table(table_file, vocab_data):
+  """Reads the tokens of a token table, or None if it is stale.
+
+  Args:
+    table_file: Path to a token table written by `write_token_table`.
+    vocab_data: The contents of the vocab.txt file that the table is for.
+
+  Returns:
+    A list of unicode tokens, or None if the table was compiled from a
+    different vocab.txt.
+
+  Raises:
+    ValueError: If `table_file` is not a valid token table.
+  """
+  with tf.gfile.GFile(table_file, "rb") as reader:
+    data = reader.read()
+  if (len(data) < _TOKEN_TABLE_HEADER.size or
+      data[:len(_TOKEN_TABLE_MAGIC)] != _TOKEN_TABLE_MAGIC):
+    raise ValueError("`%s` is not a token table." % table_file)
+  (_, vocab_size, vocab_crc, num_tokens) = _TOKEN_TABLE_HEADER.unpack_from(data)
+  if (vocab_size != len(vocab_data) or
+      vocab_crc != zlib.crc32(vocab_data) & 0xffffffff):
+    return None
+
+  tokens = []
+  if num_tokens:
+    tokens = convert_to_unicode(data[_TOKEN_TABLE_HEADER.size:]).split("\n")
+  if len(tokens) != num_tokens:
+    raise ValueError(
+        "Token table `%s` is corrupt: expected %d tokens, got %d." %
+        (table_file, num_tokens, len(tokens)))
+  return tokens
+
+
+def load_vocab_tokens(vocab_file):
+  """Loads the tokens of a vocabulary file as a list, in id order.
+
+  If `<vocab_file>.table` was written by `write_token_table` from the current
+  contents of `vocab_file`, the tokens are read from it instead of being
+  parsed from `vocab_file`. A stale table is ignored with a warning.
+
+  Args:
+    vocab_file: Path to a vocabulary file with one token per line.
+
+  Returns:
+    A list of unicode tokens, where the index of each token is its id.
+  """
+  with tf.gfile.GFile(vocab_file, "rb") as reader:
+    data = reader.read()
+
+  table_file = vocab_file + TOKEN_TABLE_SUFFIX
+  if tf.gfile.Exists(table_file):
+    tokens = _read_token_table(table_file, data)
+    if tokens is not None:
+      return tokens
+    tf.logging.warning(
+        "Ignoring %s, which was compiled from an older version of %s. Run "
+        "compile_vocab.py to update it.", table_file, vocab_file)
+
+  return _parse_vocab_text(data)
+
+
+def write_token_table(vocab_file):
+  """Compiles `vocab_file` into the token table read by `load_vocab_tokens`.
+
+  Args:
+    vocab_file: Path to a vocabulary file with one token per line.
+
+  Returns:
+    The path of the token table, `<vocab_file>.table`.
+  """
+  with tf.gfile.GFile(vocab_file, "rb") as reader:
+    data = reader.read()
+  # Stripped lines cannot contain newlines, so they can be joined by them.
+  tokens = [x.encode("utf-8") for x in _parse_vocab_text(data)]
+
+  table_file = vocab_file + TOKEN_TABLE_SUFFIX
+  with tf.gfile.GFile(table_file, "wb") as writer:
+    writer.write(
+        _TOKEN_TABLE_HEADER.pack(_TOKEN_TABLE_MAGIC, len(data),
+                                 zlib.crc32(data) & 0xffffffff, len(tokens)))
+    writer.write(b"\n".join(tokens))
+  return table_file
+
+
 def load_vocab(vocab_file):
   """Loads a vocabulary file into a dictionary."""
-  vocab = collections.OrderedDict()
-  index = 0
-  with tf.gfile.GFile(vocab_file, "r") as reader:
-    while True:
-      token = convert_to_unicode(reader.readline())
-      if not token:
-        break
-      token = token.strip()
-      vocab[token] = index
-      index += 1
-  return vocab
-
-
-def convert_by_vocab(vocab, items):
-  """Converts a sequence of [tokens|ids] using the vocab."""
-  output = []
-  for item in items:
-    output.append(vocab[item])
-  return output
+  tokens = load_vocab_tokens(vocab_file)
+  # If a token appears more than once the last id wins, as it always has.
+  return collections.OrderedDict(zip(tokens, range(len(tokens))))
+
+
+def convert_by_vocab(vocab, items, default=None):
+  """Converts a sequence of [tokens|ids] using the vocab.
+
+  Items missing from `vocab` are mapped to `default`, or raise a KeyError if
+  `default` is None.
+  """
+  if default is None:
+    return list(map(vocab.__getitem__, items))
+  return list(map(vocab.get, items, itertools.repeat(default)))
 
 
 def convert_tokens_to_ids(vocab, tokens):
@@ -161,11 +365,20 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
-    self.vocab = load_vocab(vocab_file)
+  def __init__(self, vocab_file, do_lower_case=True, unk_token="[UNK]"):
+    tokens = load_vocab_tokens(vocab_file)
+    self.vocab = collections.OrderedDict(zip(tokens, range(len(tokens))))
     self.inv_vocab = {v: k for k, v in self.vocab.items()}
+    # Ids are contiguous, so ids are converted by indexing the token list.
+    # Ids are checked by `_check_id_range` since a negative index would
+    # silently wrap around.
+    self._ids_to_tokens = tokens
+    self.unk_token = unk_token
+    self.unk_id = self.vocab.get(unk_token)
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-    self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    self.wordpiece_tokenizer = WordpieceTokenizer(
+        vocab=self.vocab, unk_token=unk_token)
+    self._inv_vocab_array = None
 
   def tokenize(self, text):
     split_tokens = []
@@ -175,11 +388,83 @@ class FullTokenizer(object):
 
     return split_tokens
 
+  def tokenize_with_offsets(self, text):
+    """Tokenizes a piece of text and returns character offsets.
+
+    This produces exactly the same tokens as `tokenize`, along with the span
+    of the original text that each wordpiece came from. Characters removed
+    during cleanup (control characters) or normalization (stripped accents)
+    are never the start or end of a span.
+
+    Args:
+      text: The text to tokenize.
+
+    Returns:
+      A tuple `(tokens, offsets)`, where `offsets[i]` is a `(start, end)` pair
+      such that `convert_to_unicode(text)[start:end]` is the text that
+      `tokens[i]` was produced from.
+    """
+    tokens = []
+    offsets = []
+    for (token, char_spans) in self.basic_tokenizer.tokenize_with_char_spans(
+        text):
+      for (sub_token, start, end) in self.wordpiece_tokenizer.tokenize_word(
+          token):
+        tokens.append(sub_token)
+        offsets.append((char_spans[start][0], char_spans[end - 1][1]))
+
+    return (tokens, offsets)
+
   def convert_tokens_to_ids(self, tokens):
-    return convert_by_vocab(self.vocab, tokens)
+    """Converts tokens to a list of ids.
+
+    Tokens that are not in the vocab are mapped to the id of `unk_token`. A
+    KeyError is only raised if the vocab does not contain `unk_token` either.
+    """
+    return convert_by_vocab(self.vocab, tokens, default=self.unk_id)
 
   def convert_ids_to_tokens(self, ids):
-    return convert_by_vocab(self.inv_vocab, ids)
+    """Converts ids to a list of tokens.
+
+    Raises:
+      KeyError: If an id is not in the vocab.
+    """
+    ids = list(ids)
+    if ids:
+      self._check_id_range(min(ids), max(ids))
+    return convert_by_vocab(self._ids_to_tokens, ids)
+
+  def convert_tokens_to_ids_array(self, tokens):
+    """Like `convert_tokens_to_ids`, but returns an int32 NumPy array."""
+    if self.unk_id is None:
+      ids = map(self.vocab.__getitem__, tokens)
+    else:
+      ids = map(self.vocab.get, tokens, itertools.repeat(self.unk_id))
+    return np.fromiter(ids, dtype=np.int32)
+
+  def convert_ids_to_tokens_array(self, ids):
+    """Converts an array-like of ids to a NumPy array of tokens.
+
+    The lookup is a single fancy-indexing operation, so `ids` can have any
+    shape (e.g. a [batch_size, seq_length] batch of `input_ids`) and the
+    result has the same shape.
+
+    Raises:
+      KeyError: If an id is not in the vocab.
+    """
+    if self._inv_vocab_array is None:
+      # Built lazily since most callers never convert ids back to tokens.
+      self._inv_vocab_array = np.array(self._ids_to_tokens, dtype=object)
+    ids = np.asarray(ids)
+    if ids.size:
+      self._check_id_range(ids.min(), ids.max())
+    return self._inv_vocab_array[ids]
+
+  def _check_id_range(self, min_id, max_id):
+    """Raises a KeyError unless all ids between these bounds are valid."""
+    for token_id in (min_id, max_id):
+      if not 0 <= token_id < len(self._ids_to_tokens):
+        raise KeyError(token_id)
 
 
 class BasicTokenizer(object):
@@ -217,6 +502,94 @@ class BasicTokenizer(object):
     output_tokens = whitespace_tokenize(" ".join(split_tokens))
     return output_tokens
 
+  def tokenize_with_offsets(self, text):
+    """Like `tokenize`, but also returns a `(start, end)` span per token."""
+    tokens = []
+    offsets = []
+    for (token, char_spans) in self.tokenize_with_char_spans(text):
+      tokens.append(token)
+      offsets.append((char_spans[0][0], char_spans[-1][1]))
+    return (tokens, offsets)
+
+  def tokenize_with_char_spans(self, text):
+    """Tokenizes a piece of text, tracking where each character came from.
+
+    This follows the same steps as `tokenize` (cleanup, CJK splitting,
+    whitespace splitting, lower casing, accent stripping and punctuation
+    splitting), but one original character at a time so that every output
+    character can be traced back to the input.
+
+    Args:
+      text: The text to tokenize.
+
+    Returns:
+      A list of `(token, char_spans)` tuples, where `char_spans[i]` is the
+      `(start, end)` span of `convert_to_unicode(text)` that produced
+      `token[i]`.
+    """
+    text = convert_to_unicode(text)
+
+    output = []
+    word = []
+    for (i, char) in enumerate(text):
+      cp = ord(char)
+      if cp == 0 or cp == 0xfffd or _is_control(char):
+        continue
+      if char.isspace():
+        self._split_word_with_char_spans(word, output)
+        word = []
+      elif self._is_chinese_char(cp):
+        self._split_word_with_char_spans(word, output)
+        self._split_word_with_char_spans([(char, i)], output)
+        word = []
+      else:
+        word.append((char, i))
+    self._split_word_with_char_spans(word, output)
+    return output
+
+  def _split_word_with_char_spans(self, word, output):
+    """Normalizes and punctuation-splits a list of `(char, index)` pairs."""
+    if not word:
+      return
+
+    chars = []
+    spans = []
+    if self.do_lower_case:
+      orig_text = "".join([char for (char, _) in word])
+      for (char, i) in word:
+        for normalized_char in self._run_strip_accents(char.lower()):
+          chars.append(normalized_char)
+          spans.append((i, i + 1))
+      expected = self._run_strip_accents(orig_text.lower())
+      if "".join(chars) != expected:
+        # Lower casing and NFD are almost always per-character, but there are
+        # context-sensitive exceptions (e.g. the Greek final sigma). Trust the
+        # whole-word result for the characters, and if the lengths no longer
+        # line up, attribute every character to the whole word.
+        if len(chars) != len(expected):
+          spans = [(word[0][1], word[-1][1] + 1)] * len(expected)
+        chars = list(expected)
+    else:
+      for (char, i) in word:
+        chars.append(char)
+        spans.append((i, i + 1))
+
+    token_chars = []
+    token_spans = []
+    for (char, span) in zip(chars, spans):
+      if char.isspace() or _is_punctuation(char):
+        if token_chars:
+          output.append(("".join(token_chars), token_spans))
+          token_chars = []
+          token_spans = []
+        if not char.isspace():
+          output.append((char, [span]))
+      else:
+        token_chars.append(char)
+        token_spans.append(span)
+    if token_chars:
+      output.append(("".join(token_chars), token_spans))
+
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
     text = unicodedata.normalize("NFD", text)
@@ -327,36 +700,44 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
-        output_tokens.append(self.unk_token)
-        continue
+      for (sub_token, _, _) in self.tokenize_word(token):
+        output_tokens.append(sub_token)
+    return output_tokens
+
+  def tokenize_word(self, token):
+    """Tokenizes a single word into word pieces, with character positions.
+
+    Args:
+      token: A single token without whitespace.
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
+    Returns:
+      A list of `(sub_token, start, end)` tuples, where `token[start:end]` is
+      the part of `token` covered by `sub_token`. An unknown word yields a
+      single `unk_token` covering the whole word.
+    """
+    num_chars = len(token)
+    if num_chars > self.max_input_chars_per_word:
+      return [(self.unk_token, 0, num_chars)]
+
+    start = 0
+    sub_tokens = []
+    while start < num_chars:
+      end = num_chars
+      cur_substr = None
+      while start < end:
+        substr = token[start:end]
+        if start > 0:
+          substr = "##" + substr
+        if substr in self.vocab:
+          cur_substr = substr
           break
-        sub_tokens.append(cur_substr)
-        start = end
+        end -= 1
+      if cur_substr is None:
+        return [(self.unk_token, 0, num_chars)]
+      sub_tokens.append((cur_substr, start, end))
+      start = end
 
-      if is_bad:
-        output_tokens.append(self.unk_token)
-      else:
-        output_tokens.extend(sub_tokens)
-    return output_tokens
+    return sub_tokens
 
 
 def _is_whitespace(char):
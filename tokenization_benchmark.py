@@ -0,0 +1,310 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput benchmark for the tokenizers in tokenization.py.
+
+`tokenization_baseline.json` holds the results of
+
+  python tokenization_benchmark.py --vocab_file=vocab-bak.txt \
+    --output_file=tokenization_baseline.json
+
+with the run settings that it records. A change to tokenization.py is
+compared with it by
+
+  python tokenization_benchmark.py --vocab_file=vocab-bak.txt \
+    --baseline_file=tokenization_baseline.json
+
+Throughput depends on the machine, so a baseline is only meaningful on the
+machine that wrote it; regenerate it with `--output_file` before changing the
+tokenizers. Allocations are only measured if `tracemalloc` is available
+(Python 3).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import platform
+import random
+import timeit
+import numpy as np
+import six
+import tokenization
+import tensorflow as tf
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("vocab_file", None,
+                    "The vocabulary file that the BERT model was trained on.")
+
+flags.DEFINE_bool(
+    "do_lower_case", True,
+    "Whether to lower case the input text. Should be True for uncased "
+    "models and False for cased models.")
+
+flags.DEFINE_string(
+    "input_file", None,
+    "Optional text file (one example per line) to benchmark in addition to "
+    "the synthetic inputs.")
+
+flags.DEFINE_integer("num_calls", 1000,
+                     "Number of timed tokenizer calls for each input set.")
+
+flags.DEFINE_integer(
+    "num_alloc_calls", 100,
+    "Number of calls for each input set that are traced to measure "
+    "allocations. These are not timed, since tracing slows them down.")
+
+flags.DEFINE_integer("random_seed", 12345, "Random seed for input generation.")
+
+flags.DEFINE_string("output_file", None,
+                    "If set, the results are written to this JSON file.")
+
+flags.DEFINE_string(
+    "baseline_file", None,
+    "If set, the results are compared with this JSON file (written by an "
+    "earlier run with `--output_file`).")
+
+flags.DEFINE_float(
+    "max_slowdown", 0.1,
+    "Fail the comparison with `--baseline_file` if the tokens/sec of any "
+    "benchmark drop by more than this fraction.")
+
+_ACCENTED_CHARS = (u"\u00E0\u00E1\u00E2\u00E4\u00E7\u00E8\u00E9\u00EA\u00EB"
+                   u"\u00ED\u00EF\u00F1\u00F3\u00F6\u00FA\u00FC\u00C9\u00D6")
+
+_PUNCTUATION = [u".", u",", u"!", u"?", u"...", u":", u"'s", u"-"]
+
+
+class InputGenerator(object):
+  """Generates real-shaped benchmark inputs from a vocabulary."""
+
+  def __init__(self, vocab_tokens, rng):
+    self.rng = rng
+    self.words = [
+        token for token in vocab_tokens
+        if token and not token.startswith("##") and not token.startswith("[")
+    ]
+
+  def _word(self):
+    return self.rng.choice(self.words)
+
+  def _sentence(self, min_words, max_words):
+    words = [self._word() for _ in range(self.rng.randint(min_words,
+                                                          max_words))]
+    for i in range(len(words)):
+      if self.rng.random() < 0.1:
+        words[i] += self.rng.choice(_PUNCTUATION)
+    words[0] = words[0].capitalize()
+    return u" ".join(words) + u"."
+
+  def tweet(self):
+    words = self._sentence(5, 25).split(u" ")
+    if self.rng.random() < 0.5:
+      words.insert(0, u"@" + self._word())
+    if self.rng.random() < 0.5:
+      words.append(u"#" + self._word() + self._word())
+    return u" ".join(words)
+
+  def article(self):
+    return u" ".join(self._sentence(8, 30) for _ in range(self.rng.randint(
+        20, 40)))
+
+  def cjk(self):
+    chars = []
+    for _ in range(self.rng.randint(50, 200)):
+      if self.rng.random() < 0.1:
+        chars.append(u" " + self._word() + u" ")
+      else:
+        chars.append(six.unichr(self.rng.randint(0x4E00, 0x9FFF)))
+    return u"".join(chars)
+
+  def accented(self):
+    words = []
+    for _ in range(self.rng.randint(10, 40)):
+      word = list(self._word())
+      for _ in range(self.rng.randint(1, 3)):
+        word[self.rng.randrange(len(word))] = self.rng.choice(_ACCENTED_CHARS)
+      words.append(u"".join(word))
+    return u" ".join(words)
+
+  def long_words(self):
+    # 200 characters is the longest word that `WordpieceTokenizer` still runs
+    # its greedy longest-match-first search on, so this is its worst case.
+    letters = u"abcdefghijklmnopqrstuvwxyz"
+    return u" ".join(
+        u"".join(self.rng.choice(letters) for _ in range(200))
+        for _ in range(self.rng.randint(1, 5)))
+
+
+def create_input_sets(vocab_tokens, num_calls, rng):
+  """Returns an OrderedDict of input set name to list of texts."""
+  generator = InputGenerator(vocab_tokens, rng)
+  input_sets = collections.OrderedDict()
+  for name in ["tweet", "article", "cjk", "accented", "long_words"]:
+    make_input = getattr(generator, name)
+    input_sets[name] = [make_input() for _ in range(num_calls)]
+  if FLAGS.input_file:
+    lines = []
+    for line in tokenization.read_lines(FLAGS.input_file):
+      line = line.strip()
+      if line:
+        lines.append(line)
+      if len(lines) == num_calls:
+        break
+    input_sets["input_file"] = lines
+  return input_sets
+
+
+def create_tokenize_fns(tokenizer):
+  """Returns an OrderedDict of tokenizer name to (prepare_fn, tokenize_fn).
+
+  `prepare_fn` is applied to each text outside of the timed region, so that
+  `WordpieceTokenizer` is measured on its real input (the output of
+  `BasicTokenizer`) without also measuring `BasicTokenizer`.
+  """
+  identity = lambda text: text
+  basic_join = lambda text: u" ".join(tokenizer.basic_tokenizer.tokenize(text))
+  return collections.OrderedDict([
+      ("basic", (identity, tokenizer.basic_tokenizer.tokenize)),
+      ("wordpiece", (basic_join, tokenizer.wordpiece_tokenizer.tokenize)),
+      ("full", (identity, tokenizer.tokenize)),
+  ])
+
+
+def run_benchmark(tokenize_fn, texts, num_alloc_calls):
+  """Times `tokenize_fn` on each of `texts`, returning a dict of results."""
+  # Warm up caches (e.g. unicodedata lookups) before timing.
+  for text in texts[:10]:
+    tokenize_fn(text)
+
+  timer = timeit.default_timer
+  latencies = np.zeros([len(texts)], dtype=np.float64)
+  num_tokens = 0
+  for (i, text) in enumerate(texts):
+    start = timer()
+    tokens = tokenize_fn(text)
+    latencies[i] = timer() - start
+    num_tokens += len(tokens)
+
+  peak_bytes = []
+  if tracemalloc is not None:
+    for text in texts[:num_alloc_calls]:
+      # Tracing is restarted for each call, since that is the only way to
+      # reset the peak before Python 3.9 (`tracemalloc.reset_peak`).
+      tracemalloc.start()
+      tokenize_fn(text)
+      (_, peak) = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      peak_bytes.append(peak)
+
+  return collections.OrderedDict([
+      ("calls", len(texts)),
+      ("tokens", num_tokens),
+      ("tokens_per_sec", float(num_tokens / max(np.sum(latencies), 1e-12))),
+      ("p50_us", float(np.percentile(latencies, 50) * 1e6)),
+      ("p99_us", float(np.percentile(latencies, 99) * 1e6)),
+      # None if allocations are not measured.
+      ("mean_peak_alloc_bytes",
+       float(np.mean(peak_bytes)) if peak_bytes else None),
+      ("max_peak_alloc_bytes", int(np.max(peak_bytes)) if peak_bytes else None),
+  ])
+
+
+def compare_with_baseline(results, baseline, max_slowdown):
+  """Logs the change from `baseline` and returns the regressed benchmarks."""
+  regressions = []
+  for (name, result) in results.items():
+    if name not in baseline:
+      tf.logging.info("  %s: no baseline", name)
+      continue
+    ratio = result["tokens_per_sec"] / baseline[name]["tokens_per_sec"]
+    tf.logging.info(
+        "  %s: %.2fx tokens/sec, p99 %.1fus -> %.1fus, peak alloc %s -> %s",
+        name, ratio, baseline[name]["p99_us"], result["p99_us"],
+        baseline[name]["max_peak_alloc_bytes"], result["max_peak_alloc_bytes"])
+    if ratio < 1.0 - max_slowdown:
+      regressions.append(name)
+  return regressions
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+
+  rng = random.Random(FLAGS.random_seed)
+  input_sets = create_input_sets(list(tokenizer.vocab), FLAGS.num_calls, rng)
+  tokenize_fns = create_tokenize_fns(tokenizer)
+
+  results = collections.OrderedDict()
+  for (input_name, texts) in input_sets.items():
+    for (tokenizer_name, (prepare_fn, tokenize_fn)) in tokenize_fns.items():
+      name = "%s/%s" % (input_name, tokenizer_name)
+      result = run_benchmark(tokenize_fn, [prepare_fn(x) for x in texts],
+                             FLAGS.num_alloc_calls)
+      results[name] = result
+      tf.logging.info(
+          "%s: %.0f tokens/sec, p50 %.1fus, p99 %.1fus, peak alloc %s bytes",
+          name, result["tokens_per_sec"], result["p50_us"], result["p99_us"],
+          result["max_peak_alloc_bytes"])
+
+  settings = collections.OrderedDict([
+      ("vocab_file", FLAGS.vocab_file),
+      ("do_lower_case", FLAGS.do_lower_case),
+      ("input_file", FLAGS.input_file),
+      ("num_calls", FLAGS.num_calls),
+      ("num_alloc_calls", FLAGS.num_alloc_calls),
+      ("random_seed", FLAGS.random_seed),
+  ])
+
+  if FLAGS.output_file:
+    output = collections.OrderedDict([
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+    ])
+    output.update(settings)
+    output["results"] = results
+    with tf.gfile.GFile(FLAGS.output_file, "w") as writer:
+      writer.write(json.dumps(output, indent=2) + "\n")
+
+  if FLAGS.baseline_file:
+    with tf.gfile.GFile(FLAGS.baseline_file, "r") as reader:
+      baseline = json.loads(reader.read())
+    for (key, value) in settings.items():
+      if key in baseline and baseline[key] != value:
+        tf.logging.warning("The baseline was run with %s=%s, not %s.", key,
+                           baseline[key], value)
+    tf.logging.info("Comparison with %s:", FLAGS.baseline_file)
+    regressions = compare_with_baseline(results, baseline["results"],
+                                        FLAGS.max_slowdown)
+    if regressions:
+      raise ValueError("Tokenizer throughput regressed by more than %.0f%% "
+                       "on: %s" % (FLAGS.max_slowdown * 100,
+                                   ", ".join(regressions)))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("vocab_file")
+  tf.app.run()
@@ -16,8 +16,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bz2
+import gzip
 import os
 import tempfile
+import numpy as np
 import tokenization
 import six
 import tensorflow as tf
@@ -48,6 +51,191 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
 
+  def test_load_vocab(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ",", u"\u535A", "want"
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      # Trailing whitespace is stripped and the last newline is optional.
+      vocab_writer.write(" \r\n".join(vocab_tokens).encode("utf-8"))
+      vocab_file = vocab_writer.name
+
+    vocab = tokenization.load_vocab(vocab_file)
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    self.assertEqual(list(vocab.keys()), vocab_tokens[:-1])
+    # If a token appears more than once the last id wins.
+    self.assertEqual(vocab["want"], 12)
+    self.assertEqual(vocab[u"\u535A"], 11)
+
+    tokens = tokenizer.tokenize(u"UNwant\u00E9d,running")
+    self.assertAllEqual(tokens, ["un", "##want", "##ed", ",", "runn", "##ing"])
+
+  def test_token_table(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ",", u"\u535A", "want"
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write(" \r\n".join(vocab_tokens).encode("utf-8"))
+      vocab_file = vocab_writer.name
+
+    table_file = tokenization.write_token_table(vocab_file)
+    self.assertEqual(table_file, vocab_file + ".table")
+    self.assertEqual(tokenization.load_vocab_tokens(vocab_file), vocab_tokens)
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    tokens = tokenizer.tokenize(u"UNwant\u00E9d,running")
+    self.assertAllEqual(tokens, ["un", "##want", "##ed", ",", "runn", "##ing"])
+
+    # A table is only read if it matches the current vocab.txt. The stale
+    # table (of the same size) would otherwise still give "un".
+    with open(vocab_file, "wb") as writer:
+      writer.write(u" \r\n".join(vocab_tokens).upper().encode("utf-8"))
+    self.assertEqual(tokenization.load_vocab_tokens(vocab_file)[7], "UN")
+
+    tokenization.write_token_table(vocab_file)
+    self.assertEqual(tokenization.load_vocab_tokens(vocab_file)[7], "UN")
+
+    with open(table_file, "wb") as writer:
+      writer.write(b"[UNK]\n")
+    with self.assertRaises(ValueError):
+      tokenization.load_vocab_tokens(vocab_file)
+    os.unlink(vocab_file)
+    os.unlink(table_file)
+
+  def test_array_conversions(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write("".join(
+          [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    ids = tokenizer.convert_tokens_to_ids_array(
+        ["[CLS]", "un", "##want", "missing", "[SEP]"])
+    self.assertEqual(ids.dtype, np.int32)
+    self.assertAllEqual(ids, [1, 7, 4, 0, 2])
+    self.assertAllEqual(
+        tokenizer.convert_tokens_to_ids(["wa", "missing"]), [6, 0])
+
+    tokens = tokenizer.convert_ids_to_tokens_array([[1, 7, 4], [8, 9, 2]])
+    self.assertAllEqual(tokens.shape, [2, 3])
+    self.assertAllEqual(tokens[1], ["runn", "##ing", "[SEP]"])
+    self.assertAllEqual(
+        tokenizer.convert_ids_to_tokens([3, 5]), ["want", "##ed"])
+    self.assertEqual(tokenizer.convert_ids_to_tokens([]), [])
+    self.assertEqual(tokenizer.inv_vocab[5], "##ed")
+
+    # Ids outside of the vocab raise instead of wrapping around.
+    for ids in ([-1], [3, 11], [[1, 2], [-2, 3]]):
+      with self.assertRaises(KeyError):
+        tokenizer.convert_ids_to_tokens_array(ids)
+    for ids in ([-1], [3, 11]):
+      with self.assertRaises(KeyError):
+        tokenizer.convert_ids_to_tokens(ids)
+
+  def test_tokenize_with_offsets(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write("".join(
+          [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    text = u"\u0005UNwant\u00E9d,  runn\u0005ing \u535Ax"
+    (tokens, offsets) = tokenizer.tokenize_with_offsets(text)
+    self.assertAllEqual(tokens, tokenizer.tokenize(text))
+    self.assertAllEqual(
+        tokens, ["un", "##want", "##ed", ",", "runn", "##ing", "[UNK]",
+                 "[UNK]"])
+    self.assertAllEqual([text[start:end] for (start, end) in offsets], [
+        u"UN", u"want", u"\u00E9d", u",", u"runn", u"ing", u"\u535A", u"x"
+    ])
+
+  def test_read_lines(self):
+    lines = [u"UNwant\u00E9d,running", u"", u"\u535A\u63A8 x" * 3, u"last"]
+    data = u"\n".join(lines).encode("utf-8")
+
+    temp_dir = tempfile.mkdtemp()
+    for (name, compressed) in [("plain.txt", data),
+                               ("zipped.txt.gz", gzip.compress(data) * 2),
+                               ("zipped.txt.bz2", bz2.compress(data))]:
+      input_file = os.path.join(temp_dir, name)
+      with open(input_file, "wb") as writer:
+        writer.write(compressed)
+
+      expected = lines
+      if name.endswith(".gz"):
+        # Concatenated streams are read back to back.
+        expected = lines[:-1] + [lines[-1] + lines[0]] + lines[1:]
+      for block_size in [3, 1 << 20]:
+        self.assertAllEqual(
+            list(tokenization.read_lines(input_file, block_size)), expected)
+      os.unlink(input_file)
+    os.rmdir(temp_dir)
+
+  def test_read_lines_concatenated_streams(self):
+    first = u"UNwant\u00E9d,running\n\u535A\u63A8 x\n".encode("utf-8")
+    second = u"last\n".encode("utf-8")
+
+    temp_dir = tempfile.mkdtemp()
+    for compress in [gzip.compress, bz2.compress]:
+      streams = [compress(first), compress(second)]
+      input_file = os.path.join(temp_dir, "concatenated")
+      with open(input_file, "wb") as writer:
+        writer.write(b"".join(streams))
+
+      # Blocks that end exactly at, just before and just after the end of the
+      # first stream.
+      stream_length = len(streams[0])
+      for block_size in [3, stream_length - 1, stream_length,
+                         stream_length + 1, 1 << 20]:
+        self.assertAllEqual(
+            list(tokenization.read_lines(input_file, block_size)),
+            [u"UNwant\u00E9d,running", u"\u535A\u63A8 x", u"last"])
+      os.unlink(input_file)
+    os.rmdir(temp_dir)
+
+  def test_read_tokenized_batches(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write("".join(
+          [x + "\n" for x in vocab_tokens]).encode("utf-8"))
+
+      vocab_file = vocab_writer.name
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    with tempfile.NamedTemporaryFile(delete=False) as input_writer:
+      input_writer.write(u"UNwant\u00E9d\n  \nrunning,\n\u0005\n".encode("utf-8"))
+
+      input_file = input_writer.name
+
+    batches = list(tokenization.read_tokenized_batches(
+        input_file, tokenizer, batch_size=3))
+    os.unlink(input_file)
+
+    self.assertEqual(batches, [[["un", "##want", "##ed"], None,
+                                ["runn", "##ing", ","]], [[]]])
+
   def test_chinese(self):
     tokenizer = tokenization.BasicTokenizer()
 
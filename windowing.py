@@ -0,0 +1,114 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Predicts long texts from overlapping windows instead of truncating them.
+
+The tokens of a text are split into windows that fit in `max_seq_length` and
+whose starts are `stride` tokens apart. The windows of all texts are predicted
+in batches like any other examples, and the class probabilities of the windows
+of each text are then aggregated into a single prediction.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+AGGREGATION_METHODS = ("mean", "max", "attention")
+
+
+def get_window_starts(num_tokens, window_length, stride):
+  """Returns the start of each window of a text.
+
+  Args:
+    num_tokens: int. Number of tokens of the text.
+    window_length: int. Number of tokens of each window.
+    stride: int. Distance between the starts of consecutive windows. It should
+      not be larger than `window_length`, or some tokens are skipped.
+
+  Returns:
+    A list of increasing ints. The last window ends at the last token, so it
+    may overlap more with the previous window than the others.
+
+  Raises:
+    ValueError: If `window_length` or `stride` is not positive.
+  """
+  if window_length <= 0 or stride <= 0:
+    raise ValueError("The window length (%d) and stride (%d) must be positive."
+                     % (window_length, stride))
+  last_start = max(num_tokens - window_length, 0)
+  starts = list(range(0, last_start, stride))
+  starts.append(last_start)
+  return starts
+
+
+def aggregate_probabilities(probabilities, method):
+  """Aggregates the class probabilities of the windows of one text.
+
+  Args:
+    probabilities: float array of shape [num_windows, num_labels].
+    method: string. One of:
+      "mean": The average of the probabilities.
+      "max": The largest probability of each class over the windows,
+        renormalized, so a class that any window is sure of wins.
+      "attention": The average weighted by the softmax over the windows of
+        their negative entropy, so confident windows count more than the
+        windows that the model cannot tell apart.
+
+  Returns:
+    float64 array of shape [num_labels] that sums to 1.
+
+  Raises:
+    ValueError: If `method` is unknown.
+  """
+  probabilities = np.asarray(probabilities, dtype=np.float64)
+  if method == "mean":
+    return np.mean(probabilities, axis=0)
+  elif method == "max":
+    output = np.max(probabilities, axis=0)
+    return output / np.sum(output)
+  elif method == "attention":
+    entropy = -np.sum(
+        probabilities * np.log(np.maximum(probabilities, 1e-12)), axis=1)
+    weights = np.exp(np.min(entropy) - entropy)
+    weights /= np.sum(weights)
+    return np.sum(weights[:, np.newaxis] * probabilities, axis=0)
+  else:
+    raise ValueError("Unknown aggregation method: %s" % method)
+
+
+def group_windows(document_indexes, results):
+  """Groups the results of consecutive windows by document.
+
+  Args:
+    document_indexes: List of the index of the document of each window. The
+      windows of a document must be consecutive.
+    results: Iterable of the result of each window, in the same order. Extra
+      results (e.g. of padding windows) are ignored.
+
+  Yields:
+    A tuple of the document index and the list of the results of its windows,
+    for each document in order.
+  """
+  current_index = None
+  current_results = []
+  for (document_index, result) in zip(document_indexes, results):
+    if document_index != current_index and current_results:
+      yield (current_index, current_results)
+      current_results = []
+    current_index = document_index
+    current_results.append(result)
+  if current_results:
+    yield (current_index, current_results)
@@ -0,0 +1,62 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+import windowing
+
+
+class WindowingTest(tf.test.TestCase):
+
+  def test_get_window_starts(self):
+    self.assertEqual(windowing.get_window_starts(5, 8, 4), [0])
+    self.assertEqual(windowing.get_window_starts(8, 8, 4), [0])
+    self.assertEqual(windowing.get_window_starts(16, 8, 4), [0, 4, 8])
+    self.assertEqual(windowing.get_window_starts(17, 8, 4), [0, 4, 8, 9])
+    with self.assertRaises(ValueError):
+      windowing.get_window_starts(17, 8, 0)
+
+  def test_aggregate_probabilities(self):
+    probabilities = [[0.9, 0.1], [0.3, 0.7], [0.5, 0.5]]
+    self.assertAllClose(
+        windowing.aggregate_probabilities(probabilities, "mean"),
+        [17.0 / 30, 13.0 / 30])
+    self.assertAllClose(
+        windowing.aggregate_probabilities(probabilities, "max"),
+        [0.9 / 1.6, 0.7 / 1.6])
+
+    # The confident first window outweighs the uncertain last one.
+    attention = windowing.aggregate_probabilities(probabilities, "attention")
+    self.assertAllClose(np.sum(attention), 1.0)
+    self.assertGreater(attention[0], 17.0 / 30)
+    self.assertAllClose(
+        windowing.aggregate_probabilities([[0.2, 0.8]], "attention"),
+        [0.2, 0.8])
+
+    with self.assertRaises(ValueError):
+      windowing.aggregate_probabilities(probabilities, "median")
+
+  def test_group_windows(self):
+    groups = list(
+        windowing.group_windows([0, 0, 1, 2, 2, 2], "abcdefgh"))
+    self.assertEqual(groups, [(0, ["a", "b"]), (1, ["c"]),
+                              (2, ["d", "e", "f"])])
+
+
+if __name__ == "__main__":
+  tf.test.main()